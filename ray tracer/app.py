@@ -7,7 +7,9 @@ class App:
         Calls high level control functions (handle input, draw scene etc)
     """
     
-    def __init__(self, width=640, height=None, use_fxaa=True):
+    def __init__(self, width=640, height=None, use_fxaa=True, greedy_meshing=False, occlusion_mode="bvh",
+        bake_visibility=False, use_lightmap=False, lighting_scale=1,
+        temporal_cache=False, dynamic_resolution=False, profile_path=None):
         pg.init()
         self.Width = width
         # if height is None or non-positive, force 4:3 aspect ratio
@@ -21,8 +23,14 @@ class App:
         pg.mouse.set_visible(False)
         
         # Pass FXAA setting to the graphics engine
-        self.graphicsEngine = engine.Engine(self.Width, self.Height, use_fxaa=use_fxaa)
-        self.scene = scene.Scene()
+        self.graphicsEngine = engine.Engine(
+            self.Width, self.Height, use_fxaa=use_fxaa, occlusion_mode=occlusion_mode,
+            bake_visibility=bake_visibility, use_lightmap=use_lightmap,
+            lighting_scale=lighting_scale, temporal_cache=temporal_cache,
+            dynamic_resolution=dynamic_resolution, profile=profile_path is not None
+        )
+        self.profilePath = profile_path
+        self.scene = scene.Scene(greedy_meshing=greedy_meshing)
         
         self.lastTime = pg.time.get_ticks()
         self.currentTime = 0
@@ -86,12 +94,21 @@ class App:
         delta = self.currentTime - self.lastTime
         if (delta >= 1000):
             framerate = max(1,int(1000.0 * self.numFrames/delta))
-            pg.display.set_caption(f"Running at {framerate} fps.")
+            caption = f"Running at {framerate} fps."
+            if self.graphicsEngine.resolutionController is not None:
+                caption += f" Rendering at {self.graphicsEngine.renderWidth}x{self.graphicsEngine.renderHeight}."
+            pg.display.set_caption(caption)
             self.lastTime = self.currentTime
             self.numFrames = -1
             self.frameTime = float(1000.0 / max(1,framerate))
         self.numFrames += 1
 
     def quit(self):
+        #save the pass times before the context goes
+        if self.profilePath is not None:
+            self.graphicsEngine.profiler.export(self.profilePath)
+            print(self.graphicsEngine.profiler.report())
+            #quit runs again from runner.py, only save them once
+            self.profilePath = None
         #self.graphicsEngine.destroy()
         pg.quit()
\ No newline at end of file
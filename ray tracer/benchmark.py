@@ -0,0 +1,787 @@
+import sys
+import multiprocessing
+import tempfile
+import time
+import bvh
+import cpurender
+import elements
+import geometry
+import levelcache
+import lightgrid
+import lightmap
+import objectbuffer
+import occlusion
+import resolution
+import scene
+import temporal
+import textures
+import tilerender
+import upsample
+import visibility
+from common import *
+
+"""
+    Headless benchmarks for level building. Run from the repository root:
+
+        python "ray tracer/benchmark.py" lumped
+"""
+
+def makeWalls(size, seed=0, density=0.3):
+    """
+        Build a random size x size wall matrix with a solid border,
+        scattered blocks of every material and a sprinkling of doors.
+    """
+
+    rng = np.random.default_rng(seed)
+    walls = rng.integers(1, 10, size=(size, size))
+    walls[rng.random((size, size)) > density] = 0
+    walls[1:-1, 1:-1][rng.random((size - 2, size - 2)) < 0.01] = geometry.DOOR
+    walls[0, :] = 6
+    walls[-1, :] = 6
+    walls[:, 0] = 6
+    walls[:, -1] = 6
+
+    return walls.astype(np.int32)
+
+def toMatrix(walls):
+    """
+        Convert an integer wall array back into the list-of-lists
+        format used by scene files.
+    """
+
+    return [["d" if block == geometry.DOOR else block for block in row] for row in walls.tolist()]
+
+def timeIt(function, *args, repeats=3):
+    """
+        Return the best wall clock time of a few calls, in seconds.
+    """
+
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmarkLumpedGeometry(sizes=(16, 64, 256, 1024, 4096), legacyLimit=1024):
+    """
+        Time getLumpedGeometryArray against the nested loop version.
+        The loop version is only run up to legacyLimit, it is far too slow beyond that.
+    """
+
+    print(f"{'size':>10} {'numpy (s)':>12} {'loops (s)':>12} {'speedup':>10}")
+    for size in sizes:
+        walls = makeWalls(size)
+        fast = timeIt(geometry.getLumpedGeometryArray, walls)
+
+        if size <= legacyLimit:
+            matrix = toMatrix(walls)
+            slow = timeIt(geometry.getLumpedGeometry, matrix, repeats=1)
+            if not np.array_equal(geometry.getLumpedGeometryArray(walls), geometry.getLumpedGeometry(matrix)):
+                raise RuntimeError(f"wall masks differ at {size}x{size}")
+            print(f"{f'{size}x{size}':>10} {fast:12.5f} {slow:12.5f} {slow / fast:9.1f}x")
+        else:
+            print(f"{f'{size}x{size}':>10} {fast:12.5f} {'-':>12} {'-':>10}")
+
+def benchmarkEdges(sizes=(16, 64, 256, 1024, 2048)):
+    """
+        Time run-length edge extraction, with and without building
+        edge.Edge objects for legacy callers.
+    """
+
+    print(f"{'size':>10} {'edges':>10} {'array (s)':>12} {'objects (s)':>12}")
+    for size in sizes:
+        wall_mask = geometry.getLumpedGeometryArray(makeWalls(size))
+        fast = timeIt(geometry.getEdgesArray, wall_mask)
+        slow = timeIt(geometry.getEdges, wall_mask, repeats=1)
+        count = len(geometry.getEdgesArray(wall_mask))
+        print(f"{f'{size}x{size}':>10} {count:10d} {fast:12.5f} {slow:12.5f}")
+
+def benchmarkClassifyEdges(sizes=(64, 256, 512, 1024, 2048)):
+    """
+        Time classifyEdgeArray on growing maps. The time per edge
+        should stay flat if the build is linear in the edge count.
+    """
+
+    print(f"{'size':>10} {'edges':>10} {'time (s)':>12} {'us/edge':>10}")
+    for size in sizes:
+        edges = geometry.getEdgesArray(geometry.getLumpedGeometryArray(makeWalls(size)))
+        elapsed = timeIt(geometry.classifyEdgeArray, edges)
+        print(f"{f'{size}x{size}':>10} {len(edges):10d} {elapsed:12.5f} {1e6 * elapsed / len(edges):10.3f}")
+
+class HeadlessScene(scene.Scene):
+    """
+        A scene which never touches OpenGL, for timing the CPU side.
+    """
+
+    def finalize(self):
+        pass
+
+def makeScene(walls, greedy_meshing=False, lights=None):
+    """
+        Build a HeadlessScene from a wall array, with plain floors and ceilings.
+    """
+
+    floors = np.full(walls.shape, 4, dtype=np.int32)
+    return HeadlessScene(
+        greedy_meshing=greedy_meshing, use_level_cache=False,
+        wall_geometry=toMatrix(walls), floor_geometry=floors.tolist(),
+        ceiling_geometry=(2 * floors).tolist(), lights=lights
+    )
+
+def getWallPlanes(_scene):
+    """
+        The wall planes of every room as a sorted list of
+        (center, normal, half width), for comparing two scenes.
+    """
+
+    return sorted(
+        (tuple(np.round(_plane.center, 3).tolist()), tuple(_plane.normal.tolist()), round(float(_plane.uMax), 3))
+        for _room in _scene.rooms for _plane in _room.planes if _plane.normal[2] == 0
+    )
+
+def benchmarkEdits(sizes=(64, 128, 256, 512, 1024), edits=200):
+    """
+        Time Scene.set_block on growing maps, toggling random blocks
+        between empty and solid. The time per edit should not grow with
+        the map, apart from the edge pass along the edited rows and columns.
+        Vertex uploads are not included, the scene has no OpenGL context.
+
+        The edited scene's wall planes and doors are checked against a
+        scene built from scratch on the edited map.
+    """
+
+    print(f"{'size':>10} {'rooms':>8} {'rebuild (s)':>12} {'edit (ms)':>10} {'matches':>8}")
+    for size in sizes:
+        walls = makeWalls(size, density=0.1)
+        _scene = makeScene(walls)
+        _scene.prepare_edits()
+
+        rng = np.random.default_rng(1)
+        cells = rng.integers(1, size - 1, size=(edits, 2)).tolist()
+        start = time.perf_counter()
+        for row, col in cells:
+            _scene.set_block(row, col, 0 if _scene.wall_array[row, col] != 0 else 5)
+        elapsed = (time.perf_counter() - start) / edits
+
+        start = time.perf_counter()
+        rebuilt = makeScene(_scene.wall_array.copy())
+        rebuild = time.perf_counter() - start
+        matches = getWallPlanes(_scene) == getWallPlanes(rebuilt) and \
+            sorted(_door.coordinate for _door in _scene.doors) == sorted(_door.coordinate for _door in rebuilt.doors)
+        print(f"{f'{size}x{size}':>10} {len(_scene.rooms):8d} {rebuild:12.5f} {1e3 * elapsed:10.3f} {str(matches):>8}")
+
+def makeRoomGrid(size, room_size=3, seed=0):
+    """
+        Build a size x size wall matrix cut into room_size x room_size
+        rooms by single walls, with a door in a few of the walls between
+        them. Gives thousands of rooms on large maps.
+    """
+
+    rng = np.random.default_rng(seed)
+    walls = np.zeros((size, size), dtype=np.int32)
+    step = room_size + 1
+    walls[::step, :] = 6
+    walls[:, ::step] = 6
+    walls[-1, :] = 6
+    walls[:, -1] = 6
+
+    #doors go in the middle of a wall, where no other wall crosses it
+    middle = np.arange(step // 2, size - 1, step)
+    lines = np.arange(step, size - 1, step)
+    for rows, cols in ((lines[:, None], middle[None, :]), (middle[:, None], lines[None, :])):
+        rows, cols = np.broadcast_arrays(rows, cols)
+        chosen = rng.random(rows.shape) < 0.2
+        walls[rows[chosen], cols[chosen]] = geometry.DOOR
+
+    return walls
+
+def findActiveRooms(_scene, coordinate):
+    """
+        The active room search Scene.update used to do, scanning
+        every room's block list.
+    """
+
+    return [_room for _room in _scene.rooms if coordinate in _room.internalCoordinates]
+
+def benchmarkUpdate(sizes=(32, 64, 128, 256, 512), updates=1000):
+    """
+        Time Scene.update with the camera moving between random empty
+        blocks and doors, on maps of small rooms. It should take the
+        same time however many rooms there are, unlike the old scan.
+    """
+
+    print(f"{'size':>10} {'rooms':>8} {'update (us)':>12} {'scan (us)':>12}")
+    for size in sizes:
+        walls = makeRoomGrid(size)
+        _scene = makeScene(walls)
+
+        rng = np.random.default_rng(1)
+        open_cells = np.argwhere((walls == 0) | (walls == geometry.DOOR))
+        cells = open_cells[rng.integers(0, len(open_cells), size=updates)].tolist()
+
+        start = time.perf_counter()
+        for row, col in cells:
+            _scene.camera.posArray[:2] = (col + 0.5, row + 0.5)
+            _scene.update(rate=1.0)
+        elapsed = (time.perf_counter() - start) / updates
+
+        #the scan is slow on big maps, a few calls are enough to time it
+        scanned = cells[:20]
+        start = time.perf_counter()
+        for row, col in scanned:
+            findActiveRooms(_scene, (row, col))
+        scan = (time.perf_counter() - start) / len(scanned)
+
+        for row, col in scanned:
+            _scene.camera.posArray[:2] = (col + 0.5, row + 0.5)
+            _scene.update(rate=1.0)
+            if {id(_room) for _room in _scene.active_rooms} != {id(_room) for _room in findActiveRooms(_scene, (row, col))}:
+                raise RuntimeError(f"active rooms differ at {(row, col)} on {size}x{size}")
+
+        print(f"{f'{size}x{size}':>10} {len(_scene.rooms):8d} {1e6 * elapsed:12.3f} {1e6 * scan:12.1f}")
+
+def recordObjects(_scene, objectData):
+    """
+        Fill the object data one float at a time, the way
+        Engine.updateScene used to every frame.
+    """
+
+    i = 0
+    for _sphere in _scene.spheres + [_sphere for _room in _scene.active_rooms for _sphere in _room.spheres]:
+        for j, value in enumerate((*_sphere.center, _sphere.radius, *_sphere.color, _sphere.roughness)):
+            objectData[20*i + j] = value
+        i += 1
+    planes = list(_scene.planes)
+    for _room in _scene.active_rooms:
+        planes += _room.planes
+        for _door in _room.doors:
+            planes += _door.planes
+    for _plane in planes:
+        for j, value in enumerate((
+            *_plane.center, *_plane.tangent, *_plane.bitangent, *_plane.normal,
+            _plane.uMin, _plane.uMax, _plane.vMin, _plane.vMax, _plane.material_index
+        )):
+            objectData[20*i + j] = value
+        i += 1
+    for _light in _scene.lights + [_light for _room in _scene.active_rooms for _light in _room.lights]:
+        for j, value in enumerate((*_light.position, _light.strength, *_light.color)):
+            objectData[20*i + j] = value
+        i += 1
+    bytes(objectData)
+
+def benchmarkObjects(sizes=(16, 32, 64, 128), lights=16, frames=100):
+    """
+        Time packing the object buffers for frames where only the
+        lights move, against writing every object one float at a time.
+        Also counts the rows which would be uploaded each frame.
+    """
+
+    print(f"{'size':>10} {'objects':>8} {'packed (us)':>12} {'rows':>6} {'floats (us)':>12}")
+    for size in sizes:
+        walls = makeWalls(size, density=0.1)
+        rng = np.random.default_rng(2)
+        cells = np.argwhere(walls == 0)[rng.integers(0, int((walls == 0).sum()), size=lights)]
+        _scene = makeScene(walls, lights=[
+            elements.Light(
+                position=(col + 0.5, row + 0.5, 0.5), color=(1, 1, 1),
+                strength=1, axis=(1, 0, 0), radius=0.25, velocity=0.025
+            )
+            for row, col in cells.tolist()
+        ])
+        _scene.camera.posArray[:2] = cells[0, ::-1] + 0.5
+        _scene.update(rate=1.0)
+
+        store = objectbuffer.ObjectStore()
+        objectCount = sum(store.pack(_scene))
+
+        rows = 0
+        elapsed = 0
+        for _ in range(frames):
+            for buffer in store.buffers:
+                buffer.dirtyRows = []
+            _scene.update(rate=1.0)
+            start = time.perf_counter()
+            store.pack(_scene)
+            elapsed += time.perf_counter() - start
+            rows += sum(last - first for buffer in store.buffers for first, last in buffer.getDirtyRanges())
+
+        objectData = np.zeros(20 * objectCount, dtype=np.float32)
+        legacy = timeIt(recordObjects, _scene, objectData)
+
+        print(f"{f'{size}x{size}':>10} {objectCount:8d} {1e6 * elapsed / frames:12.1f} {rows / frames:6.1f} {1e6 * legacy:12.1f}")
+
+def benchmarkBVH(sizes=(16, 32, 64, 128), rays=200):
+    """
+        Build the bvh for one room of growing maps, then cast random
+        shadow rays through it with the CPU traversal and check them
+        against testing every primitive.
+    """
+
+    print(f"{'size':>10} {'planes':>8} {'nodes':>8} {'build (s)':>10} {'visited':>8} {'tested':>8}")
+    for size in sizes:
+        walls = makeWalls(size, density=0.1)
+        _scene = makeScene(walls)
+        _scene.active_rooms = [max(_scene.rooms, key=lambda _room: len(_room.planes))]
+        _scene.spheres = [
+            elements.Sphere(
+                center=(col + 0.5, row + 0.5, 0.5), radius=0.3, color=(1, 1, 1),
+                roughness=0.5, axis=(0, 0, 1), motion_radius=0, velocity=0
+            )
+            for row, col in np.argwhere(walls == 0)[:8].tolist()
+        ]
+        spheres = objectbuffer.packSpheres(_scene.spheres)
+
+        start = time.perf_counter()
+        nodes, planes, top_count = bvh.buildTopLevel(_scene, spheres)
+        build = time.perf_counter() - start
+
+        rng = np.random.default_rng(3)
+        stats = {"nodes": 0, "primitives": 0}
+        for _ in range(rays):
+            origin = np.array([rng.uniform(1, size - 1), rng.uniform(1, size - 1), rng.uniform(0.05, 0.95)], dtype=np.float32)
+            direction = rng.normal(size=3).astype(np.float32)
+            direction /= np.linalg.norm(direction)
+            distance = rng.uniform(0.5, size / 2)
+            nearest = min(
+                bvh.getPlaneDistances(planes, origin, direction).min(),
+                bvh.getSphereDistances(spheres, origin, direction).min(initial=9999)
+            )
+            if bvh.isOccluded(nodes, top_count, planes, spheres, origin, direction, distance, stats) != (nearest < distance):
+                raise RuntimeError(f"shadow ray differs from brute force on {size}x{size}")
+
+        print(
+            f"{f'{size}x{size}':>10} {len(planes):8d} {len(nodes):8d} {build:10.4f} "
+            f"{stats['nodes'] / rays:8.1f} {stats['primitives'] / rays:8.1f}"
+        )
+
+def benchmarkOcclusion(sizes=(16, 32, 64, 128), rays=200):
+    """
+        Answer random shadow rays between open cells by stepping through
+        the wall grid and by walking the bvh over the scene's planes.
+        The grid walk must agree exactly with testing every block face
+        (occlusion.getBlockPlanes). The scene's planes leave out convex
+        edges, so light slips past some corners they miss; the last column
+        is how often the two methods agree.
+    """
+
+    print(f"{'size':>10} {'grid (us)':>10} {'bvh (us)':>10} {'blocked':>8} {'same (%)':>9}")
+    for size in sizes:
+        walls = makeWalls(size, density=0.1)
+        _scene = makeScene(walls)
+        _scene.active_rooms = list(_scene.rooms)
+        spheres = objectbuffer.packSpheres([])
+        nodes, planes, top_count = bvh.buildTopLevel(_scene, spheres)
+        solid = occlusion.getSolidGrid(_scene.wall_array)
+        faces = occlusion.getBlockPlanes(solid)
+
+        rng = np.random.default_rng(4)
+        open_cells = np.argwhere(walls == 0)
+        ends = [
+            np.column_stack((
+                cells[:, 1] + rng.uniform(0.02, 0.98, rays),
+                cells[:, 0] + rng.uniform(0.02, 0.98, rays),
+                rng.uniform(0.02, 0.98, rays)
+            ))
+            for cells in (open_cells[rng.integers(len(open_cells), size=(2, rays))])
+        ]
+        origins = ends[0].astype(np.float32)
+        directions = ends[1] - ends[0]
+        distances = np.linalg.norm(directions, axis=1)
+        directions = (directions / distances[:, None]).astype(np.float32)
+
+        start = time.perf_counter()
+        grid = occlusion.walkGrid(solid, origins, directions, distances)
+        grid_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tree = np.array([
+            bvh.isOccluded(nodes, top_count, planes, spheres, origin, direction, distance)
+            for origin, direction, distance in zip(origins, directions, distances)
+        ])
+        tree_time = time.perf_counter() - start
+
+        shifted = origins + occlusion.GRID_EPSILON * directions
+        expected = np.array([
+            bvh.getPlaneDistances(faces, origin, direction).min() < distance - occlusion.GRID_EPSILON
+            for origin, direction, distance in zip(shifted, directions, distances)
+        ])
+        if np.any(grid != expected):
+            raise RuntimeError(f"grid walk differs from the block faces on {size}x{size}")
+
+        print(
+            f"{f'{size}x{size}':>10} {1e6 * grid_time / rays:10.1f} {1e6 * tree_time / rays:10.1f} "
+            f"{grid.mean():8.2f} {100 * np.mean(grid == tree):9.1f}"
+        )
+
+def benchmarkLights(counts=(16, 64, 256, 1024), size=64, frames=20):
+    """
+        Bin growing numbers of moving lights into the cells of a map, as
+        ObjectStore.pack does each frame, and check every cell's list
+        against measuring each light's distance to it.
+    """
+
+    walls = makeWalls(size, density=0.1)
+    open_cells = np.argwhere(walls == 0)
+    rows, cols = np.mgrid[0:size, 0:size]
+
+    print(f"{'lights':>8} {'radius':>8} {'bin (ms)':>9} {'per cell':>9}")
+    for count in counts:
+        rng = np.random.default_rng(5)
+        cells = open_cells[rng.integers(len(open_cells), size=count)]
+        lights = [
+            elements.Light(
+                position=(col + 0.5, row + 0.5, 0.5), color=tuple(rng.uniform(0.3, 1, 3)),
+                strength=rng.uniform(0.05, 0.2), axis=(1, 0, 0), radius=0.4, velocity=0.05
+            )
+            for row, col in cells.tolist()
+        ]
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            for _light in lights:
+                _light.update(1.0)
+            packed = objectbuffer.packLights(lights)
+            table, indices = lightgrid.binLights(packed[:, 0:3], packed[:, 7], walls.shape)
+        elapsed = (time.perf_counter() - start) / frames
+
+        for i, (x, y, radius) in enumerate(packed[:, [0, 1, 7]].tolist()):
+            reached = (np.clip(x, cols, cols + 1) - x) ** 2 + (np.clip(y, rows, rows + 1) - y) ** 2 <= radius ** 2
+            listed = np.zeros(walls.size, dtype=bool)
+            owner = np.repeat(np.arange(walls.size), table["count"])
+            listed[owner[indices["light"] == i]] = True
+            if np.any(listed != reached.ravel()):
+                raise RuntimeError(f"light {i} is binned into the wrong cells")
+
+        print(
+            f"{count:8d} {packed[:, 7].mean():8.2f} {1000 * elapsed:9.3f} "
+            f"{table['count'].mean():9.1f}"
+        )
+
+def benchmarkVisibility(sizes=(16, 32, 64), lights=4, points=2000):
+    """
+        Bake moving lights' wall visibility on growing maps, then compare
+        the baked values with stepping shadow rays through the grid from
+        random points on the floor, with each light halfway between two
+        baked positions and at one of them.
+    """
+
+    print(f"{'size':>10} {'bake (s)':>9} {'kB':>8} {'error':>7} {'at sample':>10}")
+    for size in sizes:
+        walls = makeWalls(size, density=0.1)
+        solid = occlusion.getSolidGrid(walls)
+        rng = np.random.default_rng(6)
+        open_cells = np.argwhere(walls == 0)
+        cells = open_cells[rng.integers(len(open_cells), size=lights)]
+        _lights = [
+            elements.Light(
+                position=(col + 0.5, row + 0.5, 0.5), color=(1, 1, 1), strength=0.2,
+                axis=(1, 0, 0), radius=1, velocity=0.05
+            )
+            for row, col in cells.tolist()
+        ]
+
+        start = time.perf_counter()
+        volumes = [visibility.bakeVolume(_light, solid) for _light in _lights]
+        bake = (time.perf_counter() - start) / lights
+        size_kb = sum(data.nbytes for _, data in volumes) / lights / 1024
+
+        cells = open_cells[rng.integers(len(open_cells), size=points)]
+        floor = np.column_stack((
+            cells[:, 1] + rng.uniform(0, 1, points), cells[:, 0] + rng.uniform(0, 1, points), np.zeros(points)
+        ))
+        errors = []
+        for offset in (0.5, 0.0):
+            error = 0
+            for _light, (header, data) in zip(_lights, volumes):
+                #phase of a point between (or on) baked positions
+                samples = int(header["samples"])
+                phase = -1 + 2 * (samples // 2 + offset) / (samples - 1)
+                position = _light.center + _light.radius * phase * _light.axis
+                directions = position - floor
+                distances = np.linalg.norm(directions, axis=1)
+                directions /= distances[:, None]
+                reach = distances < lightgrid.getInfluenceRadii([_light])[0]
+
+                exact = ~occlusion.walkGrid(solid, floor[reach], directions[reach], distances[reach])
+                baked = visibility.sampleVolume(header, data, phase, floor[reach], directions[reach])
+                error += np.abs(baked - exact).mean() / lights
+            errors.append(error)
+
+        print(f"{f'{size}x{size}':>10} {bake:9.3f} {size_kb:8.1f} {errors[0]:7.3f} {errors[1]:10.3f}")
+
+def benchmarkLightmap(sizes=(16, 32, 64), lights=8, points=2000):
+    """
+        Bake static lights into lightmaps on growing maps, store and load
+        the bake through the level cache, then compare reading it with
+        shading the lights directly (diffuse, shadow rays through the grid)
+        at random points on the floor.
+    """
+
+    print(
+        f"{'size':>10} {'bake (s)':>9} {'MB':>6} {'load (s)':>9}"
+        f" {'direct (s)':>11} {'lightmap (s)':>13} {'error':>7}"
+    )
+    for size in sizes:
+        walls = makeWalls(size, density=0.1)
+        solid = occlusion.getSolidGrid(walls)
+        rng = np.random.default_rng(7)
+        open_cells = np.argwhere(walls == 0)
+        cells = open_cells[rng.integers(len(open_cells), size=lights)]
+        _lights = [
+            elements.Light(
+                position=(col + 0.5, row + 0.5, 0.5), color=(1, 1, 1), strength=0.2,
+                axis=(0, 0, 0), radius=0, velocity=0
+            )
+            for row, col in cells.tolist()
+        ]
+
+        start = time.perf_counter()
+        table, atlas = lightmap.bakeLightmap(walls, _lights)
+        bake = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as folder:
+            levelcache.saveLightmap("benchmark", table, atlas, folder)
+            load = timeIt(levelcache.loadLightmap, "benchmark", folder)
+
+        cells = open_cells[rng.integers(len(open_cells), size=points)]
+        floor = np.column_stack((
+            cells[:, 1] + rng.uniform(0, 1, points), cells[:, 0] + rng.uniform(0, 1, points), np.zeros(points)
+        ))
+        normals = np.tile((0.0, 0.0, 1.0), (points, 1))
+
+        def shadeDirect():
+            light = np.zeros((points, 3))
+            for _light, reach in zip(_lights, lightgrid.getInfluenceRadii(_lights)):
+                directions = _light.center - floor
+                distances = np.linalg.norm(directions, axis=1)
+                directions /= distances[:, None]
+                lit = np.flatnonzero((directions[:, 2] > 0) & (distances < reach))
+                lit = lit[~occlusion.walkGrid(solid, floor[lit], directions[lit], distances[lit])]
+                light[lit] += _light.color * _light.strength * (directions[lit, 2] / distances[lit] ** 2)[:, None]
+            return light
+
+        direct = timeIt(shadeDirect)
+        baked = timeIt(lightmap.sampleLightmap, table, atlas, floor, normals)
+        error = np.abs(lightmap.sampleLightmap(table, atlas, floor, normals) - shadeDirect()).mean()
+
+        print(
+            f"{f'{size}x{size}':>10} {bake:9.3f} {atlas.nbytes / 2 ** 20:6.2f} {load:9.4f}"
+            f" {direct:11.4f} {baked:13.4f} {error:7.4f}"
+        )
+
+def makeTopDownBuffer(walls, pixels_per_cell):
+    """
+        Positions and normals seen looking straight down on a wall grid:
+        the floor in open cells and the tops of the blocks elsewhere,
+        a little g-buffer with edges for the lighting benchmarks.
+    """
+
+    rows, cols = walls.shape
+    y, x = np.meshgrid(
+        (np.arange(rows * pixels_per_cell) + 0.5) / pixels_per_cell,
+        (np.arange(cols * pixels_per_cell) + 0.5) / pixels_per_cell, indexing="ij"
+    )
+    solid = occlusion.getSolidGrid(walls)[y.astype(np.int64), x.astype(np.int64)]
+    positions = np.stack((x, y, solid.astype(np.float64)), axis=-1)
+    normals = np.zeros_like(positions)
+    normals[:, :, 2] = 1
+    return positions, normals
+
+def shadeDiffuse(solid, lights, positions, normals):
+    """
+        Ambient and diffuse light at points, with shadow rays through the grid.
+        Returns the light and the number of shadow rays cast.
+    """
+
+    light = np.full((len(positions), 3), 0.2)
+    rays = 0
+    for _light, reach in zip(lights, lightgrid.getInfluenceRadii(lights)):
+        directions = _light.center - positions
+        distances = np.linalg.norm(directions, axis=1)
+        directions /= distances[:, None]
+        facing = np.einsum("ij,ij->i", normals, directions)
+        lit = np.flatnonzero((facing > 0) & (distances < reach))
+        rays += len(lit)
+        lit = lit[~occlusion.walkGrid(solid, positions[lit], directions[lit], distances[lit])]
+        light[lit] += _light.color * _light.strength * (facing[lit] / distances[lit] ** 2)[:, None]
+    return light, rays
+
+def benchmarkUpsample(size=24, pixels_per_cell=16, lights=12):
+    """
+        Shade a top-down view of a map at every pixel and at each lighting
+        scale, bring the smaller ones back with upsample.upsampleLighting
+        and with plain bilinear blending, and measure their PSNR against
+        full resolution along with the shadow rays cast.
+    """
+
+    walls = makeWalls(size, density=0.2)
+    solid = occlusion.getSolidGrid(walls)
+    rng = np.random.default_rng(8)
+    open_cells = np.argwhere(walls == 0)
+    cells = open_cells[rng.integers(len(open_cells), size=lights)]
+    _lights = [
+        elements.Light(
+            position=(col + 0.5, row + 0.5, 0.5), color=rng.uniform(0.5, 1, 3), strength=0.3,
+            axis=(0, 0, 0), radius=0, velocity=0
+        )
+        for row, col in cells.tolist()
+    ]
+    positions, normals = makeTopDownBuffer(walls, pixels_per_cell)
+    height, width = positions.shape[:2]
+
+    start = time.perf_counter()
+    reference, full_rays = shadeDiffuse(solid, _lights, positions.reshape(-1, 3), normals.reshape(-1, 3))
+    full_time = time.perf_counter() - start
+    reference = reference.reshape(height, width, 3)
+
+    print(f"{'scale':>6} {'rays':>9} {'shade (s)':>10} {'upsample (s)':>13} {'PSNR':>7} {'bilinear':>9}")
+    print(f"{1:>6} {full_rays:>9} {full_time:10.3f} {0:13.3f} {np.inf:7.2f} {np.inf:9.2f}")
+    for scale in upsample.LIGHTING_SCALES[1:]:
+        columns, rows = upsample.getSamplePixels(width, height, scale)
+        sample_positions = positions[rows[:, None], columns[None, :]]
+        sample_normals = normals[rows[:, None], columns[None, :]]
+
+        start = time.perf_counter()
+        lighting, rays = shadeDiffuse(solid, _lights, sample_positions.reshape(-1, 3), sample_normals.reshape(-1, 3))
+        shade = time.perf_counter() - start
+        lighting = lighting.reshape(len(rows), len(columns), 3)
+
+        start = time.perf_counter()
+        light = upsample.upsampleLighting(lighting, positions, normals, scale)
+        upsampling = time.perf_counter() - start
+
+        #the same blend with every sample's geometry taken to match
+        flat = upsample.upsampleLighting(lighting, np.zeros_like(positions), normals, scale)
+
+        print(
+            f"{scale:>6} {rays:>9} {shade:10.3f} {upsampling:13.3f}"
+            f" {upsample.getPSNR(reference, light):7.2f} {upsample.getPSNR(reference, flat):9.2f}"
+        )
+
+def benchmarkTemporal(counts=(1, 4, 16, 64), size=64, frames=64):
+    """
+        Move growing numbers of lights around a map and follow them with
+        a temporal.TemporalCache, measuring the share of cells it marks
+        dirty each frame and the share of samples that leaves to trace,
+        if every other sample reprojects onto its history.
+    """
+
+    walls = makeWalls(size, density=0.1)
+    open_cells = np.argwhere(walls == 0)
+
+    print(f"{'lights':>8} {'dirty':>7} {'traced':>7} {'fewer':>6} {'update (ms)':>12}")
+    for count in counts:
+        rng = np.random.default_rng(9)
+        cells = open_cells[rng.integers(len(open_cells), size=count)]
+        lights = [
+            elements.Light(
+                position=(col + 0.5, row + 0.5, 0.5), color=tuple(rng.uniform(0.3, 1, 3)),
+                strength=rng.uniform(1, 4), axis=tuple(rng.uniform(-1, 1, 3) * (1, 1, 0)),
+                radius=2, velocity=0.025
+            )
+            for row, col in cells.tolist()
+        ]
+        _scene = makeScene(walls, lights=lights)
+        cache = temporal.TemporalCache()
+        cache.getDirtyCells(_scene)
+        cache.advance(np.identity(4), np.zeros(3))
+
+        dirty, elapsed = 0, 0
+        for _ in range(frames):
+            for _light in lights:
+                _light.update(1.0)
+            start = time.perf_counter()
+            dirty += cache.getDirtyCells(_scene).mean() / frames
+            elapsed += (time.perf_counter() - start) / frames
+
+        traced = dirty + (1 - dirty) / temporal.REFRESH_PERIOD
+        print(f"{count:8d} {dirty:7.2f} {traced:7.2f} {1 / traced:6.1f} {1000 * elapsed:12.3f}")
+
+def benchmarkResolution(loads=(1.0, 1.5, 3.0, 6.0), frames=600, target=60, margin=10):
+    """
+        Drive a resolution.ResolutionController with a simulated GPU whose
+        frame time goes with the number of pixels, for scenes of growing
+        cost (times the target frame time at full size), with noise and a
+        doubling of the cost through the middle third. Counts the frames
+        over target - margin, with and without the controller, and the
+        scale changes.
+    """
+
+    rng = np.random.default_rng(10)
+    print(f"{'load':>6} {'slow fixed':>11} {'slow dynamic':>13} {'mean scale':>11} {'changes':>8}")
+    for load in loads:
+        controller = resolution.ResolutionController(target, margin, min_scale=0.25)
+        scale, changes, slow, slow_fixed, scales = 1.0, 0, 0, 0, 0
+        times = []
+        for frame in range(frames):
+            cost = load * (2 if frames // 3 <= frame < 2 * frames // 3 else 1)
+            noise = rng.normal(1, 0.05)
+            frame_time = cost * noise * scale ** 2 / target
+            slow += frame_time > 1 / (target - margin)
+            slow_fixed += cost * noise / target > 1 / (target - margin)
+            scales += scale / frames
+            #frame times arrive a few frames late, as from resolution.FrameTimer
+            times.append(frame_time)
+            if len(times) > resolution.QUERY_LATENCY:
+                new_scale = controller.update(times.pop(0))
+                changes += new_scale != scale
+                scale = new_scale
+        print(f"{load:6.1f} {slow_fixed:11d} {slow:13d} {scales:11.2f} {changes:8d}")
+
+def benchmarkTiles(workers=None, width=640, frames=4):
+    """
+        Draw frames of the default scene with a tilerender.TileRenderer
+        on growing numbers of worker processes, up to one per core, and
+        report the tiles drawn per second and the speedup over one worker.
+    """
+
+    cores = multiprocessing.cpu_count()
+    counts = workers or [_count for _count in (1, 2, 4, 8, 16, 32, 64) if _count < cores] + [cores]
+    atlas = textures.loadAtlas()
+    #the README's view of the yellow light sweeping across the textures
+    pose = ((14.5, 2.0, 0.6), 125, -8)
+
+    print(f"{'workers':>8} {'tiles/s':>9} {'frame (ms)':>11} {'speedup':>8} {'efficiency':>11}")
+    single = None
+    for count in counts:
+        renderer = tilerender.TileRenderer(
+            HeadlessScene(use_level_cache=False), width, workers=count, atlas=atlas
+        )
+        #the workers attach to the atlas on their first tiles
+        renderer.render_frame(pose, 0.0)
+        start = time.perf_counter()
+        for frame in range(frames):
+            renderer.render_frame(pose, (frame + 1) * scene.SCENE_FRAME_TIME)
+        elapsed = (time.perf_counter() - start) / frames
+        renderer.destroy()
+
+        single = single or elapsed
+        print(f"{count:8d} {len(renderer.tiles) / elapsed:9.1f} {1000 * elapsed:11.1f}"
+            f" {single / elapsed:7.2f}x {single / elapsed / count:11.2f}")
+
+BENCHMARKS = {
+    "lumped": benchmarkLumpedGeometry,
+    "edges": benchmarkEdges,
+    "classify": benchmarkClassifyEdges,
+    "edit": benchmarkEdits,
+    "update": benchmarkUpdate,
+    "objects": benchmarkObjects,
+    "bvh": benchmarkBVH,
+    "occlusion": benchmarkOcclusion,
+    "lights": benchmarkLights,
+    "visibility": benchmarkVisibility,
+    "lightmap": benchmarkLightmap,
+    "upsample": benchmarkUpsample,
+    "temporal": benchmarkTemporal,
+    "resolution": benchmarkResolution,
+    "tiles": benchmarkTiles,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
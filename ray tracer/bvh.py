@@ -0,0 +1,375 @@
+from elements import *
+
+"""
+    Bounding volume hierarchies for the ray tracer.
+
+    Each room keeps a bottom level tree over its planes, built with the
+    surface area heuristic and cached on the room until its planes change.
+    A small top level tree over the active rooms, door planes and spheres
+    is built when the active rooms change and refit every frame as the
+    spheres move.
+
+    Trees are flattened in depth first order. A node's skip is the index
+    of the first node after its subtree, so the shader can walk a tree
+    without a stack: go to the next node when a box is hit, jump to skip
+    when it is missed. The CPU traversal here mirrors the shader's, so
+    trees can be checked without a GPU.
+"""
+
+#one node of a flattened tree, the shader's PackedNode struct
+NODE_LAYOUT = np.dtype([
+    ("lower", np.float32, (3,)), ("upper", np.float32, (3,)),
+    ("kind", np.int32), ("first", np.int32), ("count", np.int32), ("skip", np.int32),
+])
+
+#node kinds: inner nodes, leaves holding planes or spheres [first, first + count),
+#and top level leaves holding a bottom level tree in nodes [first, first + count)
+NODE_INNER = 0
+NODE_PLANES = 1
+NODE_SPHERES = 2
+NODE_TREE = 3
+
+#planes are flat, their boxes are padded so no axis is empty
+BOX_PADDING = 1e-3
+#cost of visiting a node, relative to testing one primitive
+TRAVERSAL_COST = 1.0
+
+def getPlaneBounds(planes):
+    """
+        Boxes around packed planes (elements.packPlanes rows).
+        Returns (lower, upper), each (count, 3).
+    """
+
+    planes = np.asarray(planes, dtype=np.float32).reshape(-1, PLANE_SIZE)
+    center, tangent, bitangent = planes[:, 0:3], planes[:, 3:6], planes[:, 6:9]
+    corners = np.stack([
+        center + u[:, None] * tangent + v[:, None] * bitangent
+        for u in (planes[:, 12], planes[:, 13]) for v in (planes[:, 14], planes[:, 15])
+    ])
+    return corners.min(axis=0) - BOX_PADDING, corners.max(axis=0) + BOX_PADDING
+
+def getSphereBounds(spheres):
+    """
+        Boxes around packed spheres (objectbuffer.packSpheres rows).
+        Returns (lower, upper), each (count, 3).
+    """
+
+    spheres = np.asarray(spheres, dtype=np.float32).reshape(-1, 8)
+    center, radius = spheres[:, 0:3], spheres[:, 3:4]
+    return center - radius, center + radius
+
+def getArea(lower, upper):
+    """
+        Surface area of boxes, stacked along the first axis.
+    """
+
+    size = np.maximum(upper - lower, 0)
+    return 2 * (size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0])
+
+def findSplit(lower, upper, indices):
+    """
+        Sweep the primitives along each axis in centroid order and find
+        the split with the lowest surface area cost.
+
+        Returns (cost, left indices, right indices).
+    """
+
+    centroids = lower[indices] + upper[indices]
+    counts = np.arange(1, len(indices))
+    best = (np.inf, None, None)
+    for axis in range(3):
+        order = indices[np.argsort(centroids[:, axis], kind="stable")]
+        lo, hi = lower[order], upper[order]
+        left = getArea(np.minimum.accumulate(lo), np.maximum.accumulate(hi))[:-1]
+        right = getArea(
+            np.minimum.accumulate(lo[::-1])[::-1], np.maximum.accumulate(hi[::-1])[::-1]
+        )[1:]
+        cost = left * counts + right * counts[::-1]
+        split = int(np.argmin(cost))
+        if cost[split] < best[0]:
+            best = (cost[split], order[:split + 1], order[split + 1:])
+    return best
+
+def buildTree(lower, upper, leaf_size=4, max_leaf_size=16):
+    """
+        Build a tree over boxes with the surface area heuristic.
+        Nodes of up to leaf_size boxes are always leaves, nodes of up to
+        max_leaf_size boxes are leaves when splitting them costs more.
+
+        Leaves are NODE_PLANES nodes whose [first, first + count) range
+        indexes order, the primitives sorted into leaf order.
+
+        Returns (nodes, order), nodes a NODE_LAYOUT array.
+    """
+
+    lower = np.asarray(lower, dtype=np.float32).reshape(-1, 3)
+    upper = np.asarray(upper, dtype=np.float32).reshape(-1, 3)
+    if len(lower) == 0:
+        return np.zeros(0, dtype=NODE_LAYOUT), np.zeros(0, dtype=np.int64)
+
+    nodes = []
+    order = []
+    #depth first, left child straight after its parent
+    stack = [np.arange(len(lower))]
+    while stack:
+        indices = stack.pop()
+        node_lower = lower[indices].min(axis=0)
+        node_upper = upper[indices].max(axis=0)
+        node = [node_lower, node_upper, NODE_INNER, 0, 0, 0]
+        nodes.append(node)
+
+        if len(indices) > leaf_size:
+            cost, left, right = findSplit(lower, upper, indices)
+            area = getArea(node_lower, node_upper)
+            if area == 0 or TRAVERSAL_COST + cost / area < len(indices) or len(indices) > max_leaf_size:
+                stack.append(right)
+                stack.append(left)
+                continue
+
+        node[2:5] = [NODE_PLANES, len(order), len(indices)]
+        order.extend(indices.tolist())
+
+    flat = np.zeros(len(nodes), dtype=NODE_LAYOUT)
+    for i, (node_lower, node_upper, kind, first, count, _) in enumerate(nodes):
+        flat[i] = (node_lower, node_upper, kind, first, count, 0)
+    sizes = getSubtreeSizes(flat)
+    flat["skip"] = np.arange(len(flat)) + sizes
+
+    return flat, np.array(order, dtype=np.int64)
+
+def getSubtreeSizes(nodes):
+    """
+        Number of nodes in each node's subtree, working back from the last node.
+    """
+
+    sizes = np.ones(len(nodes), dtype=np.int32)
+    kinds = nodes["kind"].tolist()
+    for i in range(len(nodes) - 1, -1, -1):
+        if kinds[i] == NODE_INNER:
+            left = i + 1
+            sizes[i] = 1 + sizes[left] + sizes[left + sizes[left]]
+    return sizes
+
+def refitTree(nodes):
+    """
+        Grow each inner node's box to cover its two children again,
+        after leaf boxes have moved. The layout of the tree is kept.
+    """
+
+    lower, upper = nodes["lower"], nodes["upper"]
+    kinds = nodes["kind"].tolist()
+    skips = nodes["skip"].tolist()
+    for i in range(len(nodes) - 1, -1, -1):
+        if kinds[i] == NODE_INNER:
+            left = i + 1
+            right = skips[left]
+            lower[i] = np.minimum(lower[left], lower[right])
+            upper[i] = np.maximum(upper[left], upper[right])
+
+def getRoomTree(_room):
+    """
+        The bottom level tree over a room's planes, built the first time
+        it is needed. Scene drops it whenever the room's planes change.
+
+        Returns (nodes, planes), the packed planes in leaf order.
+    """
+
+    if _room.tree is None:
+        planes = packPlanes(_room.planes)
+        nodes, order = buildTree(*getPlaneBounds(planes))
+        _room.tree = (nodes, planes[order])
+    return _room.tree
+
+def buildTopLevel(scene, spheres):
+    """
+        Lay out the planes of the scene's active rooms and a top level
+        tree over them and the packed spheres.
+
+        Each room's tree becomes a NODE_TREE leaf, each sphere a NODE_SPHERES
+        leaf. Planes of the scene and the doors of the active rooms are
+        grouped into NODE_PLANES leaves. The top level nodes come first,
+        the room trees after them, with their indices moved to match.
+
+        Returns (nodes, planes, top node count).
+    """
+
+    #(kind, first, count, lower, upper) of each top level leaf
+    items = []
+    plane_blocks = []
+    plane_count = 0
+    room_trees = []
+
+    groups = [packPlanes(scene.planes)] + [
+        packPlanes([_plane for _door in _room.doors for _plane in _door.planes])
+        for _room in scene.active_rooms
+    ]
+    for planes in groups:
+        if len(planes) > 0:
+            lower, upper = getPlaneBounds(planes)
+            items.append((NODE_PLANES, plane_count, len(planes), lower.min(axis=0), upper.max(axis=0)))
+            plane_blocks.append(planes)
+            plane_count += len(planes)
+
+    for _room in scene.active_rooms:
+        nodes, planes = getRoomTree(_room)
+        if len(nodes) > 0:
+            items.append((NODE_TREE, len(room_trees), 0, nodes["lower"][0], nodes["upper"][0]))
+            room_trees.append((nodes, plane_count))
+            plane_blocks.append(planes)
+            plane_count += len(planes)
+
+    lower, upper = getSphereBounds(spheres)
+    for i in range(len(spheres)):
+        items.append((NODE_SPHERES, i, 1, lower[i], upper[i]))
+
+    top, order = buildTree([item[3] for item in items], [item[4] for item in items], leaf_size=1, max_leaf_size=1)
+    leaves = np.flatnonzero(top["kind"] != NODE_INNER)
+    node_count = len(top)
+    blocks = [top]
+    for leaf in leaves.tolist():
+        kind, first, count, _, _ = items[order[top["first"][leaf]]]
+        if kind == NODE_TREE:
+            nodes, plane_offset = room_trees[first]
+            nodes = nodes.copy()
+            nodes["skip"] += node_count
+            nodes["first"][nodes["kind"] == NODE_PLANES] += plane_offset
+            first, count = node_count, len(nodes)
+            node_count += len(nodes)
+            blocks.append(nodes)
+        top["kind"][leaf] = kind
+        top["first"][leaf] = first
+        top["count"][leaf] = count
+
+    planes = np.concatenate(plane_blocks) if plane_blocks else np.zeros((0, PLANE_SIZE), dtype=np.float32)
+    return np.concatenate(blocks), planes, len(top)
+
+def refitSpheres(nodes, top_count, spheres):
+    """
+        Move the boxes of the top level sphere leaves to the packed
+        spheres and refit the top level tree.
+    """
+
+    top = nodes[:top_count]
+    leaves = np.flatnonzero(top["kind"] == NODE_SPHERES)
+    if len(leaves) == 0:
+        return
+    lower, upper = getSphereBounds(spheres)
+    index = top["first"][leaves]
+    top["lower"][leaves] = lower[index]
+    top["upper"][leaves] = upper[index]
+    refitTree(top)
+
+def hitBox(node, origin, inverse_direction, t_max):
+    """
+        Whether a ray from origin meets a node's box between 0 and t_max.
+    """
+
+    t0 = (node["lower"] - origin) * inverse_direction
+    t1 = (node["upper"] - origin) * inverse_direction
+    enter = max(np.minimum(t0, t1).max(), 0.0)
+    leave = min(np.maximum(t0, t1).min(), t_max)
+    return enter <= leave
+
+def getInverseDirection(direction):
+    """
+        1 / direction, with zero components nudged away from zero
+        as the shader does.
+    """
+
+    direction = np.where(np.abs(direction) < 1e-8, 1e-8, direction)
+    return 1.0 / direction
+
+def getPlaneDistances(planes, origin, direction):
+    """
+        Distance along a ray to each packed plane it hits from the front,
+        9999 where it misses. Matches distanceTo in the shader.
+    """
+
+    center, tangent, bitangent, normal = planes[:, 0:3], planes[:, 3:6], planes[:, 6:9], planes[:, 9:12]
+    denom = normal @ direction
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.einsum("ij,ij->i", center - origin, normal) / denom
+    point = origin + t[:, None] * direction
+    u = np.einsum("ij,ij->i", point - center, tangent)
+    v = np.einsum("ij,ij->i", point - center, bitangent)
+    hit = (
+        (denom < 0.000001) & (t >= 0.0001)
+        & (u > planes[:, 12]) & (u < planes[:, 13]) & (v > planes[:, 14]) & (v < planes[:, 15])
+    )
+    return np.where(hit, t * np.linalg.norm(direction), 9999)
+
+def getSphereDistances(spheres, origin, direction):
+    """
+        Distance along a ray to each packed sphere, 9999 where it misses.
+        Matches distanceTo in the shader.
+    """
+
+    co = origin - spheres[:, 0:3]
+    a = direction @ direction
+    b = 2 * (co @ direction)
+    c = np.einsum("ij,ij->i", co, co) - spheres[:, 3] ** 2
+    discriminant = b * b - 4 * a * c
+    t = (-b - np.sqrt(np.maximum(discriminant, 0))) / (2 * a)
+    return np.where((discriminant > 0) & (t >= 0.0001), t * np.linalg.norm(direction), 9999)
+
+def getLeafDistance(node, planes, spheres, origin, direction):
+    """
+        Nearest distance to the primitives of a leaf.
+    """
+
+    first, count = int(node["first"]), int(node["count"])
+    if node["kind"] == NODE_PLANES:
+        distances = getPlaneDistances(planes[first:first + count], origin, direction)
+    else:
+        distances = getSphereDistances(spheres[first:first + count], origin, direction)
+    return distances.min() if len(distances) > 0 else 9999
+
+def walkTree(nodes, start, end, origin, direction, t_max, planes, spheres, stop=None, stats=None):
+    """
+        Walk nodes [start, end) without a stack, as the shader does,
+        shrinking t_max to the nearest hit. With stop given the walk ends
+        as soon as something is closer than it. Counts the nodes and
+        primitives visited into stats, if given.
+
+        Returns the new t_max.
+    """
+
+    inverse_direction = getInverseDirection(direction)
+    i = start
+    while i < end:
+        node = nodes[i]
+        if stats is not None:
+            stats["nodes"] += 1
+        if not hitBox(node, origin, inverse_direction, t_max):
+            i = int(node["skip"])
+            continue
+
+        kind = int(node["kind"])
+        if kind == NODE_TREE:
+            t_max = walkTree(
+                nodes, int(node["first"]), int(node["first"]) + int(node["count"]),
+                origin, direction, t_max, planes, spheres, stop, stats
+            )
+        elif kind != NODE_INNER:
+            if stats is not None:
+                stats["primitives"] += int(node["count"])
+            t_max = min(t_max, getLeafDistance(node, planes, spheres, origin, direction))
+        if stop is not None and t_max < stop:
+            return t_max
+        i += 1
+    return t_max
+
+def isOccluded(nodes, top_count, planes, spheres, origin, direction, distance, stats=None):
+    """
+        Whether anything lies on a shadow ray closer than distance,
+        stopping at the first hit. direction should be normalised.
+    """
+
+    return walkTree(nodes, 0, top_count, origin, direction, distance, planes, spheres, distance, stats) < distance
+
+def getClosestDistance(nodes, top_count, planes, spheres, origin, direction, stats=None):
+    """
+        Distance to the nearest primitive along a ray, 9999 for none.
+    """
+
+    return walkTree(nodes, 0, top_count, origin, direction, 9999, planes, spheres, None, stats)
@@ -0,0 +1,517 @@
+from elements import *
+import sys
+import bvh
+import geometry
+import objectbuffer
+import occlusion
+import scene
+import textures
+
+"""
+    The engine's frame drawn on the CPU with NumPy, as a golden image for
+    shader changes and to render previews with no GPU.
+
+    Each stage works on every pixel at once:
+
+        castRays        the g-buffer pass: the first block face, floor or
+                        ceiling each camera ray meets, found by stepping
+                        through the wall grid. The mesh is built from
+                        those faces. The scene's planes can't stand in
+                        for it, they leave out convex edges.
+        sampleMaterial  g_fragment.txt's atlas lookups, nearest texel
+        lightFragment   rayTracer.txt's light_fragment, over the same packed
+                        light, light grid, plane and sphere rows that
+                        Engine.updateScene uploads (objectbuffer.ObjectStore)
+        distanceToPlanes, distanceToSpheres
+                        the shader's distanceTo, for its occluded test.
+                        planesOcclude stands in for the bvh, trying each
+                        block of shadow rays on the planes near it
+
+    With occlusion_mode "grid" shadow rays walk the grid instead, as the
+    shader's gridOccluded (occlusion.walkGrid). The result is the engine's
+    color buffer without FXAA. Doors, lightmaps and baked visibility are
+    not drawn. No OpenGL is needed, build the scene with finalize=False.
+    Run from the repository root to save a frame:
+
+        python "ray tracer/cpurender.py" frame.png
+"""
+
+#as Engine.getCameraTransforms
+FIELD_OF_VIEW = 45
+ASPECT_RATIO = 800 / 600
+#as the ray tracer's ambient light in light_fragment
+AMBIENT = 0.2
+#as the shader's specular exponent
+SPECULAR_POWER = 64
+#shadow rays tested against the planes at once
+RAY_BLOCK = 8192
+#shadow rays are culled against the planes in blocks of this many cells square
+CULL_CELLS = 2
+
+def getFaceFrames():
+    """
+        For each of geometry.FACE_KINDS, from its vertex template: the
+        tangent, bitangent and normal, and the texture coordinates (s, t)
+        as a (2, 4) affine map of (x, y, z, 1). The templates are one cell
+        from the origin, and whole cells along the map change s and t by
+        whole numbers, so it holds for any cell once wrapped.
+    """
+
+    frames = []
+    for face in geometry.FACE_KINDS:
+        template = geometry.FACE_TEMPLATES[face].astype(np.float64)
+        points = np.column_stack((template[:, 0:3], np.ones(len(template))))
+        coordinates = np.linalg.lstsq(points, template[:, 3:5], rcond=None)[0].T
+        frames.append((template[0, 5:8], template[0, 8:11], template[0, 11:14], np.round(coordinates)))
+    return frames
+
+FACE_FRAMES = getFaceFrames()
+#index into FACE_FRAMES of the face with each (x, y, z) normal
+FACE_BY_NORMAL = {tuple(_normal.astype(int)): _i for _i, (_, _, _normal, _) in enumerate(FACE_FRAMES)}
+#index into FACE_FRAMES of the wall met stepping along x or y, backwards or forwards
+WALL_FACES = np.array([
+    [FACE_BY_NORMAL[(1, 0, 0)], FACE_BY_NORMAL[(-1, 0, 0)]],
+    [FACE_BY_NORMAL[(0, 1, 0)], FACE_BY_NORMAL[(0, -1, 0)]],
+])
+
+def getLength(vectors):
+    """
+        Lengths of an (count, 3) array of vectors, quicker than np.linalg.norm.
+    """
+
+    return np.sqrt(np.einsum("ik,ik->i", vectors, vectors))
+
+def getRayDirections(camera, width, height, tile=None):
+    """
+        Directions through the middle of each pixel for the engine's
+        projection, (height, width, 3) with the top row first.
+
+            Parameters:
+                camera (array): position, forwards, right and up rows, as packFrame's
+                width, height (int): size of the image
+                tile (tuple): (x, y, width, height) of the part of the image
+                    to cover, in pixels from the top left, all of it if not given
+    """
+
+    x, y, tile_width, tile_height = (0, 0, width, height) if tile is None else tile
+    extent = np.tan(np.deg2rad(FIELD_OF_VIEW / 2))
+    across = (2 * (x + np.arange(tile_width) + 0.5) / width - 1) * extent * ASPECT_RATIO
+    down = (1 - 2 * (y + np.arange(tile_height) + 0.5) / height) * extent
+    _, forwards, right, up = np.asarray(camera, dtype=np.float64)
+    return forwards + across[None, :, None] * right + down[:, None, None] * up
+
+def castRays(walls, floors, ceilings, origin, directions):
+    """
+        Step rays from one point through the wall grid, all at once, to
+        the first solid block face, floor or ceiling, as the mesh has them.
+
+            Parameters:
+                walls, floors, ceilings (arrays): the scene's rows x cols grids
+                origin (array): (3,) start of every ray, in an empty cell
+                directions (array): (count, 3) ray directions, any length
+
+            Returns:
+                t: (count,) distance along each direction, inf if it left the grid
+                face: (count,) index into FACE_FRAMES
+                material: (count,) material index of the face
+    """
+
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    origin = np.asarray(origin, dtype=np.float64)
+    rows, cols = walls.shape
+    count = len(directions)
+
+    t = np.full(count, np.inf)
+    face = np.zeros(count, dtype=np.int64)
+    material = np.zeros(count, dtype=np.int64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dz = directions[:, 2]
+        t_z = np.where(dz > 0, (1 - origin[2]) / dz, np.where(dz < 0, -origin[2] / dz, np.inf))
+        #x steps columns, y steps rows
+        cell = np.floor(origin[:2])
+        step = np.sign(directions[:, :2]).astype(np.int64)
+        t_delta = np.abs(1 / directions[:, :2])
+        t_next = np.where(
+            step > 0, (cell + 1 - origin[:2]) / directions[:, :2],
+            np.where(step < 0, (cell - origin[:2]) / directions[:, :2], np.inf)
+        )
+    floorFace = FACE_BY_NORMAL[(0, 0, 1)]
+    ceilingFace = FACE_BY_NORMAL[(0, 0, -1)]
+
+    #the rays still going, each array cut down to them as they stop
+    index = np.arange(count)
+    col = np.full(count, int(cell[0]))
+    row = np.full(count, int(cell[1]))
+    step_x, step_y = step[:, 0].copy(), step[:, 1].copy()
+    next_x, next_y = t_next[:, 0].copy(), t_next[:, 1].copy()
+    delta_x, delta_y = t_delta[:, 0].copy(), t_delta[:, 1].copy()
+    up = dz > 0
+    while len(index) > 0:
+        along_y = next_y < next_x
+        t_cell = np.where(along_y, next_y, next_x)
+
+        #the floor or ceiling of this cell comes first, empty cells have them
+        flat = t_z[index] <= t_cell
+        done, flat_row, flat_col, flat_up = index[flat], row[flat], col[flat], up[flat]
+        open_cell = walls[flat_row, flat_col] == 0
+        t[done[open_cell]] = t_z[done[open_cell]]
+        face[done] = np.where(flat_up, ceilingFace, floorFace)
+        material[done] = np.where(flat_up, ceilings[flat_row, flat_col], floors[flat_row, flat_col]) - 1
+
+        #or else the next cell, where the ray hits its face if it is solid
+        col += np.where(along_y, 0, step_x)
+        row += np.where(along_y, step_y, 0)
+        next_x += np.where(along_y, 0, delta_x)
+        next_y += np.where(along_y, delta_y, 0)
+        inside = ~flat & (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+        solid = np.zeros(len(index), dtype=bool)
+        solid[inside] = walls[row[inside], col[inside]] > 0
+
+        hit = index[solid]
+        t[hit] = t_cell[solid]
+        forwards = np.where(along_y, step_y, step_x)[solid] > 0
+        face[hit] = WALL_FACES[along_y[solid].astype(np.int64), forwards.astype(np.int64)]
+        material[hit] = walls[row[solid], col[solid]] - 1
+
+        going = inside & ~solid
+        index, row, col, up = index[going], row[going], col[going], up[going]
+        step_x, step_y, next_x, next_y = step_x[going], step_y[going], next_x[going], next_y[going]
+        delta_x, delta_y = delta_x[going], delta_y[going]
+
+    return t, face, material
+
+def sampleMaterial(atlas, material, s, t):
+    """
+        Look up a material's maps where g_fragment.txt does, at the nearest
+        texel of the atlas (textures.loadAtlas) for texture coordinates in
+        cells.
+
+            Returns:
+                albedo (count, 3), emissive (count, 3), gloss (count,),
+                normal (count, 3) in tangent space, -1 to 1, specular (count, 3)
+    """
+
+    height, width = atlas.shape[:2]
+    s = np.asarray(s, dtype=np.float32)
+    t = np.asarray(t, dtype=np.float32)
+    u = (s - np.floor(s)) / np.float32(5.0)
+    v = (np.float32(8.0) - np.asarray(material, dtype=np.float32) + (t - np.floor(t))) / np.float32(9.0)
+    rows = np.floor(v * height).astype(np.int64) % height
+    #a texel's four bytes are read as one word
+    texels = np.ascontiguousarray(atlas).view(np.uint32).reshape(height, width)
+
+    maps = []
+    for _ in range(5):
+        columns = np.floor(u * width).astype(np.int64) % width
+        texel = texels[rows, columns].view(np.uint8).reshape(-1, 4)
+        maps.append(texel[:, :3].astype(np.float32) / 255)
+        u = u + np.float32(0.2)
+    albedo, emissive, gloss, normal, specular = maps
+
+    return albedo, emissive, gloss[:, 0], 2 * normal - 1, specular
+
+def planesOcclude(planes, position, origins, directions, distances):
+    """
+        Whether shadow rays are blocked by a plane before they reach a
+        light, as distanceToPlanes(...) < distances.
+
+        Rays are taken a run from the same block of CULL_CELLS x CULL_CELLS
+        cells at a time, so they are best sorted by block, against the
+        planes which could be between their origins and the light: the ones
+        crossing the box round both with the light behind them, as the
+        shader only counts planes facing the ray.
+    """
+
+    blocked = np.zeros(len(origins), dtype=bool)
+    #the records are elements.packPlanes rows
+    low, high = bvh.getPlaneBounds(planes.view(np.float32))
+    behind = np.einsum("pk,pk->p", position - planes["center"], planes["normal"]) < 0
+    low, high, planes = low[behind], high[behind], planes[behind]
+
+    blocks = np.floor(origins[:, :2] / CULL_CELLS).astype(np.int64)
+    changes = np.flatnonzero(np.any(blocks[1:] != blocks[:-1], axis=1)) + 1
+    bounds = np.concatenate(([0], changes, [len(origins)]))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        #the block's cells, floor to ceiling
+        blockLow = np.append(CULL_CELLS * blocks[first], 0)
+        boxLow = np.minimum(blockLow, position)
+        boxHigh = np.maximum(blockLow + (CULL_CELLS, CULL_CELLS, 1), position)
+        near = np.all((low <= boxHigh) & (high >= boxLow), axis=1)
+        blocked[first:last] = distanceToPlanes(
+            planes[near], origins[first:last], directions[first:last]
+        ) < distances[first:last]
+
+    return blocked
+
+def distanceToPlanes(planes, origins, directions):
+    """
+        The nearest of the shader's distanceTo(ray, plane) over all planes,
+        for each ray. 9999 where no plane is hit.
+    """
+
+    distances = np.full(len(origins), 9999, dtype=np.float32)
+    if len(planes) == 0:
+        return distances
+
+    #each ray's dot products with every plane's normal, tangent and bitangent in one go
+    axes = np.concatenate((planes["normal"], planes["tangent"], planes["bitangent"])).T
+    centers = np.einsum("pk,jpk->jp", planes["center"], axes.T.reshape(3, len(planes), 3)).reshape(-1)
+    count = len(planes)
+
+    for first in range(0, len(origins), RAY_BLOCK):
+        o = np.asarray(origins[first:first + RAY_BLOCK], dtype=np.float32) @ axes - centers
+        d = np.asarray(directions[first:first + RAY_BLOCK], dtype=np.float32) @ axes
+        denom = d[:, :count]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = -o[:, :count] / denom
+        hit = (denom < 1e-6) & (t >= 0.0001)
+        #as testPoint - center projected on the tangent and bitangent
+        u = o[:, count:2 * count] + t * d[:, count:2 * count]
+        hit &= (u > planes["uMin"]) & (u < planes["uMax"])
+        v = o[:, 2 * count:] + t * d[:, 2 * count:]
+        hit &= (v > planes["vMin"]) & (v < planes["vMax"])
+        #the nearest t is the nearest hit, the lengths only scale it
+        t[~hit] = np.inf
+        nearest = t.min(axis=1) * getLength(directions[first:first + RAY_BLOCK])
+        distances[first:first + RAY_BLOCK] = np.where(np.isfinite(nearest), nearest, 9999)
+
+    return distances
+
+def distanceToSpheres(spheres, origins, directions):
+    """
+        The nearest of the shader's distanceTo(ray, sphere) over all spheres,
+        for each ray. 9999 where none is hit in front of the ray.
+    """
+
+    distances = np.full(len(origins), 9999, dtype=np.float32)
+    for sphere in spheres:
+        co = origins - sphere["center"]
+        a = np.einsum("ik,ik->i", directions, directions)
+        b = 2 * np.einsum("ik,ik->i", directions, co)
+        c = np.einsum("ik,ik->i", co, co) - sphere["radius"] ** 2
+        discriminant = b * b - 4 * a * c
+        with np.errstate(invalid="ignore"):
+            t = (-b - np.sqrt(discriminant)) / (2 * a)
+        hit = (discriminant > 0) & (t >= 0.0001)
+        length = np.abs(t) * np.sqrt(a)
+        distances = np.minimum(distances, np.where(hit, length, 9999))
+
+    return distances
+
+def lightFragment(positions, normals, viewer, lights, cells, indices, grid_shape, occluded):
+    """
+        Light reaching surface points, as the shader's light_fragment.
+
+            Parameters:
+                positions, normals (arrays): (count, 3) surface points and normals
+                viewer (array): (3,) camera position
+                lights (array): LIGHT_LAYOUT rows
+                cells, indices (arrays): the light grid's CELL_LAYOUT and
+                    INDEX_LAYOUT rows, see lightgrid.binLights
+                grid_shape (tuple): (rows, cols) of the light grid
+                occluded (function): (light, origins, directions, distances)
+                    -> bool array, whether each shadow ray is blocked
+
+            Returns:
+                a (count, 3) array of light
+    """
+
+    rows, cols = grid_shape
+    color = np.full((len(positions), 3), AMBIENT, dtype=np.float32)
+
+    #which lights each cell lists
+    counts = cells["count"].astype(np.int64)
+    entries = np.repeat(cells["first"].astype(np.int64), counts) \
+        + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    listed = np.zeros((rows * cols, len(lights)), dtype=bool)
+    listed[np.repeat(np.arange(rows * cols), counts), indices["light"][entries]] = True
+    cell = np.clip(np.floor(positions[:, :2]).astype(np.int64), 0, (cols - 1, rows - 1))
+    cell = cell[:, 1] * cols + cell[:, 0]
+
+    fragViewer = viewer - positions
+    fragViewer /= getLength(fragViewer)[:, None]
+
+    #np.take and np.compress gather rows several times quicker than indexing
+    for index, light in enumerate(lights):
+        lit = np.flatnonzero(listed[:, index][cell])
+        fragLight = light["position"] - np.take(positions, lit, axis=0)
+        distance = getLength(fragLight)
+        near = distance <= light["influence"]
+        lit, distance = lit[near], distance[near]
+        fragLight = np.compress(near, fragLight, axis=0) / distance[:, None]
+
+        halfway = np.take(fragViewer, lit, axis=0) + fragLight
+        halfway /= getLength(halfway)[:, None]
+        normal = np.take(normals, lit, axis=0)
+        diffuse = np.maximum(0, np.einsum("ik,ik->i", normal, fragLight))
+        specular = np.maximum(0, np.einsum("ik,ik->i", normal, halfway))
+        #SPECULAR_POWER is a power of two, squaring is much quicker than **
+        for _ in range(int(np.log2(SPECULAR_POWER))):
+            specular *= specular
+        contribution = (diffuse + specular) * light["strength"] / (distance * distance)
+
+        #only points the light adds to need a shadow ray
+        shaded = np.flatnonzero(contribution > 0)
+        shaded = shaded[~occluded(
+            light, np.take(positions, lit[shaded], axis=0), np.take(fragLight, shaded, axis=0), distance[shaded]
+        )]
+        lit = lit[shaded]
+        color[lit] = np.take(color, lit, axis=0) + light["color"] * contribution[shaded, None]
+
+    return color
+
+def packFrame(scene, store):
+    """
+        Everything a frame is drawn from, as plain arrays: the rows
+        store (an objectbuffer.ObjectStore) packs for the GPU, the map and
+        the camera.
+
+            Returns:
+                a dict of spheres, planes, lights, cells and indices (the
+                rows as records of their layouts), walls, floors and
+                ceilings (the grids) and camera (position, forwards, right
+                and up rows)
+    """
+
+    sphereCount, planeCount, lightCount, _ = store.pack(scene)
+    rows, cols = scene.wall_array.shape
+    cells = store.lightCells.getRows(rows * cols)
+    camera = scene.camera
+
+    return {
+        "spheres": store.spheres.getRows(sphereCount),
+        "planes": store.planes.getRows(planeCount),
+        "lights": store.lights.getRows(lightCount),
+        "cells": cells,
+        "indices": store.lightIndices.getRows(int(cells["count"].sum())),
+        "walls": scene.wall_array, "floors": scene.floor_array, "ceilings": scene.ceiling_array,
+        "camera": np.array((camera.posArray, camera.forwards, camera.right, camera.up), dtype=np.float32),
+    }
+
+def renderPixels(frame, atlas, occlusion_mode, directions):
+    """
+        Draw the pixels of a frame from packFrame along some camera rays.
+
+            Parameters:
+                frame (dict): from packFrame
+                atlas (array): textures.loadAtlas()
+                occlusion_mode (str): one of occlusion.OCCLUSION_MODES
+                directions (array): (count, 3) ray directions, see getRayDirections
+
+            Returns:
+                a (count, 3) float32 array of colors
+    """
+
+    spheres, planes, walls = frame["spheres"], frame["planes"], frame["walls"]
+    rows, cols = walls.shape
+
+    #the g-buffer
+    viewer = frame["camera"][0].astype(np.float64)
+    t, face, material = castRays(walls, frame["floors"], frame["ceilings"], viewer, directions)
+    hit = np.flatnonzero(np.isfinite(t))
+    positions = (viewer + t[hit, None] * directions[hit]).astype(np.float32)
+    #in order of the blocks planesOcclude culls by
+    blocks = np.floor(positions[:, :2] / CULL_CELLS).astype(np.int64)
+    order = np.argsort(blocks[:, 1] * cols + blocks[:, 0], kind="stable")
+    hit, positions, face, material = hit[order], positions[order], face[hit[order]], material[hit[order]]
+
+    tangent, bitangent, normal, coordinates = (np.array(_f, dtype=np.float32) for _f in zip(*FACE_FRAMES))
+    st = np.einsum("ijk,ik->ij", coordinates[face][:, :, :3], positions) + coordinates[face][:, :, 3]
+    albedo, emissive, _, mapNormal, _ = sampleMaterial(atlas, material, st[:, 0], st[:, 1])
+    normals = tangent[face] * mapNormal[:, 0:1] + bitangent[face] * mapNormal[:, 1:2] \
+        + normal[face] * mapNormal[:, 2:3]
+    normals /= getLength(normals)[:, None]
+
+    #shadow rays
+    if occlusion_mode == "grid":
+        solid = occlusion.getSolidGrid(walls)
+        occluded = lambda light, origins, directions, distances: (
+            occlusion.walkGrid(solid, origins, directions, distances)
+            | (distanceToSpheres(spheres, origins, directions) < distances)
+        )
+    else:
+        occluded = lambda light, origins, directions, distances: (
+            planesOcclude(planes, light["position"], origins, directions, distances)
+            | (distanceToSpheres(spheres, origins, directions) < distances)
+        )
+
+    light = lightFragment(
+        positions, normals, viewer.astype(np.float32), frame["lights"], frame["cells"], frame["indices"],
+        (rows, cols), occluded
+    )
+    color = np.zeros((len(directions), 3), dtype=np.float32)
+    color[hit] = albedo * light + emissive
+
+    return color
+
+class CPURenderer:
+    """
+        Draws a scene's frames on the CPU, see the module's notes.
+    """
+
+    def __init__(self, scene, width=640, height=None, occlusion_mode="bvh", atlas=None):
+        """
+            Set up the packed objects and load the atlas.
+
+                Parameters:
+                    scene (scene.Scene): the scene to draw, it needs no OpenGL
+                        objects of its own
+                    width (int): width of the image
+                    height (int): height of the image, 3/4 of the width if not given
+                    occlusion_mode (str): one of occlusion.OCCLUSION_MODES
+                    atlas (array): textures.loadAtlas(), loaded if not given
+        """
+
+        if occlusion_mode not in occlusion.OCCLUSION_MODES:
+            raise ValueError(f"occlusion_mode must be one of {occlusion.OCCLUSION_MODES}, not {occlusion_mode!r}")
+        self.scene = scene
+        self.width = width
+        self.height = height if (height is not None and height > 0) else 3 * width // 4
+        self.occlusionMode = occlusion_mode
+        self.atlas = textures.loadAtlas() if atlas is None else atlas
+        self.objectStore = objectbuffer.ObjectStore()
+        self.time = 0.0
+
+    def render(self):
+        """
+            Draw the scene as it is now from its camera.
+
+                Returns:
+                    a (height, width, 3) float32 array, the engine's color
+                    buffer, top row first
+        """
+
+        frame = packFrame(self.scene, self.objectStore)
+        directions = getRayDirections(frame["camera"], self.width, self.height)
+        color = renderPixels(frame, self.atlas, self.occlusionMode, directions.reshape(-1, 3))
+        return color.reshape(self.height, self.width, 3)
+
+    def render_frame(self, camera_pose, t):
+        """
+            Draw the scene at a time from a camera pose, as
+            headless.HeadlessRenderer.render_frame with FXAA off.
+
+                Returns:
+                    a (height, width, 3) uint8 array, top row first
+        """
+
+        position, theta, phi = camera_pose
+        self.scene.camera.posArray = np.array(position, dtype=np.float32)
+        self.scene.camera.theta = theta
+        self.scene.camera.phi = phi
+        self.scene.camera.recalculateCameraVectors()
+
+        self.scene.update(rate = (t - self.time) / scene.SCENE_FRAME_TIME)
+        self.time = t
+
+        return np.round(np.clip(self.render(), 0, 1) * 255).astype(np.uint8)
+
+if __name__ == "__main__":
+    renderer = CPURenderer(scene.Scene(finalize=False))
+    camera = renderer.scene.camera
+    image = renderer.render_frame((camera.posArray, camera.theta, camera.phi), 0.0)
+    pg.image.save(
+        pg.surfarray.make_surface(np.ascontiguousarray(image.swapaxes(0, 1))),
+        sys.argv[1] if len(sys.argv) > 1 else "frame.png"
+    )
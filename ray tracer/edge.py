@@ -1,8 +1,17 @@
+import numpy as np
+
 NORTH = 1
 EAST = 2
 SOUTH = 4
 WEST = 8
 
+#compact edge storage: direction bit, start cell, end cell
+EDGE_DTYPE = np.dtype([
+    ("type", np.uint8),
+    ("point_a", np.int32, (2,)),
+    ("point_b", np.int32, (2,))
+])
+
 class Edge:
 
     def __init__(self, id):
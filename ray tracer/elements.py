@@ -4,6 +4,72 @@ from common import *
     Classes for common scene elements. Camera and edges stored separately for easier management.
 """
 
+#floats per vertex: x,y,z,s,t,tx,ty,tz,bx,by,bz,nx,ny,nz,material
+#s,t are in cell units, the g-buffer shader wraps them into the material's atlas tile
+VERTEX_SIZE = 15
+
+def makeVertexBuffer(vertices):
+    """
+        Upload a float32 vertex array and describe its attributes.
+        Returns the (vao, vbo) pair.
+    """
+
+    stride = 4 * VERTEX_SIZE
+    vao = glGenVertexArrays(1)
+    glBindVertexArray(vao)
+    vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+    offset = 0
+    #position
+    glEnableVertexAttribArray(0)
+    glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+    offset += 12
+    #texture
+    glEnableVertexAttribArray(1)
+    glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+    offset += 8
+    #tangent
+    glEnableVertexAttribArray(2)
+    glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+    offset += 12
+    #bitangent
+    glEnableVertexAttribArray(3)
+    glVertexAttribPointer(3, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+    offset += 12
+    #normal
+    glEnableVertexAttribArray(4)
+    glVertexAttribPointer(4, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+    offset += 12
+    #material
+    glEnableVertexAttribArray(5)
+    glVertexAttribPointer(5, 1, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+    offset += 4
+
+    return vao, vbo
+
+def updateVertexBuffer(vbo, vertices, first=None, last=None):
+    """
+        Upload vertices[first:last] into an existing vertex buffer.
+        With no range given the buffer is reallocated to hold the whole array.
+    """
+
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    if first is None:
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+        return
+
+    data = np.ascontiguousarray(vertices[first:last])
+    glBufferSubData(GL_ARRAY_BUFFER, 4 * VERTEX_SIZE * first, data.nbytes, data)
+
+def destroyVertexBuffer(vao, vbo):
+    """
+        Free a (vao, vbo) pair made by makeVertexBuffer.
+    """
+
+    glDeleteVertexArrays(1, (vao,))
+    glDeleteBuffers(1, (vbo,))
+
 class Sphere:
     """
         Represents a sphere in the scene
@@ -63,6 +129,38 @@ class Plane:
         self.center = np.array(center, dtype=np.float32)
         self.material_index = material_index
 
+#a plane as one row of floats:
+#center(3) tangent(3) bitangent(3) normal(3) uMin uMax vMin vMax material_index
+PLANE_SIZE = 17
+
+def packPlanes(planes):
+    """
+        Pack a list of planes into a (count, PLANE_SIZE) float32 array.
+    """
+
+    data = np.zeros((len(planes), PLANE_SIZE), dtype=np.float32)
+    for i, _plane in enumerate(planes):
+        data[i, 0:3] = _plane.center
+        data[i, 3:6] = _plane.tangent
+        data[i, 6:9] = _plane.bitangent
+        data[i, 9:12] = _plane.normal
+        data[i, 12:17] = (_plane.uMin, _plane.uMax, _plane.vMin, _plane.vMax, _plane.material_index)
+    return data
+
+def unpackPlanes(data):
+    """
+        Rebuild the list of planes stored by packPlanes.
+    """
+
+    return [
+        Plane(
+            normal = row[9:12], tangent = row[3:6], bitangent = row[6:9],
+            uMin = row[12], uMax = row[13], vMin = row[14], vMax = row[15],
+            center = row[0:3], material_index = int(row[16])
+        )
+        for row in np.asarray(data, dtype=np.float32)
+    ]
+
 class Light:
     """
         Represents a light in the scene
@@ -87,6 +185,8 @@ class Light:
         self.axis = np.array(axis, dtype=np.float32)
         self.radius = radius
         self.velocity = velocity
+        #(block version, header, data) baked along its path, see visibility.getVolume
+        self.volume = None
     
     def update(self, rate):
 
@@ -110,7 +210,7 @@ class Door:
 
         self.coordinate = coordinate
         self.planes = []
-        self.vertices = []
+        self.vertices = np.zeros((0, VERTEX_SIZE), dtype=np.float32)
         self.vertexCount = 0
 
         self.finalized = False
@@ -121,33 +221,13 @@ class Door:
             return
         self.finalized = True
 
-        self.vertices = np.array(self.vertices, dtype=np.float32)
-        self.vao = glGenVertexArrays(1)
-        glBindVertexArray(self.vao)
-        self.vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices, GL_STATIC_DRAW)
-        offset = 0
-        #position
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        #texture
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 8
-        #tangent
-        glEnableVertexAttribArray(2)
-        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        #bitangent
-        glEnableVertexAttribArray(3)
-        glVertexAttribPointer(3, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        #normal
-        glEnableVertexAttribArray(4)
-        glVertexAttribPointer(4, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
+        self.vao, self.vbo = makeVertexBuffer(self.vertices)
+
+    def destroy(self):
+
+        if self.finalized:
+            destroyVertexBuffer(self.vao, self.vbo)
+            self.finalized = False
 
 class Room:
     """
@@ -164,8 +244,15 @@ class Room:
         self.internalCoordinates = []
         self.doors = []
 
-        self.vertices = []
+        self.vertices = np.zeros((0, VERTEX_SIZE), dtype=np.float32)
         self.vertexCount = 0
+        #(face, row, col) -> slot of its vertices, and unused slots, see geometry.patchFaces
+        self.faceSlots = None
+        self.freeSlots = []
+        #bottom level bvh over its planes, see bvh.getRoomTree
+        self.tree = None
+
+        self.finalized = False
     
     def add_light(self, light):
 
@@ -179,30 +266,14 @@ class Room:
     
     def finalize(self):
 
-        self.vertices = np.array(self.vertices, dtype=np.float32)
-        self.vao = glGenVertexArrays(1)
-        glBindVertexArray(self.vao)
-        self.vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices, GL_STATIC_DRAW)
-        offset = 0
-        #position
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        #texture
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 8
-        #tangent
-        glEnableVertexAttribArray(2)
-        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        #bitangent
-        glEnableVertexAttribArray(3)
-        glVertexAttribPointer(3, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        #normal
-        glEnableVertexAttribArray(4)
-        glVertexAttribPointer(4, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
\ No newline at end of file
+        if self.finalized:
+            return
+        self.finalized = True
+
+        self.vao, self.vbo = makeVertexBuffer(self.vertices)
+
+    def destroy(self):
+
+        if self.finalized:
+            destroyVertexBuffer(self.vao, self.vbo)
+            self.finalized = False
\ No newline at end of file
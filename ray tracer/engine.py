@@ -1,21 +1,68 @@
 from common import *
 import textures as textures
+import objectbuffer
+import occlusion
+import lightmap
+import upsample
+import temporal
+import resolution
+import profiler
 
 class Engine:
     """
         Responsible for drawing scenes
     """
 
-    def __init__(self, width, height, use_fxaa=True):
+    def __init__(self, width, height, use_fxaa=True, occlusion_mode="bvh", bake_visibility=False,
+        use_lightmap=False, lighting_scale=1, temporal_cache=False, dynamic_resolution=False,
+        min_render_scale=resolution.MIN_RENDER_SCALE, profile=False, output_framebuffer=0):
         """
             Initialize a flat raytracing context
             
                 Parameters:
                     width (int): width of screen
                     height (int): height of screen
+                    occlusion_mode (str): how shadow rays are answered, one of
+                        occlusion.OCCLUSION_MODES: "bvh" tests the scene's planes,
+                        "grid" steps through the wall grid
+                    bake_visibility (bool): bake each light's wall visibility
+                        along its path and read it instead of casting shadow
+                        rays against the walls, see visibility.py
+                    use_lightmap (bool): bake the light of the lights which
+                        never move onto the walls, see lightmap.py
+                    lighting_scale (int): shade one pixel in every lighting_scale
+                        x lighting_scale block and upsample the rest, one of
+                        upsample.LIGHTING_SCALES
+                    temporal_cache (bool): keep lighting from frame to frame and
+                        only trace part of it again, see temporal.py
+                    dynamic_resolution (bool): render at a smaller size when
+                        frames take too long, to hold targetFrameRate, see resolution.py
+                    min_render_scale (float): smallest fraction of the screen's
+                        size rendered with dynamic resolution
+                    profile (bool): time each pass on the GPU and the CPU,
+                        see profiler.py
+                    output_framebuffer (int): framebuffer the final image is
+                        drawn to, 0 draws to the window and flips it, see headless.py
         """
+        if occlusion_mode not in occlusion.OCCLUSION_MODES:
+            raise ValueError(f"occlusion_mode must be one of {occlusion.OCCLUSION_MODES}, not {occlusion_mode!r}")
+        if lighting_scale not in upsample.LIGHTING_SCALES:
+            raise ValueError(f"lighting_scale must be one of {upsample.LIGHTING_SCALES}, not {lighting_scale!r}")
+        self.lightingScale = lighting_scale
+        self.useTemporalCache = temporal_cache
+        #the lighting image is separate from the color buffer when scaled or kept
+        self.separateLighting = lighting_scale > 1 or temporal_cache
+        self.occlusionMode = occlusion_mode
+        self.bakeVisibility = bake_visibility
+        self.useLightmap = use_lightmap
+
+        self.outputFramebuffer = output_framebuffer
         self.screenWidth = width
         self.screenHeight = height
+        #size of the g-buffer and ray tracing passes, stretched over the screen
+        self.renderScale = 1.0
+        self.renderWidth = width
+        self.renderHeight = height
 
         self.targetFrameRate = 60
         self.frameRateMargin = 10
@@ -25,7 +72,17 @@ class Engine:
         # General OpenGL configuration
         self.shader = self.makeShader("ray tracer/shaders/frameBufferVertex.txt",
                                       "ray tracer/shaders/frameBufferFragment.txt")
-        self.rayTracerShader = self.makeComputeShader("ray tracer/shaders/rayTracer.txt")
+        scaleDefines = (f"LIGHTING_SCALE {lighting_scale}",) if self.separateLighting else ()
+        self.rayTracerShader = self.makeComputeShader(
+            "ray tracer/shaders/rayTracer.txt",
+            defines=(("GRID_OCCLUSION",) if occlusion_mode == "grid" else ()) + scaleDefines
+                + (("TEMPORAL_CACHE",) if temporal_cache else ())
+        )
+        self.upsampleShader = None
+        if self.separateLighting:
+            self.upsampleShader = self.makeComputeShader(
+                "ray tracer/shaders/upsample.txt", defines=scaleDefines
+            )
         self.shaderGPass = self.makeShader("ray tracer/shaders/g_vertex.txt",
                                            "ray tracer/shaders/g_fragment.txt")
         self.fxaaShader = self.makeShader("ray tracer/shaders/frameBufferVertex.txt",
@@ -45,6 +102,15 @@ class Engine:
         self.makeColorBuffers()
         self.makeResourceMemory()
         self.makeSuperTexture()
+
+        self.resolutionController = None
+        self.frameTimer = None
+        if dynamic_resolution:
+            self.resolutionController = resolution.ResolutionController(
+                self.targetFrameRate, self.frameRateMargin, min_scale=min_render_scale
+            )
+            self.frameTimer = resolution.FrameTimer()
+        self.profiler = profiler.Profiler() if profile else None
     
     def set_onetime_shader_data(self):
 
@@ -55,6 +121,12 @@ class Engine:
                 self.shaderGPass, "SuperTexture"
             ), 0
         )
+        glUniform1i(glGetUniformLocation(self.shaderGPass, "lightmap"), lightmap.LIGHTMAP_UNIT)
+        glUniform1i(glGetUniformLocation(self.shaderGPass, "lightmapTiles"), lightmap.TILE_TABLE_UNIT)
+
+        glUseProgram(self.rayTracerShader)
+        glUniform1i(glGetUniformLocation(self.rayTracerShader, "historyLighting"), temporal.HISTORY_UNIT)
+        glUniform1i(glGetUniformLocation(self.rayTracerShader, "dirtyCells"), temporal.DIRTY_UNIT)
     
     def get_shader_locations(self):
 
@@ -66,6 +138,8 @@ class Engine:
         self.projectionMatrixLocation = glGetUniformLocation(
             self.shaderGPass, "projection"
         )
+        self.lightmapTileSizeLocation = glGetUniformLocation(self.shaderGPass, "lightmapTileSize")
+        self.lightmapColumnsLocation = glGetUniformLocation(self.shaderGPass, "lightmapColumns")
 
         glUseProgram(self.rayTracerShader)
 
@@ -81,9 +155,12 @@ class Engine:
         self.viewerUpLocation = glGetUniformLocation(
             self.rayTracerShader, "viewer.up"
         )
+        self.lightGridSizeLocation = glGetUniformLocation(self.rayTracerShader, "lightGridSize")
         self.sphereCountLocation = glGetUniformLocation(self.rayTracerShader, "sphereCount")
-        self.planeCountLocation = glGetUniformLocation(self.rayTracerShader, "planeCount")
-        self.lightCountLocation = glGetUniformLocation(self.rayTracerShader, "lightCount")
+        self.topNodeCountLocation = glGetUniformLocation(self.rayTracerShader, "topNodeCount")
+        self.previousViewProjectionLocation = glGetUniformLocation(self.rayTracerShader, "previousViewProjection")
+        self.previousViewerPositionLocation = glGetUniformLocation(self.rayTracerShader, "previousViewerPosition")
+        self.frameIndexLocation = glGetUniformLocation(self.rayTracerShader, "frameIndex")
      
     def makeQuad(self):
         # x, y, z, s, t
@@ -120,7 +197,7 @@ class Engine:
 
         self.g0Texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.g0Texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.screenWidth, self.screenHeight, 0, GL_RGBA, GL_FLOAT, None)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.renderWidth, self.renderHeight, 0, GL_RGBA, GL_FLOAT, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
@@ -130,7 +207,7 @@ class Engine:
 
         self.g1Texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.g1Texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.screenWidth, self.screenHeight, 0, GL_RGBA, GL_FLOAT, None)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.renderWidth, self.renderHeight, 0, GL_RGBA, GL_FLOAT, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
@@ -140,7 +217,7 @@ class Engine:
 
         self.g2Texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.g2Texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.screenWidth, self.screenHeight, 0, GL_RGBA, GL_FLOAT, None)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.renderWidth, self.renderHeight, 0, GL_RGBA, GL_FLOAT, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
@@ -150,7 +227,7 @@ class Engine:
 
         self.g3Texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.g3Texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.screenWidth, self.screenHeight, 0, GL_RGBA, GL_FLOAT, None)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.renderWidth, self.renderHeight, 0, GL_RGBA, GL_FLOAT, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
@@ -167,7 +244,7 @@ class Engine:
 
         self.depthStencilBuffer = glGenRenderbuffers(1)
         glBindRenderbuffer(GL_RENDERBUFFER, self.depthStencilBuffer)
-        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH24_STENCIL8, self.screenWidth, self.screenHeight)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH24_STENCIL8, self.renderWidth, self.renderHeight)
         glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_STENCIL_ATTACHMENT, 
                                 GL_RENDERBUFFER, self.depthStencilBuffer)
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
@@ -179,48 +256,79 @@ class Engine:
 
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        #blend texels when the picture is stretched over a larger screen
+        scaled = (self.renderWidth, self.renderHeight) != (self.screenWidth, self.screenHeight)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR if scaled else GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR if scaled else GL_NEAREST)
 
     
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.screenWidth, self.screenHeight, 0, GL_RGBA, GL_FLOAT, None)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.renderWidth, self.renderHeight, 0, GL_RGBA, GL_FLOAT, None)
+
+        #lighting samples, if they are taken at a lower resolution or kept,
+        #and last frame's to go with them
+        self.lightingBuffer = None
+        self.historyBuffer = None
+        if self.separateLighting:
+            self.lightingWidth, self.lightingHeight = upsample.getLightingSize(
+                self.renderWidth, self.renderHeight, self.lightingScale
+            )
+            textures = glGenTextures(2 if self.useTemporalCache else 1)
+            textures = np.atleast_1d(textures).tolist()
+            for texture in textures:
+                glBindTexture(GL_TEXTURE_2D, texture)
+                glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.lightingWidth, self.lightingHeight, 0, GL_RGBA, GL_FLOAT, None)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            self.lightingBuffer = textures[0]
+            if self.useTemporalCache:
+                self.historyBuffer = textures[1]
     
-    def makeResourceMemory(self):
+    def destroyColorBuffers(self):
 
+        glDeleteFramebuffers(1, (self.gBuffer,))
+        glDeleteRenderbuffers(1, (self.depthStencilBuffer,))
+        glDeleteTextures(5, (self.g0Texture, self.g1Texture, self.g2Texture, self.g3Texture, self.colorBuffer))
+        if self.lightingBuffer is not None:
+            glDeleteTextures(1, (self.lightingBuffer,))
+        if self.historyBuffer is not None:
+            glDeleteTextures(1, (self.historyBuffer,))
+
+    def resize(self, scale):
         """
-            allocate memory for 1024 objects (YOLO)
+            Render at a new fraction of the screen's size, making the
+            g-buffer and the ray tracer's images again at that size.
         """
 
-        objectData = []
+        self.destroyColorBuffers()
+        self.renderScale = scale
+        self.renderWidth, self.renderHeight = resolution.getRenderSize(
+            self.screenWidth, self.screenHeight, scale
+        )
+        self.makeColorBuffers()
+        #last frame's lighting was for the old size
+        if self.temporalCache is not None:
+            self.temporalCache.reset()
 
-        # sphere: (cx cy cz r)  (r g b roughness) (- - - -)     (- - - -)             (- - - -)
-        # plane:  (cx cy cz tx) (ty tz bx by)     (bz nx ny nz) (umin umax vmin vmax) (material_index - - -)
-        # light:  (x y z s)     (r g b -)         (bz nx ny nz) (umin umax vmin vmax) (material_index - - -)
-        for object in range(1024):
-            for attribute in range(20):
-                objectData.append(0.0)
-        self.objectData = np.array(objectData, dtype=np.float32)
+    def makeResourceMemory(self):
 
-        self.objectDataTexture = glGenTextures(1)
-        glActiveTexture(GL_TEXTURE1)
-        glBindTexture(GL_TEXTURE_2D, self.objectDataTexture)
+        """
+            Set up the sphere, plane and light storage buffers, they grow as the scene needs.
+            The CPU side packing is checked against the shader's structs first.
+        """
 
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-    
-        glTexImage2D(GL_TEXTURE_2D,0,GL_RGBA32F,5,1024,0,GL_RGBA,GL_FLOAT,bytes(self.objectData))
+        with open("ray tracer/shaders/rayTracer.txt",'r') as f:
+            objectbuffer.checkLayouts(f.read())
+
+        self.objectStore = objectbuffer.ObjectStore(
+            bake_visibility=self.bakeVisibility, skip_static_lights=self.useLightmap
+        )
+        self.gridTexture = occlusion.GridTexture()
+        self.lightmap = lightmap.Lightmap() if self.useLightmap else None
+        self.temporalCache = temporal.TemporalCache() if self.useTemporalCache else None
     
     def makeSuperTexture(self):
 
-        filenames = [
-            "CopperFlatRoundRoofPatina", "AlternatingHandmadeTilesMonochrome", "BiomechZombieCircuits", 
-            "BakeliteMarbledPlastic", "MarsSmoothRock", "MetalCrateXCorrugatedPainted",
-            "OrangePineTreeBark", "SpaceLabWallOld", "SpaceStationWallKit5Metallic"
-        ]
-
-        self.SuperTexture = textures.SuperTexture(filenames)
+        self.SuperTexture = textures.SuperTexture(textures.MATERIAL_FILES)
     
     def makeShader(self, vertexFilepath, fragmentFilepath):
         """
@@ -239,127 +347,49 @@ class Engine:
         
         return shader
     
-    def makeComputeShader(self, filepath):
+    def makeComputeShader(self, filepath, defines=()):
         """
             Read source code, compile and link shaders.
+            Each of defines is #defined after the #version line.
             Returns the compiled and linked program.
         """
 
         with open(filepath,'r') as f:
             compute_src = f.readlines()
+        compute_src[1:1] = [f"#define {name}\n" for name in defines]
         
         shader = compileProgram(compileShader(compute_src, GL_COMPUTE_SHADER))
         
         return shader
 
-    def recordSphere(self, i, _sphere):
-
-        # sphere: (cx cy cz r) (r g b -) (- - - -) (- - - -) (- - - -)
-
-        self.objectData[20*i]     = _sphere.center[0]
-        self.objectData[20*i + 1] = _sphere.center[1]
-        self.objectData[20*i + 2] = _sphere.center[2]
-
-        self.objectData[20*i + 3] = _sphere.radius
-
-        self.objectData[20*i + 4] = _sphere.color[0]
-        self.objectData[20*i + 5] = _sphere.color[1]
-        self.objectData[20*i + 6] = _sphere.color[2]
-
-        self.objectData[20*i + 7] = _sphere.roughness
-    
-    def recordPlane(self, i, _plane):
-
-        # plane: (cx cy cz tx) (ty tz bx by) (bz nx ny nz) (umin umax vmin vmax) (r g b -)
-
-        self.objectData[20*i]     = _plane.center[0]
-        self.objectData[20*i + 1] = _plane.center[1]
-        self.objectData[20*i + 2] = _plane.center[2]
-
-        self.objectData[20*i + 3] = _plane.tangent[0]
-        self.objectData[20*i + 4] = _plane.tangent[1]
-        self.objectData[20*i + 5] = _plane.tangent[2]
-
-        self.objectData[20*i + 6] = _plane.bitangent[0]
-        self.objectData[20*i + 7] = _plane.bitangent[1]
-        self.objectData[20*i + 8] = _plane.bitangent[2]
-
-        self.objectData[20*i + 9]  = _plane.normal[0]
-        self.objectData[20*i + 10] = _plane.normal[1]
-        self.objectData[20*i + 11] = _plane.normal[2]
-
-        self.objectData[20*i + 12] = _plane.uMin
-        self.objectData[20*i + 13] = _plane.uMax
-        self.objectData[20*i + 14] = _plane.vMin
-        self.objectData[20*i + 15] = _plane.vMax
-
-        self.objectData[20*i + 16] = _plane.material_index
-    
-    def recordLight(self, i, _light):
-
-        # light: (x y z s) (r g b -) (- - - -) (- - - -) (- - - -)
-
-        self.objectData[20*i]     = _light.position[0]
-        self.objectData[20*i + 1] = _light.position[1]
-        self.objectData[20*i + 2] = _light.position[2]
-        self.objectData[20*i + 3] = _light.strength
-
-        self.objectData[20*i + 4] = _light.color[0]
-        self.objectData[20*i + 5] = _light.color[1]
-        self.objectData[20*i + 6] = _light.color[2]
-    
     def updateScene(self, scene):
+        """
+            Send the scene's objects and their bvh to the ray tracer, if they
+            changed. Only the rows of the storage buffers which differ are uploaded.
+        """
 
+        if not scene.outDated:
+            return
         scene.outDated = False
 
         glUseProgram(self.rayTracerShader)
 
-        #spheres
-        sphereCount = 0
-        objectCount = 0
-        for i,_sphere in enumerate(scene.spheres):
-            self.recordSphere(i + sphereCount + objectCount, _sphere)
-        sphereCount += len(scene.spheres)
-        for room in scene.active_rooms:
-            for i, _sphere in enumerate(room.spheres):
-                self.recordSphere(i + sphereCount + objectCount, _sphere)
-            sphereCount += len(room.spheres)
+        sphereCount, planeCount, lightCount, topNodeCount = self.objectStore.pack(scene)
+        rows, cols = scene.wall_array.shape
+        glUniform2f(self.lightGridSizeLocation, cols, rows)
         glUniform1f(self.sphereCountLocation, sphereCount)
-        objectCount += sphereCount
-
-        #planes
-        planeCount = 0
-        for i,_plane in enumerate(scene.planes):
-            self.recordPlane(i + planeCount + objectCount, _plane)
-        planeCount += len(scene.planes)
-        for room in scene.active_rooms:
-            for i, _plane in enumerate(room.planes):
-                self.recordPlane(i + planeCount + objectCount, _plane)
-            planeCount += len(room.planes)
-            for door in room.doors:
-                for i,_plane in enumerate(door.planes):
-                    self.recordPlane(i + planeCount + objectCount, _plane)
-                planeCount += len(door.planes)
-        glUniform1f(self.planeCountLocation, planeCount)
-        objectCount += planeCount
-
-        #lights
-        lightCount = 0
-        for i,_light in enumerate(scene.lights):
-            self.recordLight(i + lightCount + objectCount, _light)
-        lightCount += len(scene.lights)
-        for room in scene.active_rooms:
-            for i, _light in enumerate(room.lights):
-                self.recordLight(i + lightCount + objectCount, _light)
-            lightCount += len(room.lights)
-        glUniform1f(self.lightCountLocation, lightCount)
-        objectCount += lightCount
-
-        glActiveTexture(GL_TEXTURE1)
-        glBindTexture(GL_TEXTURE_2D, self.objectDataTexture)
-        glTexImage2D(GL_TEXTURE_2D,0,GL_RGBA32F,5,1024,0,GL_RGBA,GL_FLOAT,bytes(self.objectData))
+        glUniform1f(self.topNodeCountLocation, topNodeCount)
+
+        self.objectStore.upload()
+        if self.occlusionMode == "grid":
+            self.gridTexture.upload(scene)
+        if self.lightmap is not None:
+            self.lightmap.upload(scene)
     
-    def prepGeometryPass(self, scene):
+    def getCameraTransforms(self, scene):
+        """
+            The view and projection transforms of the scene's camera.
+        """
 
         view_transform = pyrr.matrix44.create_look_at(
             eye = scene.camera.posArray,
@@ -373,18 +403,32 @@ class Engine:
             near = 0.1, far = 20, dtype=np.float32
         )
 
+        return view_transform, projection_transform
+
+    def prepGeometryPass(self, scene):
+
+        view_transform, projection_transform = self.getCameraTransforms(scene)
+
         glUseProgram(self.shaderGPass)
 
         glUniformMatrix4fv(self.viewMatrixLocation, 1, False, view_transform)
 
         glUniformMatrix4fv(self.projectionMatrixLocation,1,GL_FALSE,projection_transform)
 
+        if self.lightmap is not None:
+            glUniform1i(self.lightmapTileSizeLocation, self.lightmap.tileSize)
+            glUniform1i(self.lightmapColumnsLocation, self.lightmap.columns)
+            self.lightmap.bind()
+        else:
+            glUniform1i(self.lightmapTileSizeLocation, 0)
+
     def geometry_pass(self, scene):
 
         self.prepGeometryPass(scene)
 
         glUseProgram(self.shaderGPass)
         glBindFramebuffer(GL_FRAMEBUFFER, self.gBuffer)
+        glViewport(0, 0, self.renderWidth, self.renderHeight)
         glClearColor(0.0, 0.0, 0.0, 1.0)
         glDrawBuffers(4, (
             GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1, 
@@ -418,9 +462,13 @@ class Engine:
         glUniform3fv(self.viewerUpLocation, 1, scene.camera.up)
 
         glActiveTexture(GL_TEXTURE0)
-        glBindImageTexture(0, self.colorBuffer, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
-        glActiveTexture(GL_TEXTURE1)
-        glBindImageTexture(1, self.objectDataTexture, 0, GL_FALSE, 0, GL_READ_ONLY, GL_RGBA32F)
+        if self.lightingBuffer is not None:
+            glBindImageTexture(0, self.lightingBuffer, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
+        else:
+            glBindImageTexture(0, self.colorBuffer, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
+        self.objectStore.bind()
+        if self.occlusionMode == "grid":
+            self.gridTexture.bind()
         glActiveTexture(GL_TEXTURE3)
         glBindImageTexture(3, self.SuperTexture.texture, 0, GL_FALSE, 0, GL_READ_ONLY, GL_RGBA32F)
         #g-Buffer
@@ -433,14 +481,53 @@ class Engine:
         glActiveTexture(GL_TEXTURE7)
         glBindImageTexture(7, self.g3Texture, 0, GL_FALSE, 0, GL_READ_ONLY, GL_RGBA32F)
 
+        if self.temporalCache is not None:
+            self.temporalCache.upload(scene)
+            self.temporalCache.bind(self.historyBuffer)
+            #there is no previous camera on the first frame, every cell is dirty then
+            if self.temporalCache.previousViewProjection is not None:
+                glUniformMatrix4fv(
+                    self.previousViewProjectionLocation, 1, GL_FALSE, self.temporalCache.previousViewProjection
+                )
+                glUniform3fv(self.previousViewerPositionLocation, 1, self.temporalCache.previousPosition)
+            glUniform1i(self.frameIndexLocation, self.temporalCache.frame)
+
     def RayTracerPass(self, scene):
 
         self.prepRayTracerPass(scene)
 
         glUseProgram(self.rayTracerShader)
-        glDispatchCompute(int(self.screenWidth/8), int(self.screenHeight/8), 1)
+        if self.lightingBuffer is not None:
+            glDispatchCompute(-(-self.lightingWidth // 8), -(-self.lightingHeight // 8), 1)
+        else:
+            glDispatchCompute(int(self.renderWidth/8), int(self.renderHeight/8), 1)
   
         # make sure writing to image has finished before read
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT | GL_TEXTURE_FETCH_BARRIER_BIT)
+        glBindImageTexture(0, 0, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
+
+        if self.lightingBuffer is not None:
+            self.timePass("upsample", self.UpsamplePass)
+
+        #this frame's lighting is the next one's history
+        if self.temporalCache is not None:
+            view_transform, projection_transform = self.getCameraTransforms(scene)
+            self.temporalCache.advance(
+                pyrr.matrix44.multiply(view_transform, projection_transform), scene.camera.posArray
+            )
+            self.lightingBuffer, self.historyBuffer = self.historyBuffer, self.lightingBuffer
+
+    def UpsamplePass(self):
+        """
+            Bring the lighting samples back to every pixel and apply
+            the g-buffer's albedo and emissive, see upsample.py.
+        """
+
+        glUseProgram(self.upsampleShader)
+        glBindImageTexture(0, self.colorBuffer, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
+        glBindImageTexture(1, self.lightingBuffer, 0, GL_FALSE, 0, GL_READ_ONLY, GL_RGBA32F)
+        glDispatchCompute(int(self.renderWidth/8), int(self.renderHeight/8), 1)
+
         glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
         glBindImageTexture(0, 0, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
 
@@ -456,22 +543,57 @@ class Engine:
             glUseProgram(self.fxaaShader)  # Use FXAA shader
         else:
             glUseProgram(self.defaultShader)  # Use default shader
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.outputFramebuffer)
+        glViewport(0, 0, self.screenWidth, self.screenHeight)
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_2D, self.colorBuffer)
         glBindVertexArray(self.vao)
         glDrawArrays(GL_TRIANGLES, 0, self.vertex_count)
-        pg.display.flip()
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if self.outputFramebuffer == 0:
+            pg.display.flip()
 
     def renderScene(self, scene):
         """
             Draw all objects in the scene
         """
         
-        self.updateScene(scene)
-        self.geometry_pass(scene)
-        self.RayTracerPass(scene)
-        self.drawScreen()
+        if self.profiler is not None:
+            self.profiler.beginFrame()
+        if self.frameTimer is not None:
+            self.frameTimer.begin()
+        self.timePass("update", self.updateScene, scene)
+        self.timePass("geometry", self.geometry_pass, scene)
+        self.timePass("raytrace", self.RayTracerPass, scene)
+        frameTime = self.frameTimer.end() if self.frameTimer is not None else None
+        self.timePass("present", self.drawScreen)
+        if self.profiler is not None:
+            self.profiler.endFrame()
+
+        if frameTime is not None:
+            self.adjustResolution(frameTime)
+
+    def timePass(self, name, function, *args):
+        """
+            Run a pass, timed by the profiler if there is one.
+        """
+
+        if self.profiler is None:
+            function(*args)
+            return
+        self.profiler.begin(name)
+        function(*args)
+        self.profiler.end(name)
+
+    def adjustResolution(self, frameTime):
+        """
+            Pass a frame's GPU time to the resolution controller,
+            and resize if it picks another render scale.
+        """
+
+        scale = self.resolutionController.update(frameTime)
+        if scale != self.renderScale:
+            self.resize(scale)
     
     def destroy(self):
         """
@@ -482,5 +604,17 @@ class Engine:
         glDeleteProgram(self.rayTracerShader)
         glDeleteVertexArrays(1, (self.vao,))
         glDeleteBuffers(1, (self.vbo,))
-        glDeleteTextures(1, (self.colorBuffer,))
+        self.destroyColorBuffers()
+        if self.upsampleShader is not None:
+            glDeleteProgram(self.upsampleShader)
+        if self.frameTimer is not None:
+            self.frameTimer.destroy()
+        if self.profiler is not None:
+            self.profiler.destroy()
+        if self.temporalCache is not None:
+            self.temporalCache.destroy()
+        self.objectStore.destroy()
+        self.gridTexture.destroy()
+        if self.lightmap is not None:
+            self.lightmap.destroy()
         glDeleteProgram(self.shader)
\ No newline at end of file
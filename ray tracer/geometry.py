@@ -1,7 +1,82 @@
+import bisect
 import elements
 from elements import *
 import edge
 
+#bump whenever the built geometry changes, so cached levels are rebuilt
+GEOMETRY_VERSION = 1
+
+#integer code used for "d" door cells once the wall grid is a numpy array
+DOOR = -1
+
+#an edge followed by this edge type turns a convex corner, see isConvex
+CONVEX_SUCCESSOR = np.zeros(edge.WEST + 1, dtype=np.uint8)
+CONVEX_SUCCESSOR[edge.NORTH] = edge.WEST
+CONVEX_SUCCESSOR[edge.WEST] = edge.SOUTH
+CONVEX_SUCCESSOR[edge.SOUTH] = edge.EAST
+CONVEX_SUCCESSOR[edge.EAST] = edge.NORTH
+
+def toWallArray(walls):
+    """
+        Convert a wall matrix into an integer numpy array.
+        Door cells ("d") are encoded as DOOR.
+    """
+
+    if isinstance(walls, np.ndarray):
+        return walls.astype(np.int32, copy=False)
+
+    return np.array(
+        [[DOOR if block == "d" else block for block in row] for row in walls],
+        dtype=np.int32
+    )
+
+def getLumpedGeometryArray(walls):
+    """
+        Vectorized version of getLumpedGeometry.
+
+        Takes the wall grid as an integer array (see toWallArray) and
+        returns a uint8 array holding the same visibility bitmask.
+        1: North wall
+        2: East wall
+        4: South wall
+        8: West wall
+    """
+
+    walls = toWallArray(walls)
+    empty = (walls == 0) | (walls == DOOR)
+
+    #pad with solid blocks so the map border never shows a face
+    open_space = np.zeros((walls.shape[0] + 2, walls.shape[1] + 2), dtype=bool)
+    open_space[1:-1, 1:-1] = empty
+    solid = ~empty
+
+    result = np.zeros(walls.shape, dtype=np.uint8)
+    result |= (solid & open_space[:-2, 1:-1]).astype(np.uint8)
+    result |= (solid & open_space[1:-1, 2:]).astype(np.uint8) << 1
+    result |= (solid & open_space[2:, 1:-1]).astype(np.uint8) << 2
+    result |= (solid & open_space[1:-1, :-2]).astype(np.uint8) << 3
+
+    return result
+
+def updateWallMask(walls, wall_mask, row, col):
+    """
+        Recompute the wall mask in place after the block at (row, col)
+        changed. Only that block and its four neighbours can change.
+    """
+
+    rows, cols = walls.shape
+    top, bottom = max(row - 1, 0), min(row + 2, rows)
+    left, right = max(col - 1, 0), min(col + 2, cols)
+
+    #one more block on each side, so the window sees its neighbours
+    window_top, window_left = max(top - 1, 0), max(left - 1, 0)
+    window = getLumpedGeometryArray(
+        walls[window_top:min(bottom + 1, rows), window_left:min(right + 1, cols)]
+    )
+    wall_mask[top:bottom, left:right] = window[
+        top - window_top:bottom - window_top, left - window_left:right - window_left
+    ]
+
 def getLumpedGeometry(array):
     """
         Get a description of what planes are visible.
@@ -44,285 +119,361 @@ def getLumpedGeometry(array):
 
     return result
 
+def getRuns(bits):
+    """
+        Find the runs of set cells along each row of a boolean array.
+        Returns (row, first column, last column) arrays in row-major order.
+    """
+
+    rows, cols = bits.shape
+    padded = np.zeros((rows, cols + 2), dtype=np.int8)
+    padded[:, 1:-1] = bits
+    steps = np.diff(padded, axis=1)
+
+    starts = np.flatnonzero(steps == 1)
+    ends = np.flatnonzero(steps == -1)
+
+    return starts // (cols + 1), starts % (cols + 1), ends % (cols + 1) - 1
+
+def getEdgesArray(wall_mask, rows=None, cols=None):
+    """
+        Vectorized version of getEdges.
+
+        Returns a structured array (edge.EDGE_DTYPE) of wall runs.
+        Edges are ordered north (row-major), east (column-major),
+        south (row-major) then west (column-major), so an edge's
+        index matches the id getEdges gives it.
+
+        rows and cols, as (first, last + 1), limit north and south edges
+        to a range of rows and east and west edges to a range of columns.
+    """
+
+    wall_mask = np.asarray(wall_mask)
+    rows = (0, wall_mask.shape[0]) if rows is None else rows
+    cols = (0, wall_mask.shape[1]) if cols is None else cols
+    horizontal = wall_mask[rows[0]:rows[1]]
+    vertical = wall_mask[:, cols[0]:cols[1]]
+    runs = []
+
+    #North edges: 1, a -> b runs left to right
+    row, first, last = getRuns((horizontal & edge.NORTH) != 0)
+    row += rows[0]
+    runs.append((edge.NORTH, (row, first), (row, last)))
+
+    #East edges: 2, a -> b runs top to bottom
+    col, first, last = getRuns((vertical & edge.EAST).T != 0)
+    col += cols[0]
+    runs.append((edge.EAST, (first, col), (last, col)))
+
+    #South: 4, a -> b runs right to left
+    row, first, last = getRuns((horizontal & edge.SOUTH) != 0)
+    row += rows[0]
+    runs.append((edge.SOUTH, (row, last), (row, first)))
+
+    #West: 8, a -> b runs bottom to top
+    col, first, last = getRuns((vertical & edge.WEST).T != 0)
+    col += cols[0]
+    runs.append((edge.WEST, (last, col), (first, col)))
+
+    edges = np.empty(sum(len(point_a[0]) for _, point_a, _ in runs), dtype=edge.EDGE_DTYPE)
+    offset = 0
+    for edge_type, point_a, point_b in runs:
+        count = len(point_a[0])
+        edges["type"][offset:offset + count] = edge_type
+        edges["point_a"][offset:offset + count] = np.stack(point_a, axis=1)
+        edges["point_b"][offset:offset + count] = np.stack(point_b, axis=1)
+        offset += count
+
+    return edges
+
+def toEdges(edges):
+    """
+        Build edge.Edge objects from a structured edge array.
+    """
+
+    result = []
+    for id, (edge_type, point_a, point_b) in enumerate(zip(
+        edges["type"].tolist(), edges["point_a"].tolist(), edges["point_b"].tolist()
+    )):
+        _edge = edge.Edge(id)
+        _edge.type = edge_type
+        _edge.point_a = tuple(point_a)
+        _edge.point_b = tuple(point_b)
+        result.append(_edge)
+
+    return result
+
 def getEdges(wall_mask):
+    """
+        Get the wall runs of a wall mask as a list of edge.Edge objects.
+    """
 
-    rows = len(wall_mask)
-    cols = len(wall_mask[0])
-    edges = []
-    id = 0
+    return toEdges(getEdgesArray(wall_mask))
 
-    #debugging: print mask
+def getWindowEdges(wall_mask, row, col):
     """
-    for row in range(rows):
-        for col in range(cols):
-            print(f"{wall_mask[row][col]} ", end="")
-        print()
+        The edges which can change when the block at (row, col) changes:
+        runs on the three rows and columns through it which cover the
+        blocks around it, or end right next to them.
     """
-    
-    #North edges: 1
-    building_edge = False
-    _edge = None
-    for row in range(rows):
-        for col in range(cols):
-            
-            if wall_mask[row][col] & 1:
-                if not building_edge:
-                    building_edge = True
-                    _edge = edge.Edge(id)
-                    id += 1
-                    _edge.point_a = (row, col)
-                    _edge.type = edge.NORTH
-            else:
-                if building_edge:
-                    building_edge = False
-                    _edge.point_b = (row, col - 1)
-                    edges.append(_edge)
-            
-        if building_edge:
-            building_edge = False
-            _edge.point_b = (row, cols - 1)
-            edges.append(_edge)
-        
-    #East edges: 2
-    building_edge = False
-    _edge = None
-    for col in range(cols):
-        for row in range(rows):
-            
-            if wall_mask[row][col] & 2:
-                if not building_edge:
-                    building_edge = True
-                    _edge = edge.Edge(id)
-                    id += 1
-                    _edge.point_a = (row, col)
-                    _edge.type = edge.EAST
-            else:
-                if building_edge:
-                    building_edge = False
-                    _edge.point_b = (row - 1, col)
-                    edges.append(_edge)
-            
-        if building_edge:
-            building_edge = False
-            _edge.point_b = (rows - 1, col)
-            edges.append(_edge)
-    
-    #South: 4
-    building_edge = False
-    _edge = None
-    for row in range(rows):
-        for col in range(cols):
-            
-            if wall_mask[row][col] & 4:
-                if not building_edge:
-                    building_edge = True
-                    _edge = edge.Edge(id)
-                    id += 1
-                    _edge.point_b = (row, col)
-                    _edge.type = edge.SOUTH
-            else:
-                if building_edge:
-                    building_edge = False
-                    _edge.point_a = (row, col - 1)
-                    edges.append(_edge)
-            
-        if building_edge:
-            building_edge = False
-            _edge.point_a = (row, cols - 1)
-            edges.append(_edge)
-        
-    #West: 8
-    building_edge = False
-    _edge = None
-    for col in range(cols):
-        for row in range(rows):
-            
-            if wall_mask[row][col] & 8:
-                if not building_edge:
-                    building_edge = True
-                    _edge = edge.Edge(id)
-                    id += 1
-                    _edge.point_b = (row, col)
-                    _edge.type = edge.WEST
-            else:
-                if building_edge:
-                    building_edge = False
-                    _edge.point_a = (row - 1, col)
-                    edges.append(_edge)
-            
-        if building_edge:
-            building_edge = False
-            _edge.point_a = (rows - 1, col)
-            edges.append(_edge)
-    
-    #debugging: print set of edges
+
+    rows, cols = wall_mask.shape
+    top, bottom = max(row - 1, 0), min(row + 2, rows)
+    left, right = max(col - 1, 0), min(col + 2, cols)
+    edges = getEdgesArray(wall_mask, (top, bottom), (left, right))
+
+    #runs along a row cover a range of columns, runs along a column a range of rows
+    horizontal = (edges["type"] == edge.NORTH) | (edges["type"] == edge.SOUTH)
+    first = np.minimum(edges["point_a"], edges["point_b"])
+    last = np.maximum(edges["point_a"], edges["point_b"])
+    first = np.where(horizontal, first[:, 1], first[:, 0])
+    last = np.where(horizontal, last[:, 1], last[:, 0])
+
+    return edges[(last >= np.where(horizontal, left, top) - 1) & (first <= np.where(horizontal, right, bottom))]
+
+def toEdgeKeys(edges):
+    """
+        Turn an edge array into hashable (type, a_row, a_col, b_row, b_col) tuples.
     """
-    for _edge in edges:
-        print(f"Edge {_edge.id}: ", end="")
-        if _edge.type == edge.NORTH:
-            print("North: ",end="")
-        elif _edge.type == edge.EAST:
-            print("East: ",end="")
-        elif _edge.type == edge.SOUTH:
-            print("South: ",end="")
-        elif _edge.type == edge.WEST:
-            print("West: ",end="")
-        print(f"({_edge.point_a[0]}, {_edge.point_a[1]}) -> ({_edge.point_b[0]}, {_edge.point_b[1]})")
+
+    return list(zip(
+        edges["type"].tolist(),
+        edges["point_a"][:, 0].tolist(), edges["point_a"][:, 1].tolist(),
+        edges["point_b"][:, 0].tolist(), edges["point_b"][:, 1].tolist()
+    ))
+
+def getEdgeOrder(key):
+    """
+        Sort key putting edge keys in getEdgesArray order.
     """
 
+    edge_type, a_row, a_col, b_row, b_col = key
+    if edge_type in (edge.NORTH, edge.SOUTH):
+        return (edge_type, a_row, min(a_col, b_col))
+    return (edge_type, a_col, min(a_row, b_row))
+
+def fromEdgeKeys(keys):
+    """
+        Pack edge keys into an edge array, in getEdgesArray order.
+    """
+
+    keys = sorted(keys, key=getEdgeOrder)
+    edges = np.empty(len(keys), dtype=edge.EDGE_DTYPE)
+    if keys:
+        values = np.array(keys, dtype=np.int32)
+        edges["type"] = values[:, 0]
+        edges["point_a"] = values[:, 1:3]
+        edges["point_b"] = values[:, 3:5]
+
     return edges
 
-def buildRooms(walls, doors, rooms):
+def labelRooms(walls):
     """
-        Perform Depth First search to partition the empty space
-        into rooms.
+        Label every empty (0) cell with the id of the room it belongs to.
+        Returns an int32 grid, -1 on walls and doors.
 
-        Add planes to rooms.
+        Rooms are 4-connected components of empty cells. Each row is split
+        into runs of empty cells, runs touching the run above are joined
+        with union-find, so the whole pass is linear in the map area.
+        Room ids are ordered by each room's first cell in row-major order.
     """
 
-    #list of coordinates to search.
-    coordinates_to_expand = []
-    #history of coordinates which have already been searched.
-    expanded_coordinates = []
-    empty_blocks = (0, "d")
+    walls = toWallArray(walls)
+    rows, cols = walls.shape
+    empty = (walls == 0)
+
+    #label each horizontal run of empty cells
+    starts = empty.copy()
+    starts[:, 1:] &= ~empty[:, :-1]
+    run_ids = np.cumsum(starts.ravel()).reshape(rows, cols) - 1
+    run_count = int(starts.sum())
+
+    #join runs which sit on top of each other
+    parent = list(range(run_count))
+    stacked = empty[1:] & empty[:-1]
+    pairs = np.unique(run_ids[:-1][stacked] * run_count + run_ids[1:][stacked])
+    for upper, lower in zip((pairs // run_count).tolist(), (pairs % run_count).tolist()):
+        upper = findRoot(parent, upper)
+        lower = findRoot(parent, lower)
+        if lower != upper:
+            parent[max(upper, lower)] = min(upper, lower)
+
+    #flatten, every run points at the smallest run of its room
+    parent = np.array(parent, dtype=np.int64)
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    #compact room ids, in order of first appearance
+    roots, run_rooms = np.unique(parent, return_inverse=True)
+
+    labels = np.full((rows, cols), -1, dtype=np.int32)
+    labels[empty] = run_rooms[run_ids[empty]]
+
+    return labels
+
+def findRoot(parent, index):
+    """
+        Union-find lookup with path halving.
+    """
 
-    #get the first open block to search from
-    starting_coordinate = getNewRoom(walls, expanded_coordinates)
-
-    while starting_coordinate is not None:
-        #start looking in a new room
-        coordinates_to_expand.append(starting_coordinate)
-        #empty blocks can be 0 or "d", but doors can be expanded from both sides,
-        #so remove any doors currently in history.
-        for i,coordinate in enumerate(expanded_coordinates):
-            row, col = coordinate
-            if walls[row][col] == "d":
-                expanded_coordinates.pop(i)
-        newRoom = elements.Room()
-    
-        #keep expanding empty space within the room, until done.
-        while len(coordinates_to_expand) > 0:
-
-            searched_coordinate = coordinates_to_expand.pop(0)
-            if searched_coordinate in expanded_coordinates:
-                #just in case the algorithm tells us to search
-                #the same space twice.
-                continue
-            expanded_coordinates.append(searched_coordinate)
-            neighbors = expand(walls, searched_coordinate, expanded_coordinates)
-            
-            for coordinate in neighbors:
-                row,col = coordinate
-                #in the next iteration, only the empty space neighbours
-                #will be expanded
-                if walls[row][col] in empty_blocks:
-
-                    if coordinate not in expanded_coordinates:
-                        coordinates_to_expand.append(coordinate)
-                    
-                    #If we're on a door then search to see if the door already exists
-                    #(doors can belong to multiple rooms)
-                    if walls[row][col] == "d":
-                        alreadyExists = False
-                        for _door in doors:
-                            if coordinate == _door.coordinate:
-                                alreadyExists = True
-                        
-                        if not alreadyExists:
-                            #make a door, build the central planes,
-                            #then build the external planes
-                            newDoor = elements.Door(coordinate)
-                            makeNorthWall(row, col, 7, newDoor)
-                            makeEastWall(row, col, 7, newDoor)
-                            makeSouthWall(row, col, 7, newDoor)
-                            makeWestWall(row, col, 7, newDoor)
-                            makeCeiling(row, col, 7, newDoor)
-                            makeFloor(row, col, 7, newDoor)
-                            if walls[row+1][col] not in empty_blocks:
-                                #horizontal, add top and bottom
-                                makeNorthWall(row + 1, col, 7, newDoor)
-                                makeSouthWall(row - 1, col, 7, newDoor)
-                            else:
-                                #vertical, add left and right
-                                makeEastWall(row, col - 1, 7,newDoor)
-                                makeWestWall(row, col + 1, 7,newDoor)
-                            
-                            doors.append(newDoor)
-                            newRoom.doors.append(newDoor)
-                        else:
-                            #a door exists, find the instance of the door, and add it to the
-                            #current room
-                            newDoor = getDoorByCoords(doors, coordinate)
-                            newRoom.doors.append(newDoor)
-
-                        
-                    if coordinate not in newRoom.internalCoordinates:
-                        newRoom.internalCoordinates.append(coordinate)
-
-                elif coordinate not in newRoom.coordinates:
-                    newRoom.coordinates.append(coordinate)
-
-        #this room has been fully expanded, add it to the set
-        #of rooms, then attempt to start a new room.
-        rooms.append(newRoom)
-        starting_coordinate = getNewRoom(walls, expanded_coordinates)
+    while parent[index] != index:
+        parent[index] = parent[parent[index]]
+        index = parent[index]
+    return index
 
-def getNewRoom(walls, expanded_coordinates):
+def getRoomNeighbours(labels, cells):
     """
-        Search the set of rooms and if an empty space is found
-        that hasn't been searched, return that coordinate.
-        Otherwise, return None
+        Find every cell from the mask "cells" that is 4-adjacent to a room.
+        Returns parallel arrays of (room id, flat cell index), sorted and unique.
     """
 
-    #get dimensions of map
-    rows = len(walls)
-    cols = len(walls[0])
+    rows, cols = labels.shape
+    flat_index = np.arange(rows * cols).reshape(rows, cols)
+    room_ids = []
+    neighbours = []
+
+    for room_slice, cell_slice in (
+        ((slice(1, None), slice(None)), (slice(None, -1), slice(None))),
+        ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+        ((slice(None), slice(1, None)), (slice(None), slice(None, -1))),
+        ((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+    ):
+        room_side = labels[room_slice]
+        found = (room_side >= 0) & cells[cell_slice]
+        room_ids.append(room_side[found])
+        neighbours.append(flat_index[cell_slice][found])
+
+    keys = np.unique(
+        np.concatenate(room_ids).astype(np.int64) * rows * cols + np.concatenate(neighbours)
+    )
+
+    return keys // (rows * cols), keys % (rows * cols)
+
+def splitByRoom(room_ids, cell_indices, room_count, cols, origin=(0, 0)):
+    """
+        Turn sorted (room id, flat cell index) pairs into one list
+        of (row, col) tuples per room, offset by origin.
+    """
 
-    for row in range(rows):
-        for col in range(cols):
-            if walls[row][col] == 0:
-                possible_solution = (row,col)
-                if possible_solution not in expanded_coordinates:
-                    return possible_solution
-    return None
+    bounds = np.searchsorted(room_ids, np.arange(room_count + 1))
+    rows = (cell_indices // cols + origin[0]).tolist()
+    cols = (cell_indices % cols + origin[1]).tolist()
 
-def expand(walls, coordinate, expanded_coordinates):
+    return [
+        list(zip(rows[bounds[i]:bounds[i + 1]], cols[bounds[i]:bounds[i + 1]]))
+        for i in range(room_count)
+    ]
+
+def hasCell(cells, cell):
     """
-        return the neighbourhood of coordinates around a given coordinate,
-        returning all those which are in the same room.
+        Binary search a row-major sorted list of (row, col) tuples,
+        like the ones splitByRoom returns.
     """
 
-    coordinates = [coordinate,]
+    index = bisect.bisect_left(cells, cell)
+    return index < len(cells) and cells[index] == cell
+
+def insertCell(cells, cell):
+    """
+        Add a cell to a sorted cell list, keeping it sorted.
+    """
+
+    if not hasCell(cells, cell):
+        bisect.insort(cells, cell)
+
+def removeCell(cells, cell):
+    """
+        Remove a cell from a sorted cell list, if it is there.
+    """
+
+    index = bisect.bisect_left(cells, cell)
+    if index < len(cells) and cells[index] == cell:
+        del cells[index]
+
+def buildRooms(walls, doors, rooms, origin=(0, 0)):
+    """
+        Partition the empty space into rooms.
+
+        Each room gets its surrounding wall blocks (coordinates),
+        its empty blocks plus any doors it touches (internalCoordinates)
+        and those doors. A door belongs to every room it touches.
+
+        walls can be a window of a larger map, origin is then the map
+        coordinate of walls[0][0]. Doors it touches must already be in doors.
+
+        Returns the room id grid from labelRooms.
+    """
+
+    grid = toWallArray(walls)
+    cols = grid.shape[1]
+    labels = labelRooms(grid)
+    room_count = int(labels.max()) + 1
+
+    is_door = (grid == DOOR)
+    is_wall = (grid != 0) & ~is_door
+
+    wall_rooms, wall_cells = getRoomNeighbours(labels, is_wall)
+    door_rooms, door_cells = getRoomNeighbours(labels, is_door)
+
+    #a room's internal blocks are its own empty blocks plus the doors it touches
+    empty_cells = np.flatnonzero(labels >= 0)
+    internal_keys = np.sort(np.concatenate((
+        labels.ravel()[empty_cells].astype(np.int64) * grid.size + empty_cells,
+        door_rooms * grid.size + door_cells
+    )))
+
+    coordinates = splitByRoom(wall_rooms, wall_cells, room_count, cols, origin)
+    internalCoordinates = splitByRoom(
+        internal_keys // grid.size, internal_keys % grid.size, room_count, cols, origin
+    )
+    room_doors = splitByRoom(door_rooms, door_cells, room_count, cols, origin)
+
+    #doors already in the list are reused, new doors are added in row-major order
+    door_lookup = {_door.coordinate: _door for _door in doors}
+    for cell in np.unique(door_cells).tolist():
+        coordinate = (cell // cols + origin[0], cell % cols + origin[1])
+        if coordinate not in door_lookup:
+            door_lookup[coordinate] = makeDoor(coordinate, grid)
+            doors.append(door_lookup[coordinate])
+
+    for i in range(room_count):
+        newRoom = elements.Room()
+        newRoom.coordinates = coordinates[i]
+        newRoom.internalCoordinates = internalCoordinates[i]
+        newRoom.doors = [door_lookup[coordinate] for coordinate in room_doors[i]]
+        rooms.append(newRoom)
+
+    return labels
+
+def makeDoor(coordinate, walls):
+    """
+        Make a door, build the central planes, then build the external planes.
+    """
+
+    row, col = coordinate
+    newDoor = elements.Door(coordinate)
+    faces = [
+        (edge.NORTH, row, col), (edge.EAST, row, col),
+        (edge.SOUTH, row, col), (edge.WEST, row, col),
+        (CEILING, row, col), (FLOOR, row, col)
+    ]
+    if walls[row + 1][col] not in (0, DOOR):
+        #horizontal, add top and bottom
+        faces += [(edge.NORTH, row + 1, col), (edge.SOUTH, row - 1, col)]
+    else:
+        #vertical, add left and right
+        faces += [(edge.EAST, row, col - 1), (edge.WEST, row, col + 1)]
+
+    newDoor.vertices = np.concatenate(
+        [getFaces(face, [face_row], [face_col], [7]) for face, face_row, face_col in faces]
+    )
+    newDoor.vertexCount = len(newDoor.vertices)
+
+    return newDoor
 
-    rows = len(walls)
-    cols = len(walls[0])
-    
-    row,col = coordinate
-
-    onDoor = (walls[row][col] == "d")
-
-    if row > 0:
-        if (not onDoor) \
-            or (onDoor and walls[row - 1][col] != 0) \
-            and coordinate not in expanded_coordinates:
-            coordinates.append((row - 1, col))
-    if row < rows - 1:
-        if (not onDoor) \
-            or (onDoor and walls[row + 1][col] != 0) \
-            and coordinate not in expanded_coordinates:
-            coordinates.append((row + 1, col))
-    if col > 0:
-        if (not onDoor) \
-            or (onDoor and walls[row][col - 1] != 0) \
-            and coordinate not in expanded_coordinates:
-            coordinates.append((row, col - 1))
-    if col < cols - 1:
-        if (not onDoor) \
-            or (onDoor and walls[row][col + 1] != 0) \
-            and coordinate not in expanded_coordinates:
-            coordinates.append((row, col + 1))
-    
-    return coordinates
 
 def sendEdge(_edge, target):
 
@@ -398,113 +549,388 @@ def sendEdge(_edge, target):
             )
         )
 
-def makeNorthWall(row, col, material, target):
+def sendFloorAndCeiling(cells, walls, floors, ceilings, target):
+    """
+        Cover the floor and ceiling of a room's empty cells with as few
+        planes as possible, one material per plane (see getFewestRectangles).
 
-    #x,y,z,u,v,tx,ty,tz,bx,by,bz,nx,ny,nz
-    vertices = [
-        col + 1.0, row, 1.0, 1.0/5.0, (9.0 - material)/9.0,         -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, #z+,x+
-        col,       row, 1.0, 0.0,     (9.0 - material)/9.0,         -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, #z+,x-
-        col,       row, 0.0, 0.0,     (9.0 - (material + 1.0))/9.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, #z-,x-
+        Returns (cell count, plane count) for the floor and ceiling together.
+    """
 
-        col,       row, 0.0, 0.0,     (9.0 - (material + 1.0))/9.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, #z-,x-
-        col + 1.0, row, 0.0, 1.0/5.0, (9.0 - (material + 1.0))/9.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, #z-,x+
-        col + 1.0, row, 1.0, 1.0/5.0, (9.0 - material)/9.0,         -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, #z+,x+
-    ]
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 2)
+    cells = cells[walls[cells[:, 0], cells[:, 1]] == 0]
 
-    for data in vertices:
-        target.vertices.append(data)
-    
-    target.vertexCount += 6
-    
-def makeEastWall(row, col, material, target):
+    planes = getFloorAndCeilingPlanes(cells[:, 0], cells[:, 1], floors, ceilings)
+    target.planes.extend(planes)
 
-    #x,y,z,u,v,tx,ty,tz,bx,by,bz,nx,ny,nz
-    vertices = [
-        col + 1.0, row,       0.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, #z-,y-
-        col + 1.0, row + 1.0, 0.0, 1.0/5.0, (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, #z-,y+
-        col + 1.0, row + 1.0, 1.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, #z+,y+
+    return 2 * len(cells), len(planes)
 
-        col + 1.0, row + 1.0, 1.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, #z+,y+
-        col + 1.0, row,       1.0, 0.0,     (9.0 - material)/9.0,         0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, #z+,y-
-        col + 1.0, row,       0.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, #z-,y-
-    ]
+def getFloorAndCeilingPlanes(rows, cols, floors, ceilings, faces=None):
+    """
+        Build the planes covering the floor and ceiling of the given cells.
+        faces picks FLOOR, CEILING or both (the default).
+    """
 
-    for data in vertices:
-        target.vertices.append(data)
-    
-    target.vertexCount += 6
+    faces = (FLOOR, CEILING) if faces is None else faces
+    planes = []
+    for face, materials, z, normal, tangent, bitangent in (
+        (FLOOR, floors[rows, cols] - 1, 0.0, [0, 0, 1], [0, 1, 0], [-1, 0, 0]),
+        (CEILING, ceilings[rows, cols] - 1, 1.0, [0, 0, -1], [0, -1, 0], [1, 0, 0]),
+    ):
+        if face not in faces:
+            continue
+        for row, col, height, width, material in zip(*(
+            values.tolist() for values in getFewestRectangles(rows, cols, materials)
+        )):
+            planes.append(
+                elements.Plane(
+                    normal    = normal,
+                    tangent   = tangent,
+                    bitangent = bitangent,
+                    uMin = -height/2,
+                    uMax = height/2,
+                    vMin = -width/2,
+                    vMax = width/2,
+                    center = [col + width/2, row + height/2, z],
+                    material_index = material
+                )
+            )
 
-def makeSouthWall(row, col, material, target):
+    return planes
 
-    #x,y,z,u,v,tx,ty,tz,bx,by,bz,nx,ny,nz
-    vertices = [
-        col + 1.0, row + 1.0, 1.0, 1.0/5.0, (9.0 - material)/9.0,         -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, #z+,x+
-        col + 1.0, row + 1.0, 0.0, 1.0/5.0, (9.0 - (material + 1.0))/9.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, #z-,x+
-        col,       row + 1.0, 0.0, 0.0,     (9.0 - (material + 1.0))/9.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, #z-,x-
+def splitFloorPlane(_plane, cell, floors, ceilings):
+    """
+        Cover a floor or ceiling plane's rectangle again, leaving out one cell.
+        Returns the new planes.
+    """
 
-        col,       row + 1.0, 0.0, 0.0,     (9.0 - (material + 1.0))/9.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, #z-,x-
-        col,       row + 1.0, 1.0, 0.0,     (9.0 - material)/9.0,         -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, #z+,x-
-        col + 1.0, row + 1.0, 1.0, 1.0/5.0, (9.0 - material)/9.0,         -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, #z+,x+
-    ]
+    height, width = int(round(2 * _plane.uMax)), int(round(2 * _plane.vMax))
+    row = int(round(_plane.center[1] - _plane.uMax))
+    col = int(round(_plane.center[0] - _plane.vMax))
+    rows, cols = np.mgrid[row:row + height, col:col + width]
+    keep = (rows != cell[0]) | (cols != cell[1])
+    face = FLOOR if _plane.normal[2] > 0 else CEILING
+
+    return getFloorAndCeilingPlanes(rows[keep], cols[keep], floors, ceilings, faces=(face,))
+
+#face kinds beyond the four wall directions in edge
+CEILING = 16
+FLOOR = 32
+
+#one face covering cell (0, 0), in the layout of elements.VERTEX_SIZE.
+#x and y are scaled by the width and height of merged faces, s and t by
+#the extent named in FACE_TILING, so the texture repeats once per cell.
+FACE_TEMPLATES = {
+    edge.NORTH: np.array([
+        [1.0, 0.0, 1.0, 1.0, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, 0.0], #z+,x+
+        [0.0, 0.0, 1.0, 0.0, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, 0.0], #z+,x-
+        [0.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, 0.0], #z-,x-
+
+        [0.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, 0.0], #z-,x-
+        [1.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, 0.0], #z-,x+
+        [1.0, 0.0, 1.0, 1.0, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -1.0, 0.0, 0.0], #z+,x+
+    ]),
+    edge.EAST: np.array([
+        [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0], #z-,y-
+        [1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0], #z-,y+
+        [1.0, 1.0, 1.0, 1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0], #z+,y+
+
+        [1.0, 1.0, 1.0, 1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0], #z+,y+
+        [1.0, 0.0, 1.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0], #z+,y-
+        [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0], #z-,y-
+    ]),
+    edge.SOUTH: np.array([
+        [1.0, 1.0, 1.0, 1.0, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0], #z+,x+
+        [1.0, 1.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0], #z-,x+
+        [0.0, 1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0], #z-,x-
+
+        [0.0, 1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0], #z-,x-
+        [0.0, 1.0, 1.0, 0.0, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0], #z+,x-
+        [1.0, 1.0, 1.0, 1.0, 1.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0], #z+,x+
+    ]),
+    edge.WEST: np.array([
+        [0.0, 1.0, 1.0, 1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, 0.0], #z+,y+
+        [0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, 0.0], #z-,y+
+        [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, 0.0], #z-,y-
+
+        [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, 0.0], #z-,y-
+        [0.0, 0.0, 1.0, 0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, 0.0], #z+,y-
+        [0.0, 1.0, 1.0, 1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, 0.0], #z+,y+
+    ]),
+    CEILING: np.array([
+        [1.0, 0.0, 1.0, 1.0, 1.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0], #x+,y-
+        [0.0, 0.0, 1.0, 1.0, 0.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0], #x-,y-
+        [0.0, 1.0, 1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0], #x-,y+
+
+        [0.0, 1.0, 1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0], #x-,y+
+        [1.0, 1.0, 1.0, 0.0, 1.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0], #x+,y+
+        [1.0, 0.0, 1.0, 1.0, 1.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0], #x+,y-
+    ]),
+    FLOOR: np.array([
+        [1.0, 1.0, 0.0, 1.0, 1.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0], #x+,y+
+        [0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0], #x-,y+
+        [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0], #x-,y-
+
+        [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0], #x-,y-
+        [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0], #x+,y-
+        [1.0, 1.0, 0.0, 1.0, 1.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0], #x+,y+
+    ]),
+}
+
+#which extent (width: columns, height: rows) scales each face's s and t
+FACE_TILING = {
+    edge.NORTH: ("width", None),
+    edge.EAST: ("height", None),
+    edge.SOUTH: ("width", None),
+    edge.WEST: ("height", None),
+    CEILING: ("height", "width"),
+    FLOOR: ("height", "width"),
+}
+
+#faces in the same plane are merged along these axes by greedy meshing
+MERGE_AXES = {
+    edge.NORTH: (False, True),
+    edge.EAST: (True, False),
+    edge.SOUTH: (False, True),
+    edge.WEST: (True, False),
+    CEILING: (True, True),
+    FLOOR: (True, True),
+}
+
+FACE_VERTICES = 6
+
+def writeFaces(face, rows, cols, materials, out, heights=None, widths=None):
+    """
+        Write one face of the given kind for every (row, col, material)
+        into out, a float32 array of shape (6 * count, VERTEX_SIZE).
 
-    for data in vertices:
-        target.vertices.append(data)
-    
-    target.vertexCount += 6
+        Faces span one cell unless heights and widths (in cells) are given.
+    """
 
-def makeWestWall(row, col, material, target):
+    template = FACE_TEMPLATES[face]
+    faces = out.reshape(-1, FACE_VERTICES, VERTEX_SIZE)
+    extents = {
+        "height": np.ones(len(rows)) if heights is None else np.asarray(heights, dtype=np.float64),
+        "width": np.ones(len(rows)) if widths is None else np.asarray(widths, dtype=np.float64),
+    }
+    s_extent, t_extent = FACE_TILING[face]
+
+    faces[:] = template
+    faces[:, :, 0] = np.asarray(cols, dtype=np.float64)[:, None] + template[:, 0] * extents["width"][:, None]
+    faces[:, :, 1] = np.asarray(rows, dtype=np.float64)[:, None] + template[:, 1] * extents["height"][:, None]
+    faces[:, :, 3] = template[:, 3] * extents[s_extent][:, None]
+    if t_extent is not None:
+        faces[:, :, 4] = template[:, 4] * extents[t_extent][:, None]
+    faces[:, :, 14] = np.asarray(materials, dtype=np.float64)[:, None]
+
+def getFaces(face, rows, cols, materials):
+    """
+        Return a new vertex array holding one face per (row, col, material).
+    """
 
-    #x,y,z,u,v,tx,ty,tz,bx,by,bz,nx,ny,nz
-    vertices = [
-        col, row + 1.0, 1.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, #z+,y+
-        col, row + 1.0, 0.0, 1.0/5.0, (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, #z-,y+
-        col, row,       0.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, #z-,y-
+    out = np.empty((FACE_VERTICES * len(rows), VERTEX_SIZE), dtype=np.float32)
+    writeFaces(face, rows, cols, materials, out)
+    return out
 
-        col, row,       0.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, #z-,y-
-        col, row,       1.0, 0.0,     (9.0 - material)/9.0,         0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, #z+,y-
-        col, row + 1.0, 1.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0, #z+,y+
-    ]
+def getRectangles(rows, cols, materials, merge_rows=True, merge_cols=True):
+    """
+        Greedily merge cells of the same material into rectangles.
+        Cells are first joined into runs along each row, then runs with
+        the same columns and material are stacked down the rows.
 
-    for data in vertices:
-        target.vertices.append(data)
-    
-    target.vertexCount += 6
+        Returns (row, col, height, width, material) arrays.
+    """
 
-def makeCeiling(row, col, material, target):
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    materials = np.asarray(materials, dtype=np.int64)
+    heights = np.ones(len(rows), dtype=np.int64)
+    widths = np.ones(len(rows), dtype=np.int64)
+
+    if merge_cols and len(rows) > 0:
+        order = np.lexsort((cols, rows, materials))
+        rows, cols, materials = rows[order], cols[order], materials[order]
+        starts = np.ones(len(rows), dtype=bool)
+        starts[1:] = (rows[1:] != rows[:-1]) | (materials[1:] != materials[:-1]) | (cols[1:] != cols[:-1] + 1)
+        first = np.flatnonzero(starts)
+        widths = np.diff(np.append(first, len(rows)))
+        rows, cols, materials, heights = rows[first], cols[first], materials[first], heights[first]
+
+    if merge_rows and len(rows) > 0:
+        order = np.lexsort((rows, widths, cols, materials))
+        rows, cols, materials, widths = rows[order], cols[order], materials[order], widths[order]
+        starts = np.ones(len(rows), dtype=bool)
+        starts[1:] = (
+            (cols[1:] != cols[:-1]) | (widths[1:] != widths[:-1])
+            | (materials[1:] != materials[:-1]) | (rows[1:] != rows[:-1] + 1)
+        )
+        first = np.flatnonzero(starts)
+        heights = np.diff(np.append(first, len(rows)))
+        rows, cols, materials, widths = rows[first], cols[first], materials[first], widths[first]
 
-    #x,y,z,u,v,tx,ty,tz,bx,by,bz,nx,ny,nz
-    vertices = [
-        col + 1, row,       1.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, #x+,y-
-        col,     row,       1.0, 1.0/5.0, (9.0 - (material + 1.0))/9.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, #x-,y-
-        col,     row + 1.0, 1.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, #x-,y+
+    return rows, cols, heights, widths, materials
 
-        col,     row + 1.0, 1.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, #x-,y+
-        col + 1, row + 1.0, 1.0, 0.0,     (9.0 - material)/9.0,         0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, #x+,y+
-        col + 1, row,       1.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, -1.0, #x+,y-
-    ]
+def getFewestRectangles(rows, cols, materials):
+    """
+        Run getRectangles merging along rows first and along columns first,
+        and keep whichever gives fewer rectangles.
+    """
 
-    for data in vertices:
-        target.vertices.append(data)
-    
-    target.vertexCount += 6
+    by_rows = getRectangles(rows, cols, materials)
+    col, row, width, height, material = getRectangles(cols, rows, materials)
+
+    if len(col) < len(by_rows[0]):
+        return row, col, height, width, material
+    return by_rows
+
+def selectFaces(cells, walls, floors, ceilings, wall_mask):
+    """
+        Find the faces a set of (row, col) cells contributes: visible wall
+        faces of solid blocks, floors and ceilings of empty ones.
+
+        Returns a list of (face, rows, cols, materials), one per face kind.
+    """
+
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 2)
+    rows, cols = cells[:, 0], cells[:, 1]
+    masks = wall_mask[rows, cols]
+    blocks = walls[rows, cols]
+
+    selections = []
+    for face in (edge.NORTH, edge.EAST, edge.SOUTH, edge.WEST):
+        selected = (masks & face) != 0
+        selections.append((face, rows[selected], cols[selected], blocks[selected] - 1))
+
+    selected = (blocks == 0)
+    selections.append((FLOOR, rows[selected], cols[selected], floors[rows, cols][selected] - 1))
+    selections.append((CEILING, rows[selected], cols[selected], ceilings[rows, cols][selected] - 1))
 
-def makeFloor(row, col, material, target):
+    return selections
+
+def countFaces(selections):
+    """
+        Number of single-cell faces in a list from selectFaces.
+    """
 
-    #x,y,z,u,v,tx,ty,tz,bx,by,bz,nx,ny,nz
-    vertices = [
-        col + 1.0, row + 1.0, 0.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, #x+,y+
-        col,       row + 1.0, 0.0, 1.0/5.0, (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, #x-,y+
-        col,       row,       0.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, #x-,y-
+    return sum(len(rows) for _, rows, _, _ in selections)
+
+def buildMesh(cells, walls, floors, ceilings, wall_mask, greedy=False):
+    """
+        Build the vertices for a set of (row, col) cells in one float32 array.
+
+        Faces are counted first so the array is allocated once, then all
+        faces of each kind are written in a single vectorized step.
+        With greedy set, coplanar faces of the same material are merged
+        into rectangles (see getRectangles).
+    """
+
+    batches = []
+    for face, rows, cols, materials in selectFaces(cells, walls, floors, ceilings, wall_mask):
+        if greedy:
+            merge_rows, merge_cols = MERGE_AXES[face]
+            batches.append((face,) + getRectangles(rows, cols, materials, merge_rows, merge_cols))
+        else:
+            batches.append((face, rows, cols, None, None, materials))
+
+    count = sum(len(rows) for _, rows, _, _, _, _ in batches)
+    vertices = np.empty((FACE_VERTICES * count, VERTEX_SIZE), dtype=np.float32)
+
+    offset = 0
+    for face, rows, cols, heights, widths, materials in batches:
+        size = FACE_VERTICES * len(rows)
+        writeFaces(
+            face, rows, cols, materials, vertices[offset:offset + size],
+            heights=heights, widths=widths
+        )
+        offset += size
+
+    return vertices
+
+FACE_KINDS = (edge.NORTH, edge.EAST, edge.SOUTH, edge.WEST, FLOOR, CEILING)
+
+def getFaceSlots(cells, walls, floors, ceilings, wall_mask):
+    """
+        Map each (face, row, col) of an unmerged mesh from buildMesh
+        to its slot, the index of its first vertex divided by FACE_VERTICES.
+    """
+
+    slots = {}
+    for face, rows, cols, _ in selectFaces(cells, walls, floors, ceilings, wall_mask):
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            slots[(face, row, col)] = len(slots)
+
+    return slots
+
+def patchFaces(_room, cells, walls, floors, ceilings, wall_mask):
+    """
+        Rewrite a room's faces on the given cells after an edit.
+
+        Faces that went away leave a hole of degenerate triangles which
+        is reused by the next new face, new faces go into holes or at the
+        end of the vertex array, which grows by doubling.
+
+        Returns the sorted list of slots that were written, or None if the
+        vertex array had to grow and the whole buffer needs uploading.
+    """
 
-        col,       row,       0.0, 0.0,     (9.0 - (material + 1.0))/9.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, #x-,y-
-        col + 1.0, row,       0.0, 0.0,     (9.0 - material)/9.0,         0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, #x+,y-
-        col + 1.0, row + 1.0, 0.0, 1.0/5.0, (9.0 - material)/9.0,         0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0, #x+,y+
+    members = [
+        cell for cell in cells
+        if hasCell(_room.coordinates, cell) or hasCell(_room.internalCoordinates, cell)
     ]
+    wanted = {}
+    for face, rows, cols, materials in selectFaces(members, walls, floors, ceilings, wall_mask):
+        for row, col, material in zip(rows.tolist(), cols.tolist(), materials.tolist()):
+            wanted[(face, row, col)] = material
+
+    written = []
+    for row, col in cells:
+        for face in FACE_KINDS:
+            key = (face, row, col)
+            if key in _room.faceSlots and key not in wanted:
+                slot = _room.faceSlots.pop(key)
+                _room.vertices[FACE_VERTICES * slot:FACE_VERTICES * (slot + 1)] = 0
+                _room.freeSlots.append(slot)
+                written.append(slot)
+
+    grown = False
+    for key, material in wanted.items():
+        slot = _room.faceSlots.get(key)
+        if slot is None:
+            if _room.freeSlots:
+                slot = _room.freeSlots.pop()
+            else:
+                slot = _room.vertexCount // FACE_VERTICES
+                _room.vertexCount += FACE_VERTICES
+                if _room.vertexCount > len(_room.vertices):
+                    grown = True
+                    vertices = np.zeros((max(2 * len(_room.vertices), _room.vertexCount), VERTEX_SIZE), dtype=np.float32)
+                    vertices[:len(_room.vertices)] = _room.vertices
+                    _room.vertices = vertices
+            _room.faceSlots[key] = slot
+        face, row, col = key
+        writeFaces(
+            face, [row], [col], [material],
+            _room.vertices[FACE_VERTICES * slot:FACE_VERTICES * (slot + 1)]
+        )
+        written.append(slot)
 
-    for data in vertices:
-        target.vertices.append(data)
-    
-    target.vertexCount += 6
+    if grown:
+        return None
+    return sorted(set(written))
+
+def getSlotRanges(slots):
+    """
+        Group sorted slots into runs, returned as (first, last + 1) vertex ranges.
+    """
+
+    ranges = []
+    for slot in slots:
+        if ranges and ranges[-1][1] == FACE_VERTICES * slot:
+            ranges[-1][1] += FACE_VERTICES
+        else:
+            ranges.append([FACE_VERTICES * slot, FACE_VERTICES * (slot + 1)])
+
+    return [tuple(bounds) for bounds in ranges]
 
 def getDoorByCoords(doors, coordinate):
 
@@ -512,54 +938,97 @@ def getDoorByCoords(doors, coordinate):
         if _door.coordinate == coordinate:
             return _door
 
-def getGeometryAtPoint(row, col, target, walls, floors, ceilings, wall_mask):
-
-    if wall_mask[row][col] & 1:
-        makeNorthWall(row, col, walls[row][col] - 1, target)
-                
-    if wall_mask[row][col] & 2:
-        makeEastWall(row, col, walls[row][col] - 1, target)
-                
-    if wall_mask[row][col] & 4:
-        makeSouthWall(row, col, walls[row][col] - 1, target)
+def classifyEdgeArray(edges):
+    """
+        Work out which edges are convex.
 
-    if wall_mask[row][col] & 8:
-        makeWestWall(row, col, walls[row][col] - 1, target)
-    
-    if walls[row][col] == 0:
-        makeFloor(row, col, floors[row][col] - 1, target)
-        makeCeiling(row, col, ceilings[row][col] - 1, target)
+        For each edge, in order, that isn't classified yet, find the first
+        other edge whose point_a is next to its point_b and mark both
+        with isConvex (an edge that is already marked is and-ed).
 
-def classifyEdges(edges):
+        Edges are indexed by the grid cell of their point_a, so each edge
+        only looks at the 3x3 cells around its point_b.
 
-    for _edge in edges:
+        Returns an int8 array: 1 convex, 0 not convex, -1 no neighbour found.
+    """
 
-        if _edge.convex is not None:
+    count = len(edges)
+    convex = np.full(count, -1, dtype=np.int8)
+    if count == 0:
+        return convex
+
+    #the grid only spans the edges, with a one cell border for the probes
+    point_a = edges["point_a"].astype(np.int64)
+    point_b = edges["point_b"].astype(np.int64)
+    origin = np.minimum(point_a.min(axis=0), point_b.min(axis=0)) - 1
+    point_a -= origin
+    point_b -= origin
+    height = int(max(point_a[:, 0].max(), point_b[:, 0].max())) + 2
+    width = int(max(point_a[:, 1].max(), point_b[:, 1].max())) + 2
+    ids = np.arange(count)
+
+    #cell index: the two lowest edge ids whose point_a is in each cell,
+    #writing in reverse so the lowest id is the one that sticks
+    keys = point_a[:, 0] * width + point_a[:, 1]
+    first = np.full(height * width, count, dtype=np.int64)
+    first[keys[::-1]] = ids[::-1]
+    rest = ids[first[keys] != ids]
+    second = np.full(height * width, count, dtype=np.int64)
+    second[keys[rest][::-1]] = rest[::-1]
+
+    #first edge (other than itself) next to each edge's point_b, count if none
+    match = np.full(count, count, dtype=np.int64)
+    for d_row in (-1, 0, 1):
+        for d_col in (-1, 0, 1):
+            probe = (point_b[:, 0] + d_row) * width + point_b[:, 1] + d_col
+            candidate = first[probe]
+            candidate = np.where(candidate == ids, second[probe], candidate)
+            np.minimum(match, candidate, out=match)
+
+    #an edge is skipped if an earlier edge already classified it
+    skipped = bytearray(count)
+    processed = []
+    for i, j in enumerate(match.tolist()):
+        if skipped[i] or j == count:
             continue
+        processed.append(i)
+        skipped[j] = 1
+
+    processed = np.array(processed, dtype=np.int64)
+    partners = match[processed]
+    types = edges["type"]
+    flags = (types[partners] == CONVEX_SUCCESSOR[types[processed]]).astype(np.int8)
+
+    #both edges of a pair are and-ed with the result
+    result = np.full(count, 2, dtype=np.int8)
+    np.minimum.at(result, processed, flags)
+    np.minimum.at(result, partners, flags)
+    convex[result < 2] = result[result < 2]
+
+    return convex
 
-        for _edge2 in edges:
+def toEdgeArray(edges):
+    """
+        Pack a list of edge.Edge objects into a structured edge array.
+    """
 
-            if _edge2 == _edge:
-                continue
+    result = np.empty(len(edges), dtype=edge.EDGE_DTYPE)
+    result["type"] = [_edge.type for _edge in edges]
+    result["point_a"] = [_edge.point_a for _edge in edges]
+    result["point_b"] = [_edge.point_b for _edge in edges]
 
-            row_check = abs(_edge.point_b[0] - _edge2.point_a[0]) <= 1
-            col_check = abs(_edge.point_b[1] - _edge2.point_a[1]) <= 1
+    return result
 
-            if row_check and col_check:
-                convex = isConvex(_edge.type, _edge2.type)
+def classifyEdges(edges):
+    """
+        Set the convex flag of a list of edge.Edge objects,
+        see classifyEdgeArray.
+    """
 
-                if _edge.convex is None:
-                    _edge.convex = convex
-                else:
-                    _edge.convex = _edge.convex and convex
+    flags = classifyEdgeArray(toEdgeArray(edges))
 
-                if _edge2.convex is None:
-                    _edge2.convex = convex
-                else:
-                    _edge2.convex = _edge2.convex and convex
-                #print(f"Edge {_edge.id} connects to edge {_edge2.id}")
-                #print(f"convex: {convex}")
-                break
+    for _edge, flag in zip(edges, flags.tolist()):
+        _edge.convex = None if flag < 0 else bool(flag)
 
 def isConvex(type_1, type_2):
 
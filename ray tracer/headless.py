@@ -0,0 +1,180 @@
+import os
+#pick the offscreen platforms before pygame and PyOpenGL load
+os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import sys
+import ctypes
+from OpenGL import EGL
+from common import *
+import engine
+import scene
+
+"""
+    Rendering without a window, for render boxes and CI.
+
+    An EGL context (OpenGL 4.3 core, no surface) is made current and the
+    engine draws its final image into a framebuffer object instead of the
+    window, which render_frame reads back. It runs on Mesa's llvmpipe
+    with no GPU. PyOpenGL only picks EGL if it is told before it loads,
+    so import this module before anything else which imports OpenGL.
+
+    Run from the repository root to save a frame:
+
+        python "ray tracer/headless.py" frame.png
+"""
+
+def makeContext():
+    """
+        Make a surfaceless OpenGL 4.3 core context current.
+        Returns the (display, context) pair.
+    """
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    if not EGL.eglInitialize(display, None, None):
+        raise RuntimeError("could not initialize an EGL display")
+
+    config = EGL.EGLConfig()
+    count = EGL.EGLint()
+    attributes = (EGL.EGLint * 5)(
+        EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+        EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE
+    )
+    EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count))
+    if count.value == 0:
+        raise RuntimeError("no EGL config renders OpenGL")
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+
+    contextAttributes = (EGL.EGLint * 7)(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, 4, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE
+    )
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, contextAttributes)
+    if context == EGL.EGL_NO_CONTEXT:
+        raise RuntimeError("could not create an OpenGL 4.3 core context")
+    EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context)
+
+    return display, context
+
+class HeadlessRenderer:
+    """
+        Draws a scene offscreen and hands back the frames as arrays.
+    """
+
+    def __init__(self, width=640, height=None, greedy_meshing=False, scene_args=None, **engine_args):
+        """
+            Make the context, the output framebuffer, the engine and the scene.
+
+                Parameters:
+                    width (int): width of the image
+                    height (int): height of the image, 3/4 of the width if not given
+                    greedy_meshing (bool): passed to scene.Scene
+                    scene_args (dict): more arguments for scene.Scene, such as a map
+                    engine_args: passed to engine.Engine
+        """
+
+        self.width = width
+        self.height = height if (height is not None and height > 0) else 3 * width // 4
+        self.display, self.context = makeContext()
+
+        #pygame wants a display, a dummy one will do
+        pg.init()
+        pg.display.set_mode((1, 1))
+
+        self.outputTexture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.outputTexture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        self.outputBuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.outputBuffer)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.outputTexture, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+        self.graphicsEngine = engine.Engine(
+            self.width, self.height, output_framebuffer=self.outputBuffer, **engine_args
+        )
+        self.scene = scene.Scene(greedy_meshing=greedy_meshing, **(scene_args or {}))
+        self.time = 0.0
+
+    def render_frame(self, camera_pose, t):
+        """
+            Draw the scene at a time from a camera pose.
+
+                Parameters:
+                    camera_pose (tuple): (position, theta, phi), the camera's
+                        position and its turn and tilt in degrees
+                    t (float): time in seconds, the lights and spheres
+                        move to where they are then (back too)
+
+                Returns:
+                    a (height, width, 3) uint8 array, top row first
+        """
+
+        self.draw(camera_pose, t)
+        return self.readImage()
+
+    def draw(self, camera_pose, t):
+        """
+            render_frame without reading the image back.
+        """
+
+        position, theta, phi = camera_pose
+        self.scene.camera.posArray = np.array(position, dtype=np.float32)
+        self.scene.camera.theta = theta
+        self.scene.camera.phi = phi
+        self.scene.camera.recalculateCameraVectors()
+
+        self.scene.update(rate = (t - self.time) / scene.SCENE_FRAME_TIME)
+        self.time = t
+
+        self.graphicsEngine.renderScene(self.scene)
+
+    def reset(self):
+        """
+            Put every light and sphere back where it starts, at time 0.
+        """
+
+        rooms = self.scene.rooms
+        for _light in self.scene.lights + [_light for _room in rooms for _light in _room.lights]:
+            _light.t = 0
+            _light.update(0)
+        for _sphere in self.scene.spheres + [_sphere for _room in rooms for _sphere in _room.spheres]:
+            _sphere.t = 0
+            _sphere.update(0)
+        self.scene.outDated = True
+        self.time = 0.0
+
+    def readImage(self):
+        """
+            The last frame drawn, a (height, width, 3) uint8 array.
+        """
+
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.outputBuffer)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_UNSIGNED_BYTE)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+        #OpenGL's rows run bottom up
+        return np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 3)[::-1].copy()
+
+    def destroy(self):
+
+        self.graphicsEngine.destroy()
+        glDeleteFramebuffers(1, (self.outputBuffer,))
+        glDeleteTextures(1, (self.outputTexture,))
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglTerminate(self.display)
+        pg.quit()
+
+def saveImage(image, path):
+    """
+        Save a (height, width, 3) uint8 array with pygame.
+    """
+
+    pg.image.save(pg.surfarray.make_surface(np.ascontiguousarray(image.swapaxes(0, 1))), path)
+
+if __name__ == "__main__":
+    renderer = HeadlessRenderer()
+    camera = renderer.scene.camera
+    image = renderer.render_frame((camera.posArray, camera.theta, camera.phi), 0.0)
+    saveImage(image, sys.argv[1] if len(sys.argv) > 1 else "frame.png")
+    renderer.destroy()
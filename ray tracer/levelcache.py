@@ -0,0 +1,188 @@
+import hashlib
+import os
+import shutil
+import elements
+from elements import *
+import geometry
+
+"""
+    On-disk cache of built levels.
+
+    A level is stored under a hash of its wall, floor and ceiling matrices,
+    the build options and geometry.GEOMETRY_VERSION. Each entry is a folder
+    holding the small tables in level.npz and the vertex data in .npy files,
+    which are memory-mapped when the level is loaded.
+"""
+
+CACHE_FOLDER = "ray tracer/cache"
+#bump whenever the tables stored in an entry change
+CACHE_VERSION = 2
+
+def getArrayKey(prefix, arrays):
+    """
+        Hash a string followed by the shapes, types and contents of arrays.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(prefix.encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def getLevelKey(scene):
+    """
+        Hash everything the built level depends on.
+    """
+
+    return getArrayKey(
+        f"cache {CACHE_VERSION} geometry {geometry.GEOMETRY_VERSION} greedy {scene.greedy_meshing}",
+        [
+            np.asarray(array, dtype=np.int32)
+            for array in (scene.wall_array, scene.floor_array, scene.ceiling_array)
+        ]
+    )
+
+def getOffsets(groups):
+    """
+        Start index of each group in the concatenation of all groups,
+        plus the total length.
+    """
+
+    return np.concatenate(([0], np.cumsum([len(group) for group in groups]))).astype(np.int64)
+
+def toCells(coordinates):
+    """
+        A list of (row, col) tuples as an (n, 2) int32 array.
+    """
+
+    return np.array(coordinates, dtype=np.int32).reshape(-1, 2)
+
+def toCoordinates(cells):
+    """
+        Inverse of toCells.
+    """
+
+    return [tuple(cell) for cell in cells.tolist()]
+
+def saveLevel(scene, folder=CACHE_FOLDER):
+    """
+        Store the rooms, doors and planes built by Scene.make_level.
+    """
+
+    rooms = scene.rooms
+    doors = scene.doors
+    door_index = {id(_door): i for i, _door in enumerate(doors)}
+    room_index = {id(_room): i for i, _room in enumerate(rooms)}
+    lookup = list(scene.room_lookup.items())
+
+    tables = {
+        "room_vertex_offsets": getOffsets([_room.vertices[:_room.vertexCount] for _room in rooms]),
+        "room_plane_offsets": getOffsets([_room.planes for _room in rooms]),
+        "planes": np.concatenate(
+            [packPlanes(_room.planes) for _room in rooms] + [np.zeros((0, PLANE_SIZE), dtype=np.float32)]
+        ),
+        "wall_offsets": getOffsets([_room.coordinates for _room in rooms]),
+        "wall_cells": toCells([cell for _room in rooms for cell in _room.coordinates]),
+        "internal_offsets": getOffsets([_room.internalCoordinates for _room in rooms]),
+        "internal_cells": toCells([cell for _room in rooms for cell in _room.internalCoordinates]),
+        "room_door_offsets": getOffsets([_room.doors for _room in rooms]),
+        "room_doors": np.array(
+            [door_index[id(_door)] for _room in rooms for _door in _room.doors], dtype=np.int32
+        ),
+        "door_cells": toCells([_door.coordinate for _door in doors]),
+        "door_vertex_offsets": getOffsets([_door.vertices for _door in doors]),
+        "lookup_cells": toCells([cell for cell, _ in lookup]),
+        "lookup_rooms": np.array([room_index[id(_room)] for _, _room in lookup], dtype=np.int32),
+        "room_grid": scene.room_grid,
+        "mesh_report": np.array(scene.mesh_report, dtype=np.int64).reshape(-1, 2),
+        "plane_report": np.array(scene.plane_report, dtype=np.int64).reshape(-1, 2),
+    }
+
+    empty = np.zeros((0, VERTEX_SIZE), dtype=np.float32)
+    path = os.path.join(folder, getLevelKey(scene))
+    #write to a scratch folder and move it into place, so a crash never leaves half an entry
+    scratch = path + ".tmp"
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+    np.savez(os.path.join(scratch, "level.npz"), **tables)
+    np.save(os.path.join(scratch, "vertices.npy"), np.concatenate([empty] + [_room.vertices[:_room.vertexCount] for _room in rooms]))
+    np.save(os.path.join(scratch, "door_vertices.npy"), np.concatenate([empty] + [_door.vertices for _door in doors]))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(scratch, path)
+
+def loadLevel(scene, folder=CACHE_FOLDER):
+    """
+        Fill the scene's rooms, doors, planes and room lookups from the cache.
+        Returns False if this level hasn't been cached.
+    """
+
+    path = os.path.join(folder, getLevelKey(scene))
+    if not os.path.isdir(path):
+        return False
+
+    with np.load(os.path.join(path, "level.npz")) as level:
+        tables = {name: level[name] for name in level.files}
+    vertices = np.load(os.path.join(path, "vertices.npy"), mmap_mode="r")
+    door_vertices = np.load(os.path.join(path, "door_vertices.npy"), mmap_mode="r")
+
+    offsets = tables["door_vertex_offsets"]
+    for i, coordinate in enumerate(toCoordinates(tables["door_cells"])):
+        _door = elements.Door(coordinate)
+        _door.vertices = door_vertices[offsets[i]:offsets[i + 1]]
+        _door.vertexCount = len(_door.vertices)
+        scene.doors.append(_door)
+
+    planes = unpackPlanes(tables["planes"])
+    wall_cells = toCoordinates(tables["wall_cells"])
+    internal_cells = toCoordinates(tables["internal_cells"])
+    for i in range(len(tables["room_vertex_offsets"]) - 1):
+        _room = elements.Room()
+        start, end = tables["room_vertex_offsets"][i:i + 2]
+        _room.vertices = vertices[start:end]
+        _room.vertexCount = len(_room.vertices)
+        start, end = tables["room_plane_offsets"][i:i + 2]
+        _room.planes = planes[start:end]
+        start, end = tables["wall_offsets"][i:i + 2]
+        _room.coordinates = wall_cells[start:end]
+        start, end = tables["internal_offsets"][i:i + 2]
+        _room.internalCoordinates = internal_cells[start:end]
+        start, end = tables["room_door_offsets"][i:i + 2]
+        _room.doors = [scene.doors[j] for j in tables["room_doors"][start:end].tolist()]
+        scene.rooms.append(_room)
+
+    scene.room_lookup = {
+        cell: scene.rooms[i]
+        for cell, i in zip(toCoordinates(tables["lookup_cells"]), tables["lookup_rooms"].tolist())
+    }
+    scene.index_rooms(tables["room_grid"])
+    scene.mesh_report = [tuple(row) for row in tables["mesh_report"].tolist()]
+    scene.plane_report = [tuple(row) for row in tables["plane_report"].tolist()]
+    scene.active_rooms = [scene.rooms[0], ]
+
+    return True
+
+def saveLightmap(key, table, atlas, folder=CACHE_FOLDER):
+    """
+        Store a baked lightmap (see lightmap.getLightmap) next to the levels.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"lightmap-{key}.npz")
+    #np.savez adds .npz to names without it
+    scratch = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(scratch, table=table, atlas=atlas)
+    os.replace(scratch, path)
+
+def loadLightmap(key, folder=CACHE_FOLDER):
+    """
+        Returns the (table, atlas) stored under key, None if there isn't one.
+    """
+
+    path = os.path.join(folder, f"lightmap-{key}.npz")
+    if not os.path.isfile(path):
+        return None
+
+    with np.load(path) as lightmap:
+        return lightmap["table"], lightmap["atlas"]
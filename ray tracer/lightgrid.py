@@ -0,0 +1,84 @@
+from elements import *
+
+"""
+    Per cell light lists for the ray tracer.
+
+    A light adds at most 2 * strength * brightest channel / d² to a pixel
+    (diffuse and specular each reach 1), so past its influence radius it
+    adds less than LIGHT_CUTOFF and is left out. Every frame the lights are
+    binned into the cells of the wall grid their radius reaches. The shader
+    reads a (first, count) row for the pixel's cell and only shades the
+    lights listed there.
+"""
+
+#contributions below this are dropped, one step of an 8 bit channel
+LIGHT_CUTOFF = 1 / 255
+
+#one cell of the light grid, the shader's PackedLightCell struct:
+#its lights are indices [first, first + count) of the light index list
+CELL_LAYOUT = np.dtype([("first", np.int32), ("count", np.int32)])
+#one entry of the light index list, the shader's PackedLightIndex struct
+INDEX_LAYOUT = np.dtype([("light", np.int32)])
+
+def getInfluenceRadii(lights):
+    """
+        Distance at which each light's contribution falls below LIGHT_CUTOFF.
+    """
+
+    if not lights:
+        return np.zeros(0, dtype=np.float32)
+
+    brightness = np.array([_light.strength * np.max(_light.color) for _light in lights], dtype=np.float64)
+    return np.sqrt(2 * np.maximum(brightness, 0) / LIGHT_CUTOFF).astype(np.float32)
+
+def binLights(positions, radii, shape):
+    """
+        List the lights reaching each cell of a grid.
+
+            Parameters:
+                positions (array): (count, 3) light positions, x is the column and y the row
+                radii (array): (count,) influence radii
+                shape (tuple): (rows, cols) of the grid
+
+            Returns:
+                cells: (rows * cols) array of CELL_LAYOUT, row-major
+                indices: array of INDEX_LAYOUT, the lights of each cell in
+                    increasing order, cell after cell
+    """
+
+    rows, cols = shape
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64)
+
+    #box of cells around each light, clipped to the grid
+    lower = np.floor(positions[:, :2] - radii[:, None]).astype(np.int64)
+    upper = np.floor(positions[:, :2] + radii[:, None]).astype(np.int64)
+    lower = np.maximum(lower, 0)
+    upper = np.minimum(upper, (cols - 1, rows - 1))
+    widths = np.maximum(upper - lower + 1, 0)
+    sizes = widths[:, 0] * widths[:, 1]
+
+    #one candidate per light and cell of its box
+    light = np.repeat(np.arange(len(positions)), sizes)
+    local = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    col = lower[light, 0] + local % np.maximum(widths[light, 0], 1)
+    row = lower[light, 1] + local // np.maximum(widths[light, 0], 1)
+
+    #keep the cells whose square comes within the radius
+    nearest_x = np.clip(positions[light, 0], col, col + 1)
+    nearest_y = np.clip(positions[light, 1], row, row + 1)
+    distance2 = (nearest_x - positions[light, 0]) ** 2 + (nearest_y - positions[light, 1]) ** 2
+    keep = distance2 <= radii[light] ** 2
+    cell = (row * cols + col)[keep]
+    light = light[keep]
+
+    #candidates are in light order, a stable sort keeps it within each cell
+    order = np.argsort(cell, kind="stable")
+    counts = np.bincount(cell, minlength=rows * cols)
+
+    cells = np.zeros(rows * cols, dtype=CELL_LAYOUT)
+    cells["count"] = counts
+    cells["first"] = np.cumsum(counts) - counts
+    indices = np.zeros(len(order), dtype=INDEX_LAYOUT)
+    indices["light"] = light[order]
+    return cells, indices
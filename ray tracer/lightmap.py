@@ -0,0 +1,290 @@
+from elements import *
+import geometry
+import levelcache
+import lightgrid
+import occlusion
+import visibility
+
+"""
+    Lightmaps for lights which never move.
+
+    Every surface of a level lies on a side of an open (or door) cell: its
+    floor, its ceiling, or one of its four walls. Each of those sides which
+    has a surface gets a tile of TILE_SIZE x TILE_SIZE texels in an atlas,
+    holding the diffuse light of the static lights there, shadowed by the
+    walls (occlusion.walkGrid). Merged quads span several cells, so tiles
+    aren't tied to vertices: the g-buffer pass finds the tile from the
+    fragment's position and face normal in a table of tile indices per cell
+    and side, and writes the light it reads into g3 for light_fragment,
+    which then leaves the static lights out.
+
+    Normal maps and specular highlights are lost for static lights, spheres
+    cast no shadows from them and surfaces off the sides of cells (door
+    panels, spheres) get none of their light. Bakes are stored in the level cache
+    folder under a hash of the walls, the static lights and LIGHTMAP_VERSION.
+    sampleLightmap is the NumPy version of the g-buffer shader's lookup.
+"""
+
+#bump whenever the baked values change
+LIGHTMAP_VERSION = 1
+
+#texels per cell along each side of a tile
+TILE_SIZE = 8
+
+#sides of a cell, in the order of the tile table. A side's surface faces into the cell
+SIDE_FLOOR = 0
+SIDE_CEILING = 1
+SIDE_NORTH = 2
+SIDE_EAST = 3
+SIDE_SOUTH = 4
+SIDE_WEST = 5
+SIDE_COUNT = 6
+
+#neighbour beyond each wall side, as (row, col) offsets
+SIDE_OFFSETS = {
+    SIDE_NORTH: (-1, 0), SIDE_EAST: (0, 1), SIDE_SOUTH: (1, 0), SIDE_WEST: (0, -1),
+}
+
+#texture units of the g-buffer pass, the material atlas uses 0
+LIGHTMAP_UNIT = 1
+TILE_TABLE_UNIT = 2
+
+def getStaticLights(scene):
+    """
+        Every light which never moves, global or in an active room.
+    """
+
+    lights = scene.lights + [_light for _room in scene.active_rooms for _light in _room.lights]
+    return [_light for _light in lights if not visibility.isMoving(_light)]
+
+def getTileTable(walls):
+    """
+        Give a tile to each side of the open and door cells which has a
+        surface: every floor and ceiling, and the walls towards a cell that
+        isn't empty (a block, a door or the edge of the map).
+
+        Returns a (rows, cols, SIDE_COUNT) int32 table of tile indices,
+        -1 for no tile, numbered in row-major order.
+    """
+
+    walls = geometry.toWallArray(walls)
+    rows, cols = walls.shape
+    open_cells = (walls == 0) | (walls == geometry.DOOR)
+    padded = np.ones((rows + 2, cols + 2), dtype=bool)
+    padded[1:-1, 1:-1] = walls != 0
+
+    has_tile = np.zeros((rows, cols, SIDE_COUNT), dtype=bool)
+    has_tile[:, :, SIDE_FLOOR] = open_cells
+    has_tile[:, :, SIDE_CEILING] = open_cells
+    for side, (d_row, d_col) in SIDE_OFFSETS.items():
+        has_tile[:, :, side] = open_cells & padded[1 + d_row:rows + 1 + d_row, 1 + d_col:cols + 1 + d_col]
+
+    table = np.full(has_tile.shape, -1, dtype=np.int32)
+    table[has_tile] = np.arange(np.count_nonzero(has_tile), dtype=np.int32)
+    return table
+
+def getSidePoints(rows, cols, sides, s, t):
+    """
+        World positions and normals of the points (s, t) on the given sides
+        of cells, s and t from 0 to 1 across the side.
+    """
+
+    count = len(sides)
+    positions = np.zeros((count, 3))
+    normals = np.zeros((count, 3))
+    for side, x, y, z, normal in (
+        (SIDE_FLOOR, cols + s, rows + t, 0.0, (0, 0, 1)),
+        (SIDE_CEILING, cols + s, rows + t, 1.0, (0, 0, -1)),
+        (SIDE_NORTH, cols + s, rows + 0.0, t, (0, 1, 0)),
+        (SIDE_SOUTH, cols + s, rows + 1.0, t, (0, -1, 0)),
+        (SIDE_WEST, cols + 0.0, rows + s, t, (1, 0, 0)),
+        (SIDE_EAST, cols + 1.0, rows + s, t, (-1, 0, 0)),
+    ):
+        mask = sides == side
+        positions[mask] = np.column_stack(np.broadcast_arrays(x, y, z))[mask]
+        normals[mask] = normal
+    return positions, normals
+
+def getAtlasColumns(tile_count):
+    """
+        Tiles per row of a roughly square atlas.
+    """
+
+    return max(1, int(np.ceil(np.sqrt(tile_count))))
+
+def bakeLightmap(walls, lights, tile_size=TILE_SIZE):
+    """
+        Bake the diffuse light of lights onto the surfaces of a wall grid.
+
+            Parameters:
+                walls (matrix): the level's wall grid
+                lights (list): the static lights
+                tile_size (int): texels per cell along a tile's side
+
+            Returns:
+                (table, atlas): the tile table from getTileTable and the
+                float32 atlas of shape (tile rows * tile_size,
+                getAtlasColumns(tiles) * tile_size, 3)
+    """
+
+    table = getTileTable(walls)
+    solid = occlusion.getSolidGrid(walls)
+    rows, cols, sides = np.nonzero(table >= 0)
+    tile_count = len(rows)
+    columns = getAtlasColumns(tile_count)
+    tile_rows = -(-tile_count // columns)
+
+    #one point per texel centre, tiles in table order, texels row by row
+    texel_t, texel_s = np.divmod(np.arange(tile_size * tile_size), tile_size)
+    tile = np.repeat(np.arange(tile_count), tile_size * tile_size)
+    s = np.tile((texel_s + 0.5) / tile_size, tile_count)
+    t = np.tile((texel_t + 0.5) / tile_size, tile_count)
+    positions, normals = getSidePoints(rows[tile], cols[tile], sides[tile], s, t)
+
+    light = np.zeros((len(positions), 3))
+    for _light, reach in zip(lights, lightgrid.getInfluenceRadii(lights)):
+        directions = _light.center - positions
+        distances = np.linalg.norm(directions, axis=1)
+        directions /= np.maximum(distances, 1e-9)[:, None]
+        facing = np.einsum("ij,ij->i", normals, directions)
+        lit = np.flatnonzero((facing > 0) & (distances < reach))
+        lit = lit[~occlusion.walkGrid(solid, positions[lit], directions[lit], distances[lit])]
+        light[lit] += (
+            _light.color[None, :] * _light.strength * (facing[lit] / distances[lit] ** 2)[:, None]
+        )
+
+    atlas = np.zeros((tile_rows * tile_size, columns * tile_size, 3), dtype=np.float32)
+    atlas_row = (tile // columns) * tile_size + texel_t[np.arange(len(tile)) % (tile_size * tile_size)]
+    atlas_col = (tile % columns) * tile_size + texel_s[np.arange(len(tile)) % (tile_size * tile_size)]
+    atlas[atlas_row, atlas_col] = light
+    return table, atlas
+
+def getLightmapKey(scene, lights, tile_size=TILE_SIZE):
+    """
+        Hash everything a bake depends on: the walls, the lights and the tile size.
+    """
+
+    return levelcache.getArrayKey(
+        f"lightmap {LIGHTMAP_VERSION} tile {tile_size}",
+        [scene.wall_array] + [
+            np.concatenate((_light.center, _light.color, [_light.strength])) for _light in lights
+        ]
+    )
+
+def getLightmap(scene, lights, tile_size=TILE_SIZE):
+    """
+        The scene's lightmap, from the level cache if it was baked before.
+    """
+
+    key = getLightmapKey(scene, lights, tile_size)
+    if scene.use_level_cache:
+        cached = levelcache.loadLightmap(key)
+        if cached is not None:
+            return cached
+
+    table, atlas = bakeLightmap(scene.wall_array, lights, tile_size)
+    if scene.use_level_cache:
+        levelcache.saveLightmap(key, table, atlas)
+    return table, atlas
+
+def sampleLightmap(table, atlas, positions, normals, tile_size=TILE_SIZE):
+    """
+        Read the light at surface points with face normals, blending the
+        four nearest texels of their tile as the g-buffer shader does.
+        Points on sides without a tile get none.
+    """
+
+    positions = np.asarray(positions, dtype=np.float64)
+    normals = np.asarray(normals, dtype=np.float64)
+    rows, cols = table.shape[:2]
+
+    side = np.select(
+        [normals[:, 2] > 0.5, normals[:, 2] < -0.5, normals[:, 1] > 0.5,
+         normals[:, 1] < -0.5, normals[:, 0] > 0.5],
+        [SIDE_FLOOR, SIDE_CEILING, SIDE_NORTH, SIDE_SOUTH, SIDE_WEST], SIDE_EAST
+    )
+    cell = np.floor(positions[:, :2] + 0.01 * normals[:, :2]).astype(np.int64)
+    col = np.clip(cell[:, 0], 0, cols - 1)
+    row = np.clip(cell[:, 1], 0, rows - 1)
+    s = np.where(np.isin(side, (SIDE_WEST, SIDE_EAST)), positions[:, 1] - row, positions[:, 0] - col)
+    t = np.where(np.isin(side, (SIDE_FLOOR, SIDE_CEILING)), positions[:, 1] - row, positions[:, 2])
+    tile = table[row, col, side]
+
+    columns = atlas.shape[1] // tile_size
+    x = (np.maximum(tile, 0) % columns) * tile_size + np.clip(s * tile_size, 0.5, tile_size - 0.5) - 0.5
+    y = (np.maximum(tile, 0) // columns) * tile_size + np.clip(t * tile_size, 0.5, tile_size - 0.5) - 0.5
+    x0 = np.minimum(np.floor(x).astype(np.int64), atlas.shape[1] - 2)
+    y0 = np.minimum(np.floor(y).astype(np.int64), atlas.shape[0] - 2)
+    fx = (x - x0)[:, None]
+    fy = (y - y0)[:, None]
+
+    light = (
+        (1 - fy) * ((1 - fx) * atlas[y0, x0] + fx * atlas[y0, x0 + 1])
+        + fy * ((1 - fx) * atlas[y0 + 1, x0] + fx * atlas[y0 + 1, x0 + 1])
+    )
+    return np.where((tile >= 0)[:, None], light, 0)
+
+class Lightmap:
+    """
+        The baked light of the scene's static lights, as textures for the
+        g-buffer pass. Baked again when the blocks or static lights change.
+    """
+
+    def __init__(self, tile_size=TILE_SIZE):
+
+        self.tileSize = tile_size
+        self.atlasTexture = None
+        self.tableTexture = None
+        self.columns = 1
+        self.key = None
+
+    def upload(self, scene):
+        """
+            Bake (or load) and send the lightmap if anything it depends on changed.
+        """
+
+        lights = getStaticLights(scene)
+        key = (scene.planeVersion, tuple(
+            (tuple(_light.center.tolist()), tuple(_light.color.tolist()), _light.strength)
+            for _light in lights
+        ))
+        if key == self.key and self.atlasTexture is not None:
+            return
+        self.key = key
+
+        table, atlas = getLightmap(scene, lights, self.tileSize)
+        self.columns = atlas.shape[1] // self.tileSize
+        rows, cols = table.shape[:2]
+
+        if self.atlasTexture is None:
+            self.atlasTexture, self.tableTexture = glGenTextures(2)
+
+        glBindTexture(GL_TEXTURE_2D, self.atlasTexture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB32F, atlas.shape[1], atlas.shape[0], 0, GL_RGB, GL_FLOAT, np.ascontiguousarray(atlas))
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+
+        glBindTexture(GL_TEXTURE_2D, self.tableTexture)
+        glTexImage2D(
+            GL_TEXTURE_2D, 0, GL_R32I, cols * SIDE_COUNT, rows, 0, GL_RED_INTEGER, GL_INT,
+            np.ascontiguousarray(table.reshape(rows, cols * SIDE_COUNT))
+        )
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+
+    def bind(self):
+
+        glActiveTexture(GL_TEXTURE0 + LIGHTMAP_UNIT)
+        glBindTexture(GL_TEXTURE_2D, self.atlasTexture)
+        glActiveTexture(GL_TEXTURE0 + TILE_TABLE_UNIT)
+        glBindTexture(GL_TEXTURE_2D, self.tableTexture)
+        glActiveTexture(GL_TEXTURE0)
+
+    def destroy(self):
+
+        if self.atlasTexture is not None:
+            glDeleteTextures(2, (self.atlasTexture, self.tableTexture))
+            self.atlasTexture = None
+            self.tableTexture = None
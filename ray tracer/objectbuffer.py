@@ -0,0 +1,412 @@
+from elements import *
+import re
+import bvh
+import lightgrid
+import occlusion
+import visibility
+
+"""
+    Shader storage buffers for the ray tracer's spheres, planes, lights,
+    bvh nodes, per cell light lists and baked light visibility.
+
+    Each type has its own buffer, an array of a tightly packed std430
+    struct declared in shaders/rayTracer.txt (PackedSphere, PackedPlane,
+    PackedLight, PackedNode, PackedLightCell, PackedLightIndex,
+    PackedVolume and PackedVisibility). The rows are kept in NumPy arrays and
+    compared as they are written, so only rows which actually changed are
+    uploaded again. Buffers double in size when a scene outgrows them.
+"""
+
+#field layouts of the shader's PackedSphere, PackedPlane and PackedLight structs
+SPHERE_LAYOUT = np.dtype([
+    ("center", np.float32, (3,)), ("radius", np.float32),
+    ("color", np.float32, (3,)), ("roughness", np.float32),
+])
+#the same floats as elements.packPlanes
+PLANE_LAYOUT = np.dtype([
+    ("center", np.float32, (3,)), ("tangent", np.float32, (3,)),
+    ("bitangent", np.float32, (3,)), ("normal", np.float32, (3,)),
+    ("uMin", np.float32), ("uMax", np.float32), ("vMin", np.float32), ("vMax", np.float32),
+    ("material", np.float32),
+])
+#influence is the radius from lightgrid.getInfluenceRadii
+LIGHT_LAYOUT = np.dtype([
+    ("position", np.float32, (3,)), ("color", np.float32, (3,)), ("strength", np.float32),
+    ("influence", np.float32),
+])
+
+#storage buffer binding points, as in the shader
+SPHERE_BINDING = 0
+PLANE_BINDING = 1
+LIGHT_BINDING = 2
+NODE_BINDING = 3
+LIGHT_CELL_BINDING = 4
+LIGHT_INDEX_BINDING = 5
+VOLUME_BINDING = 6
+VISIBILITY_BINDING = 7
+
+#lights baked per frame once the first frame is done, the rest cast shadow rays meanwhile
+BAKES_PER_FRAME = 4
+
+#dirty rows closer than this are uploaded in one call
+ROW_GAP = 16
+
+#(alignment, size) in bytes of the std430 types the packed structs use
+STD430_TYPES = {
+    "float": (4, 4), "int": (4, 4), "uint": (4, 4),
+    "vec2": (8, 8), "vec3": (16, 12), "vec4": (16, 16),
+}
+
+def packSpheres(spheres):
+    """
+        Pack spheres into a (count, 8) float32 array, laid out as SPHERE_LAYOUT.
+    """
+
+    data = np.zeros((len(spheres), SPHERE_LAYOUT.itemsize // 4), dtype=np.float32)
+    if spheres:
+        data[:, 0:3] = [_sphere.center for _sphere in spheres]
+        data[:, 3] = [_sphere.radius for _sphere in spheres]
+        data[:, 4:7] = [_sphere.color for _sphere in spheres]
+        data[:, 7] = [_sphere.roughness for _sphere in spheres]
+    return data
+
+def packLights(lights):
+    """
+        Pack lights into a (count, 8) float32 array, laid out as LIGHT_LAYOUT.
+    """
+
+    data = np.zeros((len(lights), LIGHT_LAYOUT.itemsize // 4), dtype=np.float32)
+    if lights:
+        data[:, 0:3] = [_light.position for _light in lights]
+        data[:, 3:6] = [_light.color for _light in lights]
+        data[:, 6] = [_light.strength for _light in lights]
+        data[:, 7] = lightgrid.getInfluenceRadii(lights)
+    return data
+
+def getRowRanges(rows, gap=ROW_GAP):
+    """
+        Group sorted row indices into (first, last) ranges,
+        joining rows less than gap apart.
+    """
+
+    if len(rows) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(rows) >= gap) + 1
+    firsts = rows[np.concatenate(([0], breaks))]
+    lasts = rows[np.concatenate((breaks - 1, [len(rows) - 1]))] + 1
+    return list(zip(firsts.tolist(), lasts.tolist()))
+
+def roundUp(value, alignment):
+    """
+        Round value up to a multiple of alignment.
+    """
+
+    return -(-value // alignment) * alignment
+
+def getStd430Layout(source, name):
+    """
+        Work out the std430 member offsets of a struct in GLSL source.
+        Handles the scalar, vector and array members used by the packed
+        structs, one declaration per statement, several names allowed.
+
+        Returns ({member: offset}, size), in bytes.
+    """
+
+    match = re.search(r"struct\s+" + name + r"\s*\{(.*?)\}\s*;", re.sub(r"//.*", "", source), re.S)
+    if match is None:
+        raise ValueError(f"struct {name} not found in shader source")
+
+    offsets = {}
+    offset = 0
+    struct_alignment = 4
+    for declaration in match.group(1).split(";"):
+        if not declaration.strip():
+            continue
+        type_name, names = declaration.split(None, 1)
+        alignment, size = STD430_TYPES[type_name]
+        for member in names.split(","):
+            array = re.fullmatch(r"\s*(\w+)\s*\[\s*(\d+)\s*\]\s*", member)
+            if array is None:
+                member, member_size = member.strip(), size
+            else:
+                member, member_size = array.group(1), roundUp(size, alignment) * int(array.group(2))
+            offset = roundUp(offset, alignment)
+            offsets[member] = offset
+            offset += member_size
+        struct_alignment = max(struct_alignment, alignment)
+
+    return offsets, roundUp(offset, struct_alignment)
+
+def checkLayout(source, name, layout):
+    """
+        Raise a ValueError unless struct name in the shader source has
+        the same member offsets and size as the NumPy layout.
+    """
+
+    offsets, size = getStd430Layout(source, name)
+    expected = {field: layout.fields[field][1] for field in layout.names}
+    if offsets != expected or size != layout.itemsize:
+        raise ValueError(
+            f"{name} is {offsets} ({size} bytes) in the shader, "
+            f"but {expected} ({layout.itemsize} bytes) on the CPU"
+        )
+
+def checkLayouts(source):
+    """
+        Check all the packed structs of the ray tracer shader source.
+    """
+
+    for name, layout in (
+        ("PackedSphere", SPHERE_LAYOUT), ("PackedPlane", PLANE_LAYOUT),
+        ("PackedLight", LIGHT_LAYOUT), ("PackedNode", bvh.NODE_LAYOUT),
+        ("PackedLightCell", lightgrid.CELL_LAYOUT), ("PackedLightIndex", lightgrid.INDEX_LAYOUT),
+        ("PackedVolume", visibility.VOLUME_LAYOUT), ("PackedVisibility", visibility.WORD_LAYOUT)
+    ):
+        checkLayout(source, name, layout)
+
+class ObjectBuffer:
+    """
+        CPU copy of one shader storage buffer, with the rows changed
+        since the last upload. No OpenGL calls are made before upload.
+    """
+
+    def __init__(self, layout, binding, capacity=64):
+        """
+            Make an empty buffer.
+
+                Parameters:
+                    layout (np.dtype): the packed struct of one row
+                    binding (int): storage buffer binding point in the shader
+                    capacity (int): rows to start with, doubled as needed
+        """
+
+        self.layout = layout
+        self.binding = binding
+        #rows are kept as raw 32 bit words, layouts can mix floats and ints
+        self.data = np.zeros((capacity, layout.itemsize // 4), dtype=np.uint32)
+        self.dirtyRows = []
+        #the whole buffer has to be allocated again
+        self.resized = True
+        self.ssbo = None
+
+    def write(self, first, rows):
+        """
+            Store rows starting at row first, noting the ones which changed.
+            rows can be a 2D float32 array or an array of the buffer's layout.
+        """
+
+        rows = np.ascontiguousarray(rows).view(np.uint32).reshape(len(rows), self.data.shape[1])
+        last = first + len(rows)
+        if last > len(self.data):
+            capacity = len(self.data)
+            while capacity < last:
+                capacity *= 2
+            data = np.zeros((capacity, self.data.shape[1]), dtype=np.uint32)
+            data[:len(self.data)] = self.data
+            self.data = data
+            self.resized = True
+
+        block = self.data[first:last]
+        changed = np.flatnonzero(np.any(block != rows, axis=1))
+        if len(changed) > 0:
+            block[changed] = rows[changed]
+            self.dirtyRows.append(changed + first)
+
+    def getRows(self, count):
+        """
+            The first count rows, as records of the buffer's layout.
+        """
+
+        return np.ascontiguousarray(self.data[:count]).view(self.layout).reshape(count)
+
+    def getDirtyRanges(self):
+        """
+            The (first, last) row ranges changed since the last upload.
+        """
+
+        if not self.dirtyRows:
+            return []
+        return getRowRanges(np.unique(np.concatenate(self.dirtyRows)))
+
+    def upload(self):
+        """
+            Send the changed rows to the storage buffer.
+            Everything goes if the buffer grew.
+        """
+
+        if self.ssbo is None:
+            self.ssbo = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.ssbo)
+        if self.resized:
+            glBufferData(GL_SHADER_STORAGE_BUFFER, self.data.nbytes, self.data, GL_DYNAMIC_DRAW)
+            self.resized = False
+        else:
+            for first, last in self.getDirtyRanges():
+                data = self.data[first:last]
+                glBufferSubData(GL_SHADER_STORAGE_BUFFER, first * self.layout.itemsize, data.nbytes, data)
+        self.dirtyRows = []
+
+    def bind(self):
+
+        if self.ssbo is None:
+            self.upload()
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, self.binding, self.ssbo)
+
+    def destroy(self):
+
+        if self.ssbo is not None:
+            glDeleteBuffers(1, (self.ssbo,))
+            self.ssbo = None
+            self.resized = True
+
+class ObjectStore:
+    """
+        The sphere, plane, light, bvh node, light grid and
+        visibility buffers of the ray tracer.
+    """
+
+    def __init__(self, bake_visibility=False, skip_static_lights=False):
+        """
+            Make the empty buffers.
+
+                Parameters:
+                    bake_visibility (bool): bake each light's wall visibility
+                        along its path (see visibility.py) instead of casting
+                        shadow rays against the walls
+                    skip_static_lights (bool): leave out the lights which
+                        never move, their light is in the lightmap
+        """
+
+        self.spheres = ObjectBuffer(SPHERE_LAYOUT, SPHERE_BINDING)
+        self.planes = ObjectBuffer(PLANE_LAYOUT, PLANE_BINDING)
+        self.lights = ObjectBuffer(LIGHT_LAYOUT, LIGHT_BINDING)
+        self.nodes = ObjectBuffer(bvh.NODE_LAYOUT, NODE_BINDING)
+        self.lightCells = ObjectBuffer(lightgrid.CELL_LAYOUT, LIGHT_CELL_BINDING)
+        self.lightIndices = ObjectBuffer(lightgrid.INDEX_LAYOUT, LIGHT_INDEX_BINDING)
+        self.volumes = ObjectBuffer(visibility.VOLUME_LAYOUT, VOLUME_BINDING)
+        self.visibility = ObjectBuffer(visibility.WORD_LAYOUT, VISIBILITY_BINDING)
+        self.buffers = (
+            self.spheres, self.planes, self.lights, self.nodes,
+            self.lightCells, self.lightIndices, self.volumes, self.visibility
+        )
+
+        self.planeCount = 0
+        self.planeKey = None
+        self.nodeRows = np.zeros(0, dtype=bvh.NODE_LAYOUT)
+        self.topNodeCount = 0
+
+        self.bakeVisibility = bake_visibility
+        self.skipStaticLights = skip_static_lights
+        #the volumes laid out in the visibility buffer, and where
+        self.volumeKey = None
+        self.volumeOffsets = {}
+        self.solid = None
+        self.solidVersion = None
+
+    def pack(self, scene):
+        """
+            Lay out the scene's global objects and those of its active rooms.
+            Planes and the bvh are only laid out again when the active rooms,
+            the number of spheres or scene.planeVersion change, otherwise
+            the top level of the bvh is refit around the moving spheres.
+            Lights are binned into the cells of the wall grid every time,
+            leaving out the static ones if they are in a lightmap.
+
+            Returns the sphere, plane and light counts and the number of
+            top level bvh nodes.
+        """
+
+        spheres = scene.spheres + [_sphere for _room in scene.active_rooms for _sphere in _room.spheres]
+        sphereRows = packSpheres(spheres)
+        self.spheres.write(0, sphereRows)
+
+        key = (scene.planeVersion, tuple(id(_room) for _room in scene.active_rooms), len(spheres))
+        if key != self.planeKey:
+            self.nodeRows, planes, self.topNodeCount = bvh.buildTopLevel(scene, sphereRows)
+            self.planes.write(0, planes)
+            self.nodes.write(0, self.nodeRows)
+            self.planeCount = len(planes)
+            self.planeKey = key
+        else:
+            #every pack, boxes a frame behind would let rays miss a moving sphere
+            bvh.refitSpheres(self.nodeRows, self.topNodeCount, sphereRows)
+            self.nodes.write(0, self.nodeRows[:self.topNodeCount])
+
+        lights = scene.lights + [_light for _room in scene.active_rooms for _light in _room.lights]
+        if self.skipStaticLights:
+            lights = [_light for _light in lights if visibility.isMoving(_light)]
+        lightRows = packLights(lights)
+        self.lights.write(0, lightRows)
+        cells, indices = lightgrid.binLights(lightRows[:, 0:3], lightRows[:, 7], scene.wall_array.shape)
+        self.lightCells.write(0, cells)
+        self.lightIndices.write(0, indices)
+        self.volumes.write(0, self.packVolumes(scene, lights))
+
+        return len(spheres), self.planeCount, len(lights), self.topNodeCount
+
+    def packVolumes(self, scene, lights):
+        """
+            Bake the lights' visibility where it is missing or out of date,
+            BAKES_PER_FRAME at a time after the first frame, and lay out the
+            volumes the lights have. Returns their headers, in light order.
+        """
+
+        headers = np.zeros(len(lights), dtype=visibility.VOLUME_LAYOUT)
+        if not self.bakeVisibility:
+            return headers
+
+        if scene.planeVersion != self.solidVersion:
+            self.solid = occlusion.getSolidGrid(scene.wall_array)
+            self.solidVersion = scene.planeVersion
+
+        budget = None if self.volumeKey is None else BAKES_PER_FRAME
+        volumes = []
+        for _light in lights:
+            if _light.volume is None or _light.volume[0] != scene.planeVersion:
+                if budget == 0:
+                    volumes.append(None)
+                    continue
+                if budget is not None:
+                    budget -= 1
+            volumes.append(visibility.getVolume(_light, self.solid, scene.planeVersion))
+
+        #the bytes are only laid out again when the set of volumes changes
+        key = tuple(id(volume[1]) if volume is not None else None for volume in volumes)
+        if key != self.volumeKey:
+            self.volumeOffsets = {}
+            chunks = []
+            first = 0
+            for volume in volumes:
+                if volume is None or id(volume[1]) in self.volumeOffsets:
+                    continue
+                data = volume[1].ravel()
+                self.volumeOffsets[id(volume[1])] = first
+                chunks.append(np.pad(data, (0, roundUp(len(data), 4) - len(data))))
+                first += roundUp(len(data), 4)
+            words = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+            self.visibility.write(0, words.view(visibility.WORD_LAYOUT))
+            self.volumeKey = key
+
+        for i, (_light, volume) in enumerate(zip(lights, volumes)):
+            if volume is None:
+                continue
+            headers[i] = volume[0]
+            headers[i]["first"] = self.volumeOffsets[id(volume[1])]
+            headers[i]["phase"] = visibility.getPhase(_light)
+        return headers
+
+    def upload(self):
+
+        for buffer in self.buffers:
+            buffer.upload()
+
+    def bind(self):
+
+        for buffer in self.buffers:
+            buffer.bind()
+
+    def destroy(self):
+
+        for buffer in self.buffers:
+            buffer.destroy()
@@ -0,0 +1,163 @@
+from elements import *
+import geometry
+
+"""
+    Shadow rays answered by stepping through the wall grid.
+
+    Levels are blocks on a grid one unit high: x is the column, y the row
+    and everything lies between the floor (z = 0) and the ceiling (z = 1).
+    A shadow ray is blocked if it enters a solid block before reaching its
+    light, or leaves that slab through the floor or ceiling. Walking the
+    cells it crosses (a DDA) costs time in proportion to the distance
+    travelled, whatever the number of planes.
+
+    The engine picks this or the bvh when it is made, see OCCLUSION_MODES.
+    walkGrid here is the NumPy version of the shader's gridOccluded, so the
+    two can be checked against the plane intersections on the CPU.
+"""
+
+#engine occlusion modes: "bvh" tests the planes, "grid" walks the wall grid
+OCCLUSION_MODES = ("bvh", "grid")
+
+#image binding of the wall grid in the shader
+GRID_BINDING = 1
+
+#rays start this far along their direction, so they leave the surface they start on
+GRID_EPSILON = 1e-3
+
+def getSolidGrid(walls):
+    """
+        Which blocks of a wall grid stop light: walls do, empty cells and doors don't.
+    """
+
+    walls = geometry.toWallArray(walls)
+    return walls > 0
+
+def getBlockPlanes(solid):
+    """
+        One packed plane (elements.packPlanes rows) for every face of a solid
+        block next to open space, facing out of the block. Unlike the
+        scene's planes, which leave out convex edges, these cover every
+        face, so a ray hits one of them exactly when walkGrid says it is
+        blocked by a wall.
+    """
+
+    padded = np.ones((solid.shape[0] + 2, solid.shape[1] + 2), dtype=bool)
+    padded[1:-1, 1:-1] = solid
+    rows = []
+    for d_row, d_col in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        neighbour = padded[1 + d_row:padded.shape[0] - 1 + d_row, 1 + d_col:padded.shape[1] - 1 + d_col]
+        row, col = np.nonzero(solid & ~neighbour)
+        data = np.zeros((len(row), 17), dtype=np.float32)
+        data[:, 0] = col + 0.5 + 0.5 * d_col
+        data[:, 1] = row + 0.5 + 0.5 * d_row
+        data[:, 2] = 0.5
+        data[:, 3:6] = (abs(d_row), abs(d_col), 0)
+        data[:, 6:9] = (0, 0, 1)
+        data[:, 9:12] = (d_col, d_row, 0)
+        data[:, 12:16] = (-0.5, 0.5, -0.5, 0.5)
+        rows.append(data)
+    return np.concatenate(rows)
+
+def walkGrid(solid, origins, directions, distances):
+    """
+        Step a batch of shadow rays through the grid, all at once.
+
+            Parameters:
+                solid (bool array): rows x cols, see getSolidGrid
+                origins (array): (count, 3) ray origins
+                directions (array): (count, 3) normalised ray directions
+                distances (array): (count,) distance to each light
+
+            Returns:
+                a bool array, whether each ray is blocked before its distance
+    """
+
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    limits = np.asarray(distances, dtype=np.float64).reshape(-1) - GRID_EPSILON
+    origins = origins + GRID_EPSILON * directions
+    rows, cols = solid.shape
+    count = len(origins)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        #floor and ceiling
+        dz = directions[:, 2]
+        t_z = np.where(dz > 0, (1 - origins[:, 2]) / dz, np.where(dz < 0, -origins[:, 2] / dz, np.inf))
+        blocked = (origins[:, 2] < 0) | (origins[:, 2] > 1) | (t_z < limits)
+
+        #x steps columns, y steps rows
+        cell = np.floor(origins[:, :2]).astype(np.int64)
+        step = np.sign(directions[:, :2]).astype(np.int64)
+        t_delta = np.abs(1 / directions[:, :2])
+        t_next = np.where(
+            step > 0, (cell + 1 - origins[:, :2]) / directions[:, :2],
+            np.where(step < 0, (cell - origins[:, :2]) / directions[:, :2], np.inf)
+        )
+
+    active = ~blocked
+    while True:
+        index = np.flatnonzero(active)
+        if len(index) == 0:
+            return blocked
+
+        col, row = cell[index, 0], cell[index, 1]
+        inside = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+        hit = ~inside
+        hit[inside] = solid[row[inside], col[inside]]
+        blocked[index[hit]] = True
+        active[index[hit]] = False
+
+        #move the rest on to their next cell, unless they reach the light first
+        index = index[~hit]
+        axis = np.argmin(t_next[index], axis=1)
+        t = t_next[index, axis]
+        done = t >= limits[index]
+        active[index[done]] = False
+        index, axis = index[~done], axis[~done]
+        cell[index, axis] += step[index, axis]
+        t_next[index, axis] += t_delta[index, axis]
+
+class GridTexture:
+    """
+        The scene's wall grid as an integer image for the shader,
+        sent again whenever the scene's blocks change.
+    """
+
+    def __init__(self):
+
+        self.texture = None
+        self.shape = None
+        self.planeVersion = None
+
+    def upload(self, scene):
+        """
+            Send the wall grid if it changed since the last upload.
+        """
+
+        if scene.planeVersion == self.planeVersion and self.texture is not None:
+            return
+        self.planeVersion = scene.planeVersion
+
+        walls = np.ascontiguousarray(scene.wall_array, dtype=np.int32)
+        if self.texture is None:
+            self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        if walls.shape != self.shape:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_R32I, walls.shape[1], walls.shape[0], 0, GL_RED_INTEGER, GL_INT, walls)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            self.shape = walls.shape
+        else:
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, walls.shape[1], walls.shape[0], GL_RED_INTEGER, GL_INT, walls)
+
+    def bind(self):
+
+        glBindImageTexture(GRID_BINDING, self.texture, 0, GL_FALSE, 0, GL_READ_ONLY, GL_R32I)
+
+    def destroy(self):
+
+        if self.texture is not None:
+            glDeleteTextures(1, (self.texture,))
+            self.texture = None
+            self.shape = None
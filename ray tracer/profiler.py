@@ -0,0 +1,199 @@
+from elements import *
+import collections
+import csv
+import json
+import time
+import resolution
+
+"""
+    Per pass timing of the engine.
+
+    Each pass is wrapped in a pair of timestamp queries, for its GPU time,
+    and perf_counter calls, for the CPU time spent sending it. The queries
+    of a frame sit in a ring of QUERY_LATENCY frames and are read back when
+    the ring comes round to them, so the CPU doesn't wait for the GPU.
+    Timestamps, rather than GL_TIME_ELAPSED, work on Mesa's software driver
+    and let passes nest (the upsample pass runs inside the ray tracer's).
+
+    Frames are kept whole for export, getSummary gives the 50th, 95th and
+    99th percentile of each pass over the last WINDOW frames.
+"""
+
+#frames between timing a frame and reading its queries
+QUERY_LATENCY = 3
+#frames in the rolling percentiles
+WINDOW = 300
+#percentiles reported
+PERCENTILES = (50, 95, 99)
+#the pass spanning the whole frame
+FRAME = "frame"
+
+class Profiler:
+    """
+        Times named passes each frame, on the GPU and the CPU.
+    """
+
+    def __init__(self, latency=QUERY_LATENCY, window=WINDOW):
+
+        #per ring slot: pass name -> (start query, end query)
+        self.queries = [{} for _ in range(latency)]
+        #per ring slot: pass name -> cpu seconds, waiting for the gpu times
+        self.pending = [None] * latency
+        self.starts = {}
+        self.cpuTimes = {}
+        self.frame = 0
+
+        #finished frames: (frame, {pass name: (gpu ms, cpu ms)})
+        self.frames = []
+        self.recent = collections.deque(maxlen=window)
+
+    def getQueries(self, name):
+
+        slot = self.queries[self.frame % len(self.queries)]
+        if name not in slot:
+            slot[name] = tuple(np.atleast_1d(glGenQueries(2)).tolist())
+        return slot[name]
+
+    def begin(self, name):
+        """
+            Start timing a pass.
+        """
+
+        glQueryCounter(self.getQueries(name)[0], GL_TIMESTAMP)
+        self.starts[name] = time.perf_counter()
+
+    def end(self, name):
+        """
+            Stop timing a pass.
+        """
+
+        self.cpuTimes[name] = time.perf_counter() - self.starts.pop(name)
+        glQueryCounter(self.getQueries(name)[1], GL_TIMESTAMP)
+
+    def beginFrame(self):
+        """
+            Start timing a frame. Waits for the frame last timed in this
+            ring slot if the GPU is still behind it.
+        """
+
+        self.collect(self.frame % len(self.queries), wait=True)
+        self.begin(FRAME)
+
+    def endFrame(self):
+        """
+            Finish this frame's timing, and collect the frame which
+            was timed latency frames ago if its queries are ready.
+        """
+
+        self.end(FRAME)
+        slot = self.frame % len(self.queries)
+        self.pending[slot] = (self.frame, self.cpuTimes)
+        self.cpuTimes = {}
+        self.frame += 1
+
+        self.collect(self.frame % len(self.queries), wait=False)
+
+    def collect(self, slot, wait):
+        """
+            Read back a ring slot's times, if it holds a frame and its
+            queries are done (or waiting for them).
+        """
+
+        if self.pending[slot] is None:
+            return
+        frame, cpuTimes = self.pending[slot]
+        queries = self.queries[slot]
+        if not wait and not glGetQueryObjectiv(queries[FRAME][1], GL_QUERY_RESULT_AVAILABLE):
+            return
+
+        times = {}
+        for name, cpuTime in cpuTimes.items():
+            start, end = queries[name]
+            gpuTime = (resolution.readTimestamp(end) - resolution.readTimestamp(start)) * 1e-6
+            times[name] = (gpuTime, cpuTime * 1e3)
+        self.pending[slot] = None
+        self.frames.append((frame, times))
+        self.recent.append(times)
+
+    def flush(self):
+        """
+            Wait for and collect every frame still in the ring.
+        """
+
+        for offset in range(len(self.queries)):
+            self.collect((self.frame + offset) % len(self.queries), wait=True)
+
+    def reset(self):
+        """
+            Forget every frame timed so far, after a warm-up.
+        """
+
+        self.flush()
+        self.frames = []
+        self.recent.clear()
+
+    def getSummary(self, everything=False):
+        """
+            Percentiles of each pass's times over the recent frames,
+            or over every frame collected.
+
+                Returns:
+                    {pass name: {"gpu": {"p50": ms, ...}, "cpu": {...}, "frames": count}}
+        """
+
+        frames = [_times for _, _times in self.frames] if everything else self.recent
+        summary = {}
+        names = dict.fromkeys(_name for _times in frames for _name in _times)
+        for name in names:
+            times = np.array([_times[name] for _times in frames if name in _times])
+            summary[name] = {"frames": len(times)}
+            for column, clock in enumerate(("gpu", "cpu")):
+                values = np.percentile(times[:, column], PERCENTILES)
+                summary[name][clock] = {f"p{_p}": float(_value) for _p, _value in zip(PERCENTILES, values)}
+        return summary
+
+    def export(self, path):
+        """
+            Write every collected frame to a .csv (a row per frame and pass)
+            or a .json file (the frames and the summary), by the path's extension.
+        """
+
+        self.flush()
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(("frame", "pass", "gpu_ms", "cpu_ms"))
+                for frame, times in self.frames:
+                    for name, (gpuTime, cpuTime) in times.items():
+                        writer.writerow((frame, name, f"{gpuTime:.6f}", f"{cpuTime:.6f}"))
+        elif path.endswith(".json"):
+            frames = [
+                {"frame": frame, "passes": {
+                    _name: {"gpu_ms": _gpu, "cpu_ms": _cpu} for _name, (_gpu, _cpu) in times.items()
+                }}
+                for frame, times in self.frames
+            ]
+            with open(path, "w") as file:
+                json.dump({"summary": self.getSummary(), "frames": frames}, file, indent=1)
+        else:
+            raise ValueError(f"profile path must end in .csv or .json, not {path!r}")
+
+    def report(self):
+        """
+            The summary as a table of milliseconds.
+        """
+
+        lines = [f"{'pass':>10} {'frames':>7} " + " ".join(f"{'gpu p' + str(_p):>9}" for _p in PERCENTILES)
+            + " " + " ".join(f"{'cpu p' + str(_p):>9}" for _p in PERCENTILES)]
+        for name, stats in self.getSummary().items():
+            lines.append(f"{name:>10} {stats['frames']:7d} "
+                + " ".join(f"{_value:9.3f}" for _value in stats["gpu"].values()) + " "
+                + " ".join(f"{_value:9.3f}" for _value in stats["cpu"].values()))
+        return "\n".join(lines)
+
+    def destroy(self):
+
+        for slot in self.queries:
+            for start, end in slot.values():
+                glDeleteQueries(2, (start, end))
+            slot.clear()
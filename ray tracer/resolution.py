@@ -0,0 +1,137 @@
+from elements import *
+import ctypes
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as getQueryResult64
+
+"""
+    Dynamic resolution: the g-buffer and ray tracing passes draw at a
+    fraction of the window's size, chosen each frame to hold the engine's
+    target frame rate, and the present (or FXAA) pass stretches the
+    result over the window.
+
+    The GPU time of those passes is measured with timestamp queries, read a
+    few frames late so the CPU never waits for them, and smoothed. The
+    render scale drops at once to what should fit the frame when the
+    frame rate falls below target - margin, and rises a step at a time
+    while the frame rate would stay above target + margin after the step.
+    Every change is followed by COOLDOWN_FRAMES of measuring before the
+    next one, so the scale doesn't flicker between two sizes.
+"""
+
+#render scales are multiples of this fraction of the window's size
+RENDER_SCALE_STEP = 0.125
+#the smallest render scale by default
+MIN_RENDER_SCALE = 0.5
+#weight of each new frame time in the running average
+SMOOTHING = 0.2
+#frames measured after a change before the next
+COOLDOWN_FRAMES = 10
+#frames between timing a frame and reading the time back
+QUERY_LATENCY = 3
+
+def getRenderSize(width, height, scale):
+    """
+        Render size for a window at a scale, whole multiples of the
+        ray tracer's 8 x 8 work groups and at least one.
+    """
+
+    return max(8, 8 * round(width * scale / 8)), max(8, 8 * round(height * scale / 8))
+
+class ResolutionController:
+    """
+        Chooses the render scale from measured frame times.
+    """
+
+    def __init__(self, target_frame_rate, frame_rate_margin, min_scale=MIN_RENDER_SCALE, max_scale=1.0):
+        """
+            Start at the largest scale.
+
+                Parameters:
+                    target_frame_rate (float): frames per second to hold
+                    frame_rate_margin (float): frames per second either side
+                        of the target before the scale changes
+                    min_scale, max_scale (float): bounds of the render scale
+        """
+
+        self.slowTime = 1 / max(target_frame_rate - frame_rate_margin, 1)
+        self.targetTime = 1 / target_frame_rate
+        self.fastTime = 1 / (target_frame_rate + frame_rate_margin)
+        self.minScale = min_scale
+        self.maxScale = max_scale
+
+        self.scale = max_scale
+        self.average = None
+        self.wait = COOLDOWN_FRAMES
+
+    def update(self, frame_time):
+        """
+            Take a frame's GPU time in seconds, returns the render scale to use.
+        """
+
+        if self.average is None:
+            self.average = frame_time
+        else:
+            self.average += SMOOTHING * (frame_time - self.average)
+
+        if self.wait > 0:
+            self.wait -= 1
+            return self.scale
+
+        #time goes with the number of pixels, the square of the scale
+        scale = self.scale
+        if self.average > self.slowTime:
+            fitting = scale * np.sqrt(self.targetTime / self.average)
+            scale = max(self.minScale, np.floor(fitting / RENDER_SCALE_STEP) * RENDER_SCALE_STEP)
+        else:
+            larger = min(self.maxScale, scale + RENDER_SCALE_STEP)
+            if self.average * (larger / scale) ** 2 < self.fastTime:
+                scale = larger
+
+        if scale != self.scale:
+            self.scale = float(scale)
+            self.average = None
+            self.wait = COOLDOWN_FRAMES
+        return self.scale
+
+class FrameTimer:
+    """
+        GPU time of each frame, from a ring of timestamp query pairs.
+    """
+
+    def __init__(self, latency=QUERY_LATENCY):
+
+        self.queries = np.atleast_1d(glGenQueries(2 * latency)).reshape(latency, 2).tolist()
+        self.frame = 0
+
+    def begin(self):
+
+        glQueryCounter(self.queries[self.frame % len(self.queries)][0], GL_TIMESTAMP)
+
+    def end(self):
+        """
+            Finish this frame's queries. Returns the time of the frame
+            latency frames ago in seconds, None if it isn't known yet.
+        """
+
+        glQueryCounter(self.queries[self.frame % len(self.queries)][1], GL_TIMESTAMP)
+        self.frame += 1
+        if self.frame < len(self.queries):
+            return None
+
+        start, end = self.queries[self.frame % len(self.queries)]
+        if not glGetQueryObjectiv(end, GL_QUERY_RESULT_AVAILABLE):
+            return None
+        return (readTimestamp(end) - readTimestamp(start)) * 1e-9
+
+    def destroy(self):
+
+        glDeleteQueries(2 * len(self.queries), sum(self.queries, []))
+
+def readTimestamp(query):
+    """
+        A finished timestamp query's time in nanoseconds. PyOpenGL's
+        wrapper can't return 64 bit results, so the raw call is used.
+    """
+
+    value = ctypes.c_uint64()
+    getQueryResult64(query, GL_QUERY_RESULT, ctypes.byref(value))
+    return value.value
@@ -5,8 +5,28 @@ W = 1600
 H = -1
 USE_FXAA = True
 # Set to False to disable FXAA
+GREEDY_MESHING = False
+# Set to True to merge flat runs of walls, floors and ceilings into fewer quads
+OCCLUSION_MODE = "bvh"
+# Set to "grid" to answer shadow rays by stepping through the wall grid
+BAKE_VISIBILITY = False
+# Set to True to bake each light's wall shadows along its path at startup
+USE_LIGHTMAP = False
+# Set to True to bake the lights which never move into lightmaps, kept in the level cache
+LIGHTING_SCALE = 1
+# Set to 2 or 4 to shade one pixel per 2x2 or 4x4 block and upsample the lighting
+TEMPORAL_CACHE = False
+# Set to True to keep lighting between frames and only trace a share of it again
+DYNAMIC_RESOLUTION = False
+# Set to True to lower the render size when frames fall below the target frame rate
+PROFILE_PATH = None
+# Set to a .csv or .json path to time each pass and save the times on exit
 
 if __name__ == "__main__":
     # Pass in desired width, height, and FXAA setting
-    myApp = app.App(width=W, height=H, use_fxaa=USE_FXAA)
+    myApp = app.App(width=W, height=H, use_fxaa=USE_FXAA, greedy_meshing=GREEDY_MESHING,
+                    occlusion_mode=OCCLUSION_MODE, bake_visibility=BAKE_VISIBILITY,
+                    use_lightmap=USE_LIGHTMAP, lighting_scale=LIGHTING_SCALE,
+                    temporal_cache=TEMPORAL_CACHE,
+                    dynamic_resolution=DYNAMIC_RESOLUTION, profile_path=PROFILE_PATH)
     myApp.quit()
\ No newline at end of file
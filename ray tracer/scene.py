@@ -1,17 +1,43 @@
 import elements
 from elements import *
+import collections
 import camera
+import edge
 import geometry
+import levelcache
+
+#scene.update's rate counts frames of this many seconds
+SCENE_FRAME_TIME = 0.016
 
 class Scene:
     """
         Holds pointers to all objects in the scene
     """
 
-    def __init__(self):
+    def __init__(self, greedy_meshing=False, use_level_cache=True,
+        wall_geometry=None, floor_geometry=None, ceiling_geometry=None, lights=None, finalize=True,
+        verbose=False):
         """
             Set up scene objects.
+
+                Parameters:
+                    greedy_meshing (bool): merge coplanar faces of the same
+                        material into larger quads when building room geometry
+                    use_level_cache (bool): load the built level from
+                        levelcache.CACHE_FOLDER if it is there, and store it otherwise
+                    wall_geometry, floor_geometry, ceiling_geometry (matrices):
+                        a map to use instead of the default one
+                    lights (list): lights for that map, none if not given
+                    finalize (bool): make the vertex buffers, leave it off to
+                        use the scene without an OpenGL context (cpurender.py)
+                    verbose (bool): print how many planes cover the floors and
+                        ceilings, and how much greedy meshing saved in each
+                        room, when the level is built
         """
+        self.greedy_meshing = greedy_meshing
+        self.use_level_cache = use_level_cache
+        self.verbose = verbose
+
         # Map data for a single large 16x16 room
         self.wall_geometry = [
             [6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6],
@@ -105,11 +131,21 @@ class Scene:
             )
         ]
 
+        if wall_geometry is not None:
+            self.wall_geometry = wall_geometry
+            self.floor_geometry = floor_geometry
+            self.ceiling_geometry = ceiling_geometry
+            self.lights = [] if lights is None else lights
+
         self.rooms = []
         self.doors = []
         self.planes = []
         self.room_lookup = {}
-        self.vertices = []
+        #(vertices before, vertices after) greedy meshing, per room
+        self.mesh_report = []
+        #(floor and ceiling cells, planes covering them), per room
+        self.plane_report = []
+        self.vertices = np.zeros((0, VERTEX_SIZE), dtype=np.float32)
         self.vertexCount = 0
 
         self.camera = camera.Camera(
@@ -117,79 +153,768 @@ class Scene:
         )
 
         self.outDated = True
+        #bumped whenever planes are added or removed, so the engine packs them again
+        self.planeVersion = 0
+        self.finalized = False
+        #lookups for set_block, built on the first edit by prepare_edits
+        self.edge_planes = None
 
-        self.make_level()
+        self.wall_array = geometry.toWallArray(self.wall_geometry)
+        self.floor_array = np.array(self.floor_geometry, dtype=np.int32)
+        self.ceiling_array = np.array(self.ceiling_geometry, dtype=np.int32)
+
+        if not (self.use_level_cache and levelcache.loadLevel(self)):
+            self.make_level()
+            if self.use_level_cache:
+                levelcache.saveLevel(self)
         self.send_objects_to_rooms()
-        self.finalize()
+        if finalize:
+            self.finalize()
 
     def make_level(self):
-        geometry.buildRooms(
-            walls=self.wall_geometry, doors=self.doors, rooms=self.rooms
+        room_grid = geometry.buildRooms(
+            walls=self.wall_array, doors=self.doors, rooms=self.rooms
         )
+        self.index_rooms(room_grid)
 
-        wall_mask = geometry.getLumpedGeometry(self.wall_geometry)
+        wall_mask = geometry.getLumpedGeometryArray(self.wall_array)
 
         for _room in self.rooms:
             for coordinate in _room.coordinates:
-                row, col = coordinate
                 self.room_lookup[coordinate] = _room
-                geometry.getGeometryAtPoint(
-                    row, col, _room,
-                    self.wall_geometry, self.floor_geometry, self.ceiling_geometry, wall_mask
-                )
-
             for coordinate in _room.internalCoordinates:
-                row, col = coordinate
                 self.room_lookup[coordinate] = _room
-                geometry.getGeometryAtPoint(
-                    row, col, _room,
-                    self.wall_geometry, self.floor_geometry, self.ceiling_geometry, wall_mask
-                )
 
-        edges = geometry.getEdges(wall_mask)
-        geometry.classifyEdges(edges)
+            cells = _room.coordinates + _room.internalCoordinates
+            _room.vertices = geometry.buildMesh(
+                cells, self.wall_array, self.floor_array, self.ceiling_array, wall_mask,
+                greedy=self.greedy_meshing
+            )
+            _room.vertexCount = len(_room.vertices)
+
+            if self.greedy_meshing:
+                faces = geometry.countFaces(geometry.selectFaces(
+                    cells, self.wall_array, self.floor_array, self.ceiling_array, wall_mask
+                ))
+                self.mesh_report.append((geometry.FACE_VERTICES * faces, _room.vertexCount))
+
+            cell_count, plane_count = geometry.sendFloorAndCeiling(
+                _room.internalCoordinates,
+                self.wall_array, self.floor_array, self.ceiling_array, _room
+            )
+            self.plane_report.append((cell_count, plane_count))
+
+        if self.verbose:
+            cell_count = sum(cells for cells, _ in self.plane_report)
+            plane_count = sum(planes for _, planes in self.plane_report)
+            print(f"Floor and ceiling planes: {cell_count} cells -> {plane_count} planes")
+            for i, (before, after) in enumerate(self.mesh_report):
+                print(f"Room {i}: {before} -> {after} vertices ({100 * (before - after) / max(1, before):.0f}% fewer)")
+
+        edges = geometry.getEdgesArray(wall_mask)
+        convex = geometry.classifyEdgeArray(edges)
 
-        for _edge in edges:
-            target = self.room_lookup[_edge.point_a]
-            geometry.sendEdge(_edge, target)
+        #convex edges are never sent, only build objects for the rest
+        for _edge in geometry.toEdges(edges[convex != 1]):
+            #walls only touching doors belong to no room
+            target = self.room_lookup.get(_edge.point_a)
+            if target is not None:
+                geometry.sendEdge(_edge, target)
 
         self.active_rooms = [self.rooms[0], ]
 
+    def index_rooms(self, room_grid):
+        """
+            Keep the room id of every empty block (-1 elsewhere) and the
+            rooms touching every door, so finding the rooms at a block
+            doesn't depend on how many rooms there are.
+        """
+
+        #room ids index room_table, ids of removed rooms are reused
+        self.room_table = list(self.rooms)
+        self.free_room_ids = []
+        self.room_grid = np.array(room_grid, dtype=np.int32)
+
+        self.door_rooms = {}
+        for _room in self.rooms:
+            for _door in _room.doors:
+                self.door_rooms.setdefault(_door.coordinate, []).append(_room)
+
+    def get_rooms_at(self, row, col):
+        """
+            The rooms holding a block: its own room if it is empty,
+            the rooms it joins if it is a door, none otherwise.
+        """
+
+        rows, cols = self.room_grid.shape
+        if not (0 <= row < rows and 0 <= col < cols):
+            return []
+
+        room_id = int(self.room_grid[row, col])
+        if room_id >= 0:
+            return [self.room_table[room_id]]
+        return self.door_rooms.get((row, col), [])
+
+    def prepare_edits(self):
+        """
+            Build the lookups set_block works from: the wall mask, every
+            edge with the plane it sent and the face slots of each room's
+            vertices. Runs once, on the first edit.
+        """
+
+        self.wall_mask = geometry.getLumpedGeometryArray(self.wall_array)
+
+        self.door_lookup = {_door.coordinate: _door for _door in self.doors}
+
+        #edge planes are sent again below, this time remembering which edge sent them
+        self.plane_index = {}
+        self.floor_planes = np.empty(self.wall_array.shape + (2,), dtype=object)
+        for _room in self.rooms:
+            planes = [_plane for _plane in _room.planes if _plane.normal[2] != 0]
+            _room.planes = []
+            self.add_planes(_room, planes)
+
+        self.edge_flags = {}
+        self.edge_planes = {}
+        self.edge_starts = {}
+        self.edge_ends = {}
+        edges = geometry.getEdgesArray(self.wall_mask)
+        for key, flag in zip(geometry.toEdgeKeys(edges), geometry.classifyEdgeArray(edges).tolist()):
+            self.add_edge(key, flag)
+
+        for _room in self.rooms:
+            #cached levels come in as read-only memory maps
+            _room.vertices = np.array(_room.vertices[:_room.vertexCount], dtype=np.float32)
+            if not self.greedy_meshing:
+                _room.faceSlots = geometry.getFaceSlots(
+                    _room.coordinates + _room.internalCoordinates,
+                    self.wall_array, self.floor_array, self.ceiling_array, self.wall_mask
+                )
+                _room.freeSlots = []
+
+    def add_planes(self, _room, planes):
+        """
+            Append planes to a room, noting where they went so
+            remove_plane can find them. Floor and ceiling planes
+            are also written into floor_planes.
+        """
+
+        _room.tree = None
+        for _plane in planes:
+            self.plane_index[id(_plane)] = len(_room.planes)
+            _room.planes.append(_plane)
+
+            if _plane.normal[2] != 0:
+                top = int(round(_plane.center[1] - _plane.uMax))
+                left = int(round(_plane.center[0] - _plane.vMax))
+                height, width = int(round(2 * _plane.uMax)), int(round(2 * _plane.vMax))
+                self.floor_planes[top:top + height, left:left + width, int(_plane.normal[2] < 0)] = _plane
+
+    def remove_plane(self, _room, _plane):
+        """
+            Take a plane out of a room in constant time,
+            the room's last plane fills the gap.
+        """
+
+        _room.tree = None
+        index = self.plane_index.pop(id(_plane))
+        last = _room.planes.pop()
+        if last is not _plane:
+            _room.planes[index] = last
+            self.plane_index[id(last)] = index
+
+    def add_room(self):
+        """
+            Make a new empty room and give it an id.
+            Returns the id.
+        """
+
+        _room = elements.Room()
+        if not self.greedy_meshing:
+            _room.faceSlots = {}
+        if self.finalized:
+            _room.finalize()
+        self.rooms.append(_room)
+
+        if self.free_room_ids:
+            room_id = self.free_room_ids.pop()
+            self.room_table[room_id] = _room
+        else:
+            room_id = len(self.room_table)
+            self.room_table.append(_room)
+        return room_id
+
+    def remove_room(self, room_id):
+        """
+            Drop a room which has no blocks left. Anything still in it
+            goes to the scene's global lists.
+        """
+
+        _room = self.room_table[room_id]
+        self.room_table[room_id] = None
+        self.free_room_ids.append(room_id)
+        self.rooms.remove(_room)
+        if _room in self.active_rooms:
+            self.active_rooms.remove(_room)
+
+        for _plane in _room.planes:
+            del self.plane_index[id(_plane)]
+        self.lights += _room.lights
+        self.spheres += _room.spheres
+        _room.destroy()
+
+    def get_neighbours(self, row, col):
+        """
+            The in-bounds blocks sharing a side with (row, col).
+        """
+
+        rows, cols = self.wall_array.shape
+        return [
+            (row + d_row, col + d_col)
+            for d_row, d_col in ((-1, 0), (0, 1), (1, 0), (0, -1))
+            if 0 <= row + d_row < rows and 0 <= col + d_col < cols
+        ]
+
+    def get_cell_rooms(self, cell):
+        """
+            The rooms holding a block: its own room if it is empty,
+            otherwise every room next to it.
+        """
+
+        room_id = int(self.room_grid[cell])
+        if room_id >= 0:
+            return [self.room_table[room_id]]
+
+        room_ids = [int(self.room_grid[neighbour]) for neighbour in self.get_neighbours(*cell)]
+        return [self.room_table[room_id] for room_id in dict.fromkeys(room_ids) if room_id >= 0]
+
+    def is_locally_connected(self, row, col):
+        """
+            Check whether the empty blocks next to (row, col) are still
+            joined through the eight blocks around it. If they are,
+            filling (row, col) can't split its room.
+        """
+
+        ring = [
+            (row - 1, col - 1), (row - 1, col), (row - 1, col + 1), (row, col + 1),
+            (row + 1, col + 1), (row + 1, col), (row + 1, col - 1), (row, col - 1)
+        ]
+        rows, cols = self.wall_array.shape
+        empty = [
+            0 <= ring_row < rows and 0 <= ring_col < cols and self.wall_array[ring_row, ring_col] == 0
+            for ring_row, ring_col in ring
+        ]
+        if all(empty):
+            return True
+
+        #walk the ring from a filled block, counting the runs of empty blocks which hold a side
+        start = empty.index(False)
+        runs = 0
+        has_side = False
+        for i in range(9):
+            position = (start + i) % 8
+            if i < 8 and empty[position]:
+                has_side |= (position % 2 == 1)
+            else:
+                runs += has_side
+                has_side = False
+
+        return runs <= 1
+
+    def find_cut_off(self, row, col, room_id):
+        """
+            After (row, col) was filled, look for a piece of the room which
+            is no longer joined to the rest. A search runs out from each of
+            the room's blocks next to (row, col) in turn, stopping once they
+            have all met or as soon as one search runs out of blocks, so the
+            cost is set by the way round or by the piece cut off, not by the
+            size of the room.
+
+            Returns the blocks of the piece, or None if nothing was cut off.
+        """
+
+        starts = [
+            neighbour for neighbour in self.get_neighbours(row, col)
+            if self.room_grid[neighbour] == room_id
+        ]
+        if len(starts) <= 1 or self.is_locally_connected(row, col):
+            return None
+
+        owner = {start: i for i, start in enumerate(starts)}
+        queues = [collections.deque([start]) for start in starts]
+        root = list(range(len(starts)))
+        remaining = len(starts)
+        while remaining > 1:
+            for i in range(len(starts)):
+                if root[i] != i:
+                    continue
+                if not queues[i]:
+                    return [cell for cell, j in owner.items() if self.find_search(root, j) == i]
+                for neighbour in self.get_neighbours(*queues[i].popleft()):
+                    if self.room_grid[neighbour] != room_id:
+                        continue
+                    j = owner.get(neighbour)
+                    if j is None:
+                        owner[neighbour] = i
+                        queues[i].append(neighbour)
+                        continue
+                    j = self.find_search(root, j)
+                    if j != i:
+                        #two searches met, carry on as one
+                        root[j] = i
+                        queues[i].extend(queues[j])
+                        queues[j].clear()
+                        remaining -= 1
+                if remaining == 1:
+                    break
+
+        return None
+
+    def find_search(self, root, i):
+        """
+            The search a merged search in find_cut_off carries on as.
+        """
+
+        while root[i] != i:
+            i = root[i]
+        return i
+
+    def set_block(self, row, col, value):
+        """
+            Change one block of the map (0 for empty, a material for
+            a wall or "d" for a door) and patch the level around it.
+
+            Only the block and its neighbours are rebuilt: the wall mask,
+            the edges on the rows and columns through them (reclassifying
+            the edges linked to those, see update_edges), their faces
+            in each room's vertex buffer (uploaded with glBufferSubData)
+            and the floor and ceiling planes under the block.
+            Rooms are only touched beyond that when the edit joins or
+            splits them: joined rooms move into the largest of them and
+            a piece cut off moves into a new room, so the cost follows the
+            smaller side. Rooms built with greedy meshing rebuild their
+            whole mesh.
+
+            Raises ValueError for a block outside the map, or a door on
+            its border: a door faces along the blocks on either side.
+        """
+
+        rows, cols = self.wall_array.shape
+        if not (0 <= row < rows and 0 <= col < cols):
+            raise ValueError(f"block ({row}, {col}) is outside the {rows}x{cols} map")
+        if value == "d" and not (0 < row < rows - 1 and 0 < col < cols - 1):
+            raise ValueError(f"a door needs a block on each side, ({row}, {col}) is on the map's border")
+
+        if self.edge_planes is None:
+            self.prepare_edits()
+
+        value = geometry.DOOR if value == "d" else int(value)
+        old = int(self.wall_array[row, col])
+        if value == old:
+            return
+
+        window = [(row, col)] + self.get_neighbours(row, col)
+        before = {cell: self.get_cell_rooms(cell) for cell in window}
+
+        old_edges = set(geometry.toEdgeKeys(geometry.getWindowEdges(self.wall_mask, row, col)))
+
+        self.wall_geometry[row][col] = "d" if value == geometry.DOOR else value
+        self.wall_array[row, col] = value
+        geometry.updateWallMask(self.wall_array, self.wall_mask, row, col)
+
+        self.remove_door((row, col))
+
+        room_id = int(self.room_grid[row, col])
+        joined = []
+        if old == 0:
+            self.room_grid[row, col] = -1
+        elif value == 0:
+            #an emptied block joins the largest room next to it, or starts a new one
+            joined = sorted(
+                {int(self.room_grid[neighbour]) for neighbour in self.get_neighbours(row, col)} - {-1},
+                key=lambda room_id: -len(self.room_table[room_id].internalCoordinates)
+            )
+            room_id = joined.pop(0) if joined else self.add_room()
+            self.room_grid[row, col] = room_id
+
+        after = {cell: self.get_cell_rooms(cell) for cell in window}
+        for cell in window:
+            self.update_membership(cell, before[cell], after[cell], old if cell == (row, col) else None)
+        self.update_floor_planes(row, col, old, value, self.room_table[room_id])
+
+        for other_id in joined:
+            self.move_cells(self.get_empty_cells(self.room_table[other_id]), other_id, room_id)
+            self.remove_room(other_id)
+
+        if old == 0:
+            while True:
+                piece = self.find_cut_off(row, col, room_id)
+                if piece is None:
+                    break
+                self.move_cells(piece, room_id, self.add_room())
+
+        self.update_edges(row, col, old_edges)
+
+        for _room in dict.fromkeys(
+            _room for cell in window for _room in before[cell] + after[cell]
+        ):
+            if _room in self.room_table:
+                self.patch_room(_room, window)
+        for cell in window[1:]:
+            if cell in self.door_lookup:
+                self.rebuild_door(self.door_lookup[cell])
+
+        if old == 0 and not self.room_table[room_id].internalCoordinates:
+            self.remove_room(room_id)
+
+        self.planeVersion += 1
+        self.outDated = True
+
+    def get_empty_cells(self, _room):
+        """
+            A room's empty blocks, without the doors it touches.
+        """
+
+        return [cell for cell in _room.internalCoordinates if self.wall_array[cell] == 0]
+
+    def update_membership(self, cell, before, after, old=None):
+        """
+            Move a block in and out of the block lists of rooms.
+            For the edited block old is its previous value: it changes kind,
+            so it is taken out of every room it was in and put back into
+            every room it is in now.
+        """
+
+        edited = old is not None
+        was_door = (old if edited else self.wall_array[cell]) == geometry.DOOR
+        for _room in before:
+            if edited or _room not in after:
+                geometry.removeCell(_room.coordinates, cell)
+                geometry.removeCell(_room.internalCoordinates, cell)
+                if was_door:
+                    _room.doors = [_door for _door in _room.doors if _door.coordinate != cell]
+
+        for _room in after:
+            if edited or _room not in before:
+                if self.wall_array[cell] == 0:
+                    geometry.insertCell(_room.internalCoordinates, cell)
+                elif self.wall_array[cell] == geometry.DOOR:
+                    geometry.insertCell(_room.internalCoordinates, cell)
+                    _room.doors.append(self.get_door(cell))
+                else:
+                    geometry.insertCell(_room.coordinates, cell)
+
+        if self.wall_array[cell] == geometry.DOOR and after:
+            self.door_rooms[cell] = list(after)
+        else:
+            self.door_rooms.pop(cell, None)
+            #a door no room reaches any more is gone, as in a rebuild
+            self.remove_door(cell)
+
+        if self.room_lookup.get(cell) not in after:
+            if after:
+                self.room_lookup[cell] = after[0]
+            else:
+                self.room_lookup.pop(cell, None)
+
+    def get_door(self, cell):
+        """
+            The door on a block, made the first time a room reaches it.
+        """
+
+        if cell not in self.door_lookup:
+            _door = geometry.makeDoor(cell, self.wall_array)
+            self.doors.append(_door)
+            self.door_lookup[cell] = _door
+            if self.finalized:
+                _door.finalize()
+        return self.door_lookup[cell]
+
+    def remove_door(self, cell):
+        """
+            Drop the door on a block, if there is one, and free its buffers.
+        """
+
+        if cell in self.door_lookup:
+            _door = self.door_lookup.pop(cell)
+            self.doors.remove(_door)
+            _door.destroy()
+
+    def update_floor_planes(self, row, col, old, value, _room):
+        """
+            Cut a filled block out of the floor and ceiling planes of its
+            room, or give an emptied block its own floor and ceiling.
+        """
+
+        if old == 0 and value != 0:
+            for _plane in self.floor_planes[row, col]:
+                self.remove_plane(_room, _plane)
+                self.add_planes(_room, geometry.splitFloorPlane(
+                    _plane, (row, col), self.floor_array, self.ceiling_array
+                ))
+            self.floor_planes[row, col] = None
+        elif old != 0 and value == 0:
+            self.add_planes(_room, geometry.getFloorAndCeilingPlanes(
+                np.array([row]), np.array([col]), self.floor_array, self.ceiling_array
+            ))
+
+    def move_cells(self, cells, source_id, target_id):
+        """
+            Move empty blocks from one room to another, along with their
+            floor and ceiling planes, the walls and doors around them and
+            any lights and spheres inside them.
+        """
+
+        source = self.room_table[source_id]
+        target = self.room_table[target_id]
+        window = list(dict.fromkeys(
+            cells + [neighbour for cell in cells for neighbour in self.get_neighbours(*cell)]
+        ))
+
+        before = {cell: self.get_cell_rooms(cell) for cell in window}
+        rows, cols = np.array(cells, dtype=np.int64).reshape(-1, 2).T
+        self.room_grid[rows, cols] = target_id
+        for cell in window:
+            self.update_membership(cell, before[cell], self.get_cell_rooms(cell))
+
+        planes = {id(_plane): _plane for _plane in self.floor_planes[rows, cols].ravel()}
+        for _plane in planes.values():
+            self.remove_plane(source, _plane)
+        self.add_planes(target, list(planes.values()))
+
+        #edge planes follow the room their first block now looks up
+        for cell in window:
+            for key in list(self.edge_starts.get(cell, ())):
+                self.refresh_edge(key)
+
+        moved = set(cells)
+        for _light in [_light for _light in source.lights if (int(_light.position[1]), int(_light.position[0])) in moved]:
+            source.lights.remove(_light)
+            target.add_light(_light)
+        for _sphere in [_sphere for _sphere in source.spheres if (int(_sphere.center[1]), int(_sphere.center[0])) in moved]:
+            source.spheres.remove(_sphere)
+            target.add_sphere(_sphere)
+
+        self.patch_room(source, window)
+        self.patch_room(target, window)
+
+    def add_edge(self, key, flag):
+        """
+            Index an edge and send its plane unless it is convex.
+        """
+
+        self.edge_flags[key] = flag
+        self.edge_starts.setdefault(key[1:3], set()).add(key)
+        self.edge_ends.setdefault(key[3:5], set()).add(key)
+        if flag != 1:
+            self.send_edge(key)
+
+    def remove_edge(self, key):
+        """
+            Forget an edge and take its plane out of its room.
+        """
+
+        self.unsend_edge(key)
+        del self.edge_flags[key]
+        for lookup, index in (
+            (self.edge_starts, key[1:3]),
+            (self.edge_ends, key[3:5]),
+        ):
+            lookup[index].discard(key)
+            if not lookup[index]:
+                del lookup[index]
+
+    def send_edge(self, key):
+        """
+            Send an edge's plane to the room holding its first block.
+        """
+
+        target = self.room_lookup.get(key[1:3])
+        if target is None:
+            return
+
+        _edge = edge.Edge(None)
+        _edge.type = key[0]
+        _edge.point_a = key[1:3]
+        _edge.point_b = key[3:5]
+        geometry.sendEdge(_edge, target)
+        target.tree = None
+        self.plane_index[id(target.planes[-1])] = len(target.planes) - 1
+        self.edge_planes[key] = (target, target.planes[-1])
+
+    def unsend_edge(self, key):
+        """
+            Take an edge's plane out of its room, if it sent one.
+        """
+
+        if key in self.edge_planes:
+            target, _plane = self.edge_planes.pop(key)
+            self.remove_plane(target, _plane)
+
+    def refresh_edge(self, key):
+        """
+            Move an edge's plane to the room its first block looks up now.
+            An edge which is not convex but had no room to go to is sent
+            once its block has one.
+        """
+
+        if self.edge_flags[key] == 1:
+            return
+        sent = self.edge_planes.get(key)
+        if (sent[0] if sent else None) is not self.room_lookup.get(key[1:3]):
+            self.unsend_edge(key)
+            self.send_edge(key)
+
+    def get_nearby_edges(self, lookup, point):
+        """
+            Edges in an edge_starts or edge_ends lookup with their
+            point in the 3x3 blocks around the given one.
+        """
+
+        found = set()
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                found |= lookup.get((point[0] + d_row, point[1] + d_col), set())
+        return found
+
+    def get_linked_edges(self, keys):
+        """
+            Every edge joined to the given ones through a chain of edges
+            starting next to where another ends. classifyEdgeArray pairs
+            edges in order along these chains, so a flag can depend on
+            edges anywhere on them.
+        """
+
+        found = set(keys)
+        queue = list(found)
+        while queue:
+            key = queue.pop()
+            for linked in (
+                self.get_nearby_edges(self.edge_starts, key[3:5])
+                | self.get_nearby_edges(self.edge_ends, key[1:3])
+            ):
+                if linked not in found:
+                    found.add(linked)
+                    queue.append(linked)
+        return found
+
+    def update_edges(self, row, col, old_keys):
+        """
+            Swap the edges around (row, col) which changed, given the
+            ones there were before (see geometry.getWindowEdges), and
+            reclassify every edge linked to them (see get_linked_edges),
+            so the flags come out as make_level would give them.
+        """
+
+        new_keys = set(geometry.toEdgeKeys(geometry.getWindowEdges(self.wall_mask, row, col)))
+
+        removed = old_keys - new_keys
+        added = new_keys - old_keys
+
+        #edges linked through a removed edge may not be linked any more, start on both sides
+        starts = set(added)
+        for key in removed:
+            starts |= self.get_nearby_edges(self.edge_ends, key[1:3])
+            starts |= self.get_nearby_edges(self.edge_starts, key[3:5])
+        for key in removed:
+            self.remove_edge(key)
+        starts -= removed
+
+        #new edges are indexed unsent until they are classified
+        for key in added:
+            self.add_edge(key, 1)
+
+        affected = self.get_linked_edges(starts)
+        edges = geometry.fromEdgeKeys(affected)
+        flags = geometry.classifyEdgeArray(edges).tolist()
+
+        for key, flag in zip(geometry.toEdgeKeys(edges), flags):
+            if flag != self.edge_flags[key]:
+                self.edge_flags[key] = flag
+                if flag == 1:
+                    self.unsend_edge(key)
+                elif key not in self.edge_planes:
+                    self.send_edge(key)
+
+        #blocks in the window may have changed room
+        for key in new_keys:
+            self.refresh_edge(key)
+
+    def patch_room(self, _room, cells):
+        """
+            Rewrite a room's faces on the given blocks and upload the changed ranges.
+        """
+
+        if _room.faceSlots is None:
+            _room.vertices = geometry.buildMesh(
+                _room.coordinates + _room.internalCoordinates,
+                self.wall_array, self.floor_array, self.ceiling_array, self.wall_mask,
+                greedy=self.greedy_meshing
+            )
+            _room.vertexCount = len(_room.vertices)
+            if _room.finalized:
+                updateVertexBuffer(_room.vbo, _room.vertices)
+            return
+
+        slots = geometry.patchFaces(
+            _room, cells, self.wall_array, self.floor_array, self.ceiling_array, self.wall_mask
+        )
+        if not _room.finalized:
+            return
+        if slots is None:
+            updateVertexBuffer(_room.vbo, _room.vertices)
+            return
+        for first, last in geometry.getSlotRanges(slots):
+            updateVertexBuffer(_room.vbo, _room.vertices, first, last)
+
+    def rebuild_door(self, _door):
+        """
+            Build a door's faces again, its orientation follows its neighbours.
+        """
+
+        _door.vertices = geometry.makeDoor(_door.coordinate, self.wall_array).vertices
+        if _door.finalized:
+            updateVertexBuffer(_door.vbo, _door.vertices, 0, len(_door.vertices))
+
     def send_objects_to_rooms(self):
-        while len(self.lights) > 0:
-            _light = self.lights.pop()
-            coordinate = (int(_light.position[1]), int(_light.position[0]))
-            _room = self.room_lookup[coordinate]
-            _room.add_light(_light)
+        """
+            Hand each light and sphere to the room it is in.
+            Anything outside every room stays global.
+        """
+
+        lights = []
+        for _light in self.lights:
+            _room = self.get_object_room(_light.position)
+            if _room is None:
+                lights.append(_light)
+            else:
+                _room.add_light(_light)
+        self.lights = lights
+
+        spheres = []
+        for _sphere in self.spheres:
+            _room = self.get_object_room(_sphere.center)
+            if _room is None:
+                spheres.append(_sphere)
+            else:
+                _room.add_sphere(_sphere)
+        self.spheres = spheres
+
+    def get_object_room(self, position):
+        """
+            The room an object at position belongs to, looking it up by the
+            block under it. Objects in a wall go to the room that wall faces.
+        """
+
+        coordinate = (int(position[1]), int(position[0]))
+        rooms = self.get_rooms_at(*coordinate)
+        if rooms:
+            return rooms[0]
+        return self.room_lookup.get(coordinate)
 
     def finalize(self):
-        self.vertices = np.array(self.vertices, dtype=np.float32)
-        self.vao = glGenVertexArrays(1)
-        glBindVertexArray(self.vao)
-        self.vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices, GL_STATIC_DRAW)
-        offset = 0
-        # position
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        # texture
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 8
-        # tangent
-        glEnableVertexAttribArray(2)
-        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        # bitangent
-        glEnableVertexAttribArray(3)
-        glVertexAttribPointer(3, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
-        # normal
-        glEnableVertexAttribArray(4)
-        glVertexAttribPointer(4, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
-        offset += 12
+        self.finalized = True
+        self.vao, self.vbo = makeVertexBuffer(self.vertices)
 
         for _room in self.rooms:
             _room.finalize()
@@ -237,24 +962,31 @@ class Scene:
         self.camera.recalculateCameraVectors()
 
     def update(self, rate):
+        """
+            Move the lights and spheres near the camera on by rate frames.
+            The scene is only marked outDated, for the engine to pack its
+            objects again, if one of them moved or the camera changed room.
+        """
+
         row = int(self.camera.posArray[1])
         col = int(self.camera.posArray[0])
-        coordinate = (row, col)
-        
-        self.active_rooms = []
-        
-        for room in self.rooms:
-            if coordinate in room.internalCoordinates:
-                self.active_rooms.append(room)
-                
-                for _light in room.lights:
-                    _light.update(rate)
-                
-                for _sphere in room.spheres:
-                    _sphere.update(rate)
-        
-        # Update any lights that remain in the scene (global lights)
-        for _light in self.lights:
+
+        active_rooms = list(self.get_rooms_at(row, col))
+        if active_rooms != self.active_rooms:
+            self.outDated = True
+        self.active_rooms = active_rooms
+
+        moved = False
+        # Update any lights that remain in the scene (global lights) too
+        for _light in [_light for _room in self.active_rooms for _light in _room.lights] + self.lights:
+            position = _light.position
             _light.update(rate)
-        
-        self.outDated = True
\ No newline at end of file
+            moved |= not np.array_equal(position, _light.position)
+
+        for _sphere in [_sphere for _room in self.active_rooms for _sphere in _room.spheres]:
+            center = _sphere.center
+            _sphere.update(rate)
+            moved |= not np.array_equal(center, _sphere.center)
+
+        if moved:
+            self.outDated = True
\ No newline at end of file
@@ -0,0 +1,215 @@
+import headless
+from common import *
+import argparse
+import hashlib
+import json
+import platform
+import subprocess
+import time
+import elements
+import scene
+
+"""
+    Scripted rendering benchmarks, the README's performance table made
+    repeatable. Run from the repository root:
+
+        python "ray tracer/suite.py" --out results.json
+
+    Every run draws offscreen (see headless.py) along a scripted camera
+    path on a fixed timestep clock: frame i is at i * TIMESTEP seconds
+    whatever it took to draw, and the lights and spheres start from t = 0.
+    After WARMUP_FRAMES it times FRAMES frames, each drawn and finished on
+    the GPU, and collects the engine's per pass times (see profiler.py).
+
+    It runs every combination of the resolutions, FXAA on and off, the
+    scenes and their camera paths, and writes the frame time percentiles,
+    the passes and the object counts of each as JSON, with the commit and
+    the machine, so numbers can be compared across both.
+"""
+
+#seconds between frames on the scripted clock, a scene.update rate of 1
+TIMESTEP = scene.SCENE_FRAME_TIME
+#the README measures over 10 seconds
+FRAMES = 625
+WARMUP_FRAMES = 60
+#the README's resolutions
+RESOLUTIONS = ((600, 450), (800, 600), (960, 720))
+PERCENTILES = (50, 95, 99)
+#seconds to go once round the walking path
+WALK_PERIOD = 10.0
+
+def makeHall(size=24):
+    """
+        Scene arguments for a size x size hall with a pillar of each
+        texture in turn every 6 cells and five moving lights.
+    """
+
+    walls = np.zeros((size, size), dtype=np.int32)
+    rows, cols = np.mgrid[:size, :size]
+    pillars = (rows % 6 == 3) & (cols % 6 == 3)
+    walls[pillars] = 1 + np.arange(np.count_nonzero(pillars)) % 9
+    walls[0, :] = walls[-1, :] = walls[:, 0] = walls[:, -1] = 6
+    floors = np.full((size, size), 4, dtype=np.int32)
+
+    lights = [
+        elements.Light(position=(x, y, 0.5), color=color, strength=3, axis=axis, radius=2, velocity=0.025)
+        for (x, y), color, axis in (
+            ((6.5, 6.5), (1, 0, 0), (1, 0, 0)),
+            ((17.5, 6.5), (0, 1, 0), (0, 1, 0)),
+            ((6.5, 17.5), (0, 0, 1), (0, 1, 0)),
+            ((17.5, 17.5), (1, 1, 0), (1, 0, 0)),
+            ((12.5, 12.5), (1, 1, 1), (0.7071, 0.7071, 0)),
+        )
+    ]
+
+    return {
+        "wall_geometry": walls.tolist(), "floor_geometry": floors.tolist(),
+        "ceiling_geometry": (2 * floors).tolist(), "lights": lights,
+    }
+
+#per scene: its arguments, the pose watching its lights and the walk's
+#center and radius, which keeps clear of its blocks
+SCENES = {
+    #the README's test: the yellow light sweeping across the 9 textures
+    "default": {"args": dict, "sweep": ((14.5, 2.0, 0.6), 125, -8), "walk": ((10.5, 4.5), 2.0)},
+    "hall": {"args": makeHall, "sweep": ((1.5, 12.0, 0.6), 0, -5), "walk": ((12.0, 12.0), 2.0)},
+}
+PATHS = ("sweep", "walk")
+
+def getPose(scene_name, path, t):
+    """
+        Where a scene's camera path is at a time, as (position, theta, phi).
+    """
+
+    if path == "sweep":
+        return SCENES[scene_name]["sweep"]
+
+    (x, y), radius = SCENES[scene_name]["walk"]
+    angle = 2 * np.pi * t / WALK_PERIOD
+    #facing the way it walks
+    return (x + radius * np.cos(angle), y + radius * np.sin(angle), 0.5), np.rad2deg(angle) + 90, 0
+
+def countObjects(renderer):
+    """
+        The objects the ray tracer saw on the last frame, and the level's size.
+    """
+
+    _scene = renderer.scene
+    store = renderer.graphicsEngine.objectStore
+    return {
+        "rooms": len(_scene.rooms),
+        "active_rooms": len(_scene.active_rooms),
+        "lights": len(_scene.lights) + sum(len(_room.lights) for _room in _scene.active_rooms),
+        "spheres": len(_scene.spheres) + sum(len(_room.spheres) for _room in _scene.active_rooms),
+        "planes": store.planeCount,
+        "top_nodes": store.topNodeCount,
+        "vertices": _scene.vertexCount + sum(_room.vertexCount for _room in _scene.active_rooms),
+    }
+
+def runCase(scene_name, path, width, height, use_fxaa, frames=FRAMES, warmup=WARMUP_FRAMES, engine_args=None):
+    """
+        Time a scene's camera path at a resolution, returns its results.
+    """
+
+    renderer = headless.HeadlessRenderer(
+        width, height, use_fxaa=use_fxaa, profile=True,
+        scene_args={"use_level_cache": False, **SCENES[scene_name]["args"]()},
+        **(engine_args or {})
+    )
+    renderer.reset()
+    profiler = renderer.graphicsEngine.profiler
+
+    frameTimes = []
+    for frame in range(warmup + frames):
+        if frame == warmup:
+            profiler.reset()
+        t = frame * TIMESTEP
+        start = time.perf_counter()
+        renderer.draw(getPose(scene_name, path, t), t)
+        glFinish()
+        if frame >= warmup:
+            frameTimes.append(1e3 * (time.perf_counter() - start))
+    profiler.flush()
+
+    frameTimes = np.array(frameTimes)
+    result = {
+        "scene": scene_name, "path": path, "width": width, "height": height,
+        "fxaa": use_fxaa, "frames": frames, "warmup": warmup, "timestep": TIMESTEP,
+        "frame_ms": {
+            "mean": float(frameTimes.mean()),
+            **{f"p{_p}": float(_value) for _p, _value in zip(PERCENTILES, np.percentile(frameTimes, PERCENTILES))},
+        },
+        "fps": float(1e3 / frameTimes.mean()),
+        "passes": profiler.getSummary(everything=True),
+        "objects": countObjects(renderer),
+        #the same on a machine from run to run, if the clock is deterministic
+        "last_frame_md5": hashlib.md5(renderer.readImage().tobytes()).hexdigest(),
+        "renderer": glGetString(GL_RENDERER).decode(),
+    }
+    renderer.destroy()
+    return result
+
+def getCommit():
+
+    try:
+        return subprocess.run(
+            ("git", "rev-parse", "HEAD"), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runSuite(resolutions=RESOLUTIONS, fxaa=(False, True), scenes=tuple(SCENES), paths=PATHS,
+    frames=FRAMES, warmup=WARMUP_FRAMES, engine_args=None):
+    """
+        Run every combination, returns the results with the commit and machine.
+    """
+
+    results = []
+    for scene_name in scenes:
+        for path in paths:
+            for width, height in resolutions:
+                for use_fxaa in fxaa:
+                    result = runCase(scene_name, path, width, height, use_fxaa, frames, warmup, engine_args)
+                    print(f"{scene_name:>8} {path:>6} {width:5d}x{height:<5d} fxaa {str(use_fxaa):>5}"
+                        f" {result['fps']:9.2f} fps  p50 {result['frame_ms']['p50']:9.3f} ms"
+                        f"  p99 {result['frame_ms']['p99']:9.3f} ms")
+                    results.append(result)
+
+    return {
+        "commit": getCommit(),
+        "machine": {
+            "platform": platform.platform(), "processor": platform.processor(),
+            "python": platform.python_version(),
+            "renderer": results[0]["renderer"] if results else None,
+        },
+        "engine_args": engine_args or {},
+        "results": results,
+    }
+
+def parseResolution(text):
+
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scripted rendering benchmarks.")
+    parser.add_argument("--resolutions", nargs="+", type=parseResolution,
+        default=RESOLUTIONS, help="WIDTHxHEIGHT, the README's by default")
+    parser.add_argument("--fxaa", nargs="+", choices=("off", "on"), default=("off", "on"))
+    parser.add_argument("--scenes", nargs="+", choices=tuple(SCENES), default=tuple(SCENES))
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=PATHS)
+    parser.add_argument("--frames", type=int, default=FRAMES)
+    parser.add_argument("--warmup", type=int, default=WARMUP_FRAMES)
+    parser.add_argument("--engine-args", type=json.loads, default={},
+        help='engine.Engine arguments as JSON, such as \'{"lighting_scale": 2}\'')
+    parser.add_argument("--out", help="write the results to this JSON file")
+    arguments = parser.parse_args()
+
+    report = runSuite(
+        resolutions=arguments.resolutions, fxaa=tuple(_f == "on" for _f in arguments.fxaa),
+        scenes=arguments.scenes, paths=arguments.paths, frames=arguments.frames,
+        warmup=arguments.warmup, engine_args=arguments.engine_args
+    )
+    if arguments.out:
+        with open(arguments.out, "w") as file:
+            json.dump(report, file, indent=1)
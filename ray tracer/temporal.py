@@ -0,0 +1,210 @@
+from elements import *
+import lightgrid
+
+"""
+    Lighting kept from one frame to the next.
+
+    With the temporal cache on, the ray tracer stores each lighting
+    sample's light together with its distance to the camera. Next frame a
+    sample finds where its surface point was on the previous frame's screen
+    (reprojecting it with the previous view and projection) and takes the
+    light stored there, if the distance stored there matches its own
+    distance to the previous camera position. Otherwise it traces again.
+
+    It always traces again if it is in this frame's share of the screen
+    (one sample in REFRESH_PERIOD, in turn) or if its cell of the wall grid
+    is dirty. Once a light or sphere has moved LIGHT_MOVE_THRESHOLD since
+    the cache last traced for it, the cells within MOVE_REACH times that
+    distance of where it was and is are dirty (no farther than the light
+    reaches, and for a sphere only if a light reaches it). Farther away
+    the light changes little for the move and catches up through the
+    refresh share. Changing the blocks or the set of lights and spheres
+    makes every cell dirty.
+
+    getRefreshMask and reprojectPositions are the NumPy versions of the
+    shader's tests.
+"""
+
+#samples trace again at least once every REFRESH_PERIOD frames
+REFRESH_PERIOD = 8
+#lights and spheres moving less than this leave the cache alone
+LIGHT_MOVE_THRESHOLD = 0.1
+#a move dirties the cells within this many times its length
+MOVE_REACH = 40
+#history is kept while the distance to the camera matches to this fraction
+HISTORY_TOLERANCE = 0.05
+
+#texture units of the history and the dirty cells in the ray tracer
+HISTORY_UNIT = 8
+DIRTY_UNIT = 9
+#atomic counter binding counting the samples traced
+COUNTER_BINDING = 0
+
+def getRefreshMask(width, height, frame):
+    """
+        Which samples of a lighting image trace again this frame in any case.
+    """
+
+    y, x = np.mgrid[:height, :width]
+    return (x + 3 * y) % REFRESH_PERIOD == frame % REFRESH_PERIOD
+
+def reprojectPositions(positions, view_projection, screen_size, scale):
+    """
+        Lighting samples under surface points on the screen of a camera.
+
+            Parameters:
+                positions (array): (count, 3) points
+                view_projection (array): 4x4 view @ projection, pyrr's row vector order
+                screen_size (tuple): (width, height) in pixels
+                scale (int): pixels per lighting sample along each axis
+
+            Returns:
+                (count, 2) int array of lighting image (column, row),
+                -1 for points behind the camera
+    """
+
+    positions = np.asarray(positions, dtype=np.float64)
+    clip = np.column_stack((positions, np.ones(len(positions)))) @ np.asarray(view_projection, dtype=np.float64)
+    ahead = clip[:, 3] > 0
+    w = np.where(ahead, clip[:, 3], 1)
+    screen = (clip[:, :2] / w[:, None] * 0.5 + 0.5) * np.asarray(screen_size)
+    samples = np.floor((screen - 0.5 - scale // 2) / scale + 0.5).astype(np.int64)
+    return np.where(ahead[:, None], samples, -1)
+
+def getReachedCells(positions, radii, shape):
+    """
+        Cells of a grid (rows, cols) within reach of any of the points.
+    """
+
+    cells, _ = lightgrid.binLights(positions, radii, shape)
+    return (cells["count"] > 0).reshape(shape)
+
+class TemporalCache:
+    """
+        The moving lights and spheres followed for the cache, the dirty
+        cells sent to the shader and the camera of the previous frame.
+    """
+
+    def __init__(self):
+
+        self.key = None
+        self.lightPositions = None
+        self.spherePositions = None
+        self.frame = 0
+        self.previousViewProjection = None
+        self.previousPosition = None
+
+        self.dirtyTexture = None
+        self.shape = None
+        self.counterBuffer = None
+
+    def getDirtyCells(self, scene):
+        """
+            Find the cells whose light changed since they were last traced,
+            and mark the lights and spheres which moved that far as traced.
+            Everything is dirty on the first frame and after the blocks,
+            lights or spheres change.
+        """
+
+        lights = scene.lights + [_light for _room in scene.active_rooms for _light in _room.lights]
+        spheres = scene.spheres + [_sphere for _room in scene.active_rooms for _sphere in _room.spheres]
+        shape = scene.wall_array.shape
+        lightPositions = np.array([_light.position for _light in lights], dtype=np.float64).reshape(-1, 3)
+        spherePositions = np.array([_sphere.center for _sphere in spheres], dtype=np.float64).reshape(-1, 3)
+
+        key = (scene.planeVersion, shape, tuple(map(id, lights)), tuple(map(id, spheres)))
+        if key != self.key or self.previousViewProjection is None:
+            self.key = key
+            self.lightPositions = lightPositions
+            self.spherePositions = spherePositions
+            return np.ones(shape, dtype=bool)
+
+        radii = lightgrid.getInfluenceRadii(lights).astype(np.float64)
+        movedLights = np.linalg.norm(lightPositions - self.lightPositions, axis=1) > LIGHT_MOVE_THRESHOLD
+        movedSpheres = np.linalg.norm(spherePositions - self.spherePositions, axis=1) > LIGHT_MOVE_THRESHOLD
+
+        #a moving light changes the light around where it was and where it is
+        moves = np.linalg.norm(lightPositions - self.lightPositions, axis=1)[movedLights]
+        reached = np.concatenate((self.lightPositions[movedLights], lightPositions[movedLights]))
+        dirty = getReachedCells(reached, np.tile(np.minimum(MOVE_REACH * moves, radii[movedLights]), 2), shape)
+
+        #and a moving sphere the shadows around it, if a light reaches it
+        if np.any(movedSpheres):
+            sphereRadii = np.array([_sphere.radius for _sphere in spheres], dtype=np.float64)[movedSpheres]
+            moves = np.linalg.norm(spherePositions - self.spherePositions, axis=1)[movedSpheres]
+            centers = np.concatenate((self.spherePositions[movedSpheres], spherePositions[movedSpheres]))
+            distances = np.linalg.norm(lightPositions[:, None, :] - centers[None, :, :], axis=2)
+            lit = np.any(distances - np.tile(sphereRadii, 2)[None, :] < radii[:, None], axis=0)
+            reach = np.minimum(MOVE_REACH * np.tile(moves, 2) + np.tile(sphereRadii, 2), radii.max(initial=0))
+            dirty |= getReachedCells(centers[lit], reach[lit], shape)
+
+        self.lightPositions[movedLights] = lightPositions[movedLights]
+        self.spherePositions[movedSpheres] = spherePositions[movedSpheres]
+        return dirty
+
+    def upload(self, scene):
+        """
+            Send this frame's dirty cells.
+        """
+
+        dirty = np.ascontiguousarray(self.getDirtyCells(scene), dtype=np.int32)
+        if self.dirtyTexture is None:
+            self.dirtyTexture = glGenTextures(1)
+            self.counterBuffer = glGenBuffers(1)
+        glBindTexture(GL_TEXTURE_2D, self.dirtyTexture)
+        if dirty.shape != self.shape:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_R32I, dirty.shape[1], dirty.shape[0], 0, GL_RED_INTEGER, GL_INT, dirty)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            self.shape = dirty.shape
+        else:
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, dirty.shape[1], dirty.shape[0], GL_RED_INTEGER, GL_INT, dirty)
+
+        glBindBuffer(GL_ATOMIC_COUNTER_BUFFER, self.counterBuffer)
+        glBufferData(GL_ATOMIC_COUNTER_BUFFER, 4, np.zeros(1, dtype=np.uint32), GL_DYNAMIC_DRAW)
+
+    def bind(self, history):
+        """
+            Bind the dirty cells, the previous frame's lighting and the counter.
+        """
+
+        glActiveTexture(GL_TEXTURE0 + HISTORY_UNIT)
+        glBindTexture(GL_TEXTURE_2D, history)
+        glActiveTexture(GL_TEXTURE0 + DIRTY_UNIT)
+        glBindTexture(GL_TEXTURE_2D, self.dirtyTexture)
+        glActiveTexture(GL_TEXTURE0)
+        glBindBufferBase(GL_ATOMIC_COUNTER_BUFFER, COUNTER_BINDING, self.counterBuffer)
+
+    def reset(self):
+        """
+            Forget the history, every cell is dirty next frame.
+        """
+
+        self.previousViewProjection = None
+
+    def advance(self, view_projection, position):
+        """
+            Remember this frame's camera for the next one.
+        """
+
+        self.previousViewProjection = np.array(view_projection, dtype=np.float32)
+        self.previousPosition = np.array(position, dtype=np.float32)
+        self.frame += 1
+
+    def readTracedSamples(self):
+        """
+            Samples traced in the last frame, the rest came from the history.
+            Waits for the frame to finish.
+        """
+
+        glBindBuffer(GL_ATOMIC_COUNTER_BUFFER, self.counterBuffer)
+        return int(np.frombuffer(glGetBufferSubData(GL_ATOMIC_COUNTER_BUFFER, 0, 4), dtype=np.uint32)[0])
+
+    def destroy(self):
+
+        if self.dirtyTexture is not None:
+            glDeleteTextures(1, (self.dirtyTexture,))
+            glDeleteBuffers(1, (self.counterBuffer,))
+            self.dirtyTexture = None
+            self.counterBuffer = None
+            self.shape = None
@@ -1,34 +1,58 @@
 from common import *
 
+#the engine's materials, in material index order
+MATERIAL_FILES = [
+    "CopperFlatRoundRoofPatina", "AlternatingHandmadeTilesMonochrome", "BiomechZombieCircuits", 
+    "BakeliteMarbledPlastic", "MarsSmoothRock", "MetalCrateXCorrugatedPainted",
+    "OrangePineTreeBark", "SpaceLabWallOld", "SpaceStationWallKit5Metallic"
+]
+
+def loadAtlasBytes(filenames):
+    """
+        Lay the materials' albedo, emissive, glossiness, normal and specular
+        maps side by side, a row of them per material with the first at
+        the bottom. Returns (width, height, RGBA bytes), top row first,
+        which is the texture's first row in OpenGL.
+    """
+
+    texture_size = 1024
+    texture_count = len(filenames)
+    width = 5 * texture_size
+    height = texture_count * texture_size
+
+    textureData = pg.Surface((width,height))
+    for i in range(texture_count):
+        #load albedo
+        image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_albedo.png")
+        textureData.blit(image, (0, (texture_count - i - 1) * texture_size))
+        #load emissive
+        image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_emissive.png")
+        textureData.blit(image, (texture_size, (texture_count - i - 1) * texture_size))
+        #load glossmap
+        image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_glossiness.png")
+        textureData.blit(image, (2 * texture_size, (texture_count - i - 1) * texture_size))
+        #load normal
+        image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_normal.png")
+        textureData.blit(image, (3 * texture_size, (texture_count - i - 1) * texture_size))
+        #load specular
+        image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_specular.png")
+        textureData.blit(image, (4 * texture_size, (texture_count - i - 1) * texture_size))
+    return width, height, pg.image.tostring(textureData,"RGBA")
+
+def loadAtlas(filenames=MATERIAL_FILES):
+    """
+        The atlas SuperTexture uploads, as a (height, width, 4) uint8 array
+        indexed [row, column] like the texture's texels.
+    """
+
+    width, height, img_data = loadAtlasBytes(filenames)
+    return np.frombuffer(img_data, dtype=np.uint8).reshape(height, width, 4)
+
 class SuperTexture:
 
     def __init__(self, filenames):
-        
-        texture_size = 1024
-        texture_count = len(filenames)
-        width = 5 * texture_size
-        height = texture_count * texture_size
-
-        
-        textureData = pg.Surface((width,height)).convert()
-        for i in range(texture_count):
-            #load albedo
-            image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_albedo.png").convert()
-            textureData.blit(image, (0, (texture_count - i - 1) * texture_size))
-            #load emissive
-            image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_emissive.png").convert()
-            textureData.blit(image, (texture_size, (texture_count - i - 1) * texture_size))
-            #load glossmap
-            image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_glossiness.png").convert()
-            textureData.blit(image, (2 * texture_size, (texture_count - i - 1) * texture_size))
-            #load normal
-            image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_normal.png").convert()
-            textureData.blit(image, (3 * texture_size, (texture_count - i - 1) * texture_size))
-            #load specular
-            image = pg.image.load(f"ray tracer/textures/{filenames[i]}/{filenames[i]}_specular.png").convert()
-            textureData.blit(image, (4 * texture_size, (texture_count - i - 1) * texture_size))
-        img_data = pg.image.tostring(textureData,"RGBA")
 
+        width, height, img_data = loadAtlasBytes(filenames)
 
         self.texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.texture)
@@ -0,0 +1,218 @@
+from elements import *
+import os
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+import cpurender
+import scene
+
+"""
+    The CPU renderer (cpurender.py) on every core. The frame is cut into
+    TILE_SIZE square tiles which a pool of worker processes draws, each
+    tile going to the next free worker so slow tiles don't hold up the rest.
+
+    Nothing large is pickled per tile. The atlas is copied into shared
+    memory once, when the pool starts, and each frame's packed rows, map
+    and camera (cpurender.packFrame) into a second block. Workers attach
+    to both by name and draw their tiles straight into a shared image,
+    so a task only says where those are and which tile to draw.
+
+    Run from the repository root to save a frame:
+
+        python "ray tracer/tilerender.py" frame.png
+"""
+
+#pixels along the side of a tile
+TILE_SIZE = 64
+#arrays in a shared block start on multiples of this many bytes
+ALIGNMENT = 64
+#environment variables holding the BLAS libraries' thread counts
+BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+def getTiles(width, height, size=TILE_SIZE):
+    """
+        Cut an image into tiles, (x, y, width, height) in pixels from the
+        top left. Tiles on the right and bottom edges may be smaller.
+    """
+
+    return [
+        (x, y, min(size, width - x), min(size, height - y))
+        for y in range(0, height, size) for x in range(0, width, size)
+    ]
+
+def getArrayViews(buffer, layout):
+    """
+        Arrays over a shared block's buffer, from a layout made by SharedBlock.write.
+    """
+
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        for name, (offset, shape, dtype) in layout.items()
+    }
+
+class SharedBlock:
+    """
+        Named arrays in a block of shared memory, which other processes
+        attach to by its name. A write which doesn't fit replaces the
+        block with one twice the size needed.
+    """
+
+    def __init__(self, size=ALIGNMENT):
+
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+
+    def write(self, arrays):
+        """
+            Copy a dict of arrays into the block.
+
+                Returns:
+                    (block name, {array name: (offset, shape, dtype)}),
+                    which attachBlock reads them back with
+        """
+
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            layout[name] = (size, array.shape, array.dtype)
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+        if size > self.memory.size:
+            self.destroy()
+            self.memory = shared_memory.SharedMemory(create=True, size=2 * size)
+
+        views = getArrayViews(self.memory.buf, layout)
+        for name, array in arrays.items():
+            views[name][...] = array
+        return self.memory.name, layout
+
+    def getArrays(self, layout):
+
+        return getArrayViews(self.memory.buf, layout)
+
+    def destroy(self):
+
+        self.memory.close()
+        self.memory.unlink()
+
+#in a worker: role -> the shared memory it has attached for it
+attached = {}
+
+def attachBlock(role, block):
+    """
+        A worker's views of a shared block's arrays. The block stays
+        attached until another with a different name takes its role.
+    """
+
+    name, layout = block
+    if role not in attached or attached[role].name != name:
+        if role in attached:
+            attached[role].close()
+        attached[role] = shared_memory.SharedMemory(name=name)
+    return getArrayViews(attached[role].buf, layout)
+
+def renderTile(task):
+    """
+        Draw one tile into the shared image, in a worker. Returns the tile.
+    """
+
+    frameBlock, atlasBlock, imageBlock, occlusion_mode, tile = task
+    frame = attachBlock("frame", frameBlock)
+    atlas = attachBlock("atlas", atlasBlock)["atlas"]
+    image = attachBlock("image", imageBlock)["image"]
+
+    x, y, width, height = tile
+    directions = cpurender.getRayDirections(frame["camera"], image.shape[1], image.shape[0], tile)
+    color = cpurender.renderPixels(frame, atlas, occlusion_mode, directions.reshape(-1, 3))
+    image[y:y + height, x:x + width] = color.reshape(height, width, 3)
+    return tile
+
+def startPool(workers):
+    """
+        Start worker processes with BLAS held to one thread in each. The
+        workers are the parallelism, and NumPy's matrix products would
+        otherwise start a thread per core in every one of them. BLAS
+        reads its thread count when it loads, so the workers are spawned
+        afresh rather than forked from this process.
+    """
+
+    saved = {_name: os.environ.get(_name) for _name in BLAS_THREAD_VARIABLES}
+    os.environ.update(dict.fromkeys(BLAS_THREAD_VARIABLES, "1"))
+    try:
+        return multiprocessing.get_context("spawn").Pool(workers)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+class TileRenderer(cpurender.CPURenderer):
+    """
+        A CPURenderer which shares the frame out between worker processes.
+    """
+
+    def __init__(self, scene, width=640, height=None, occlusion_mode="bvh", atlas=None,
+        workers=None, tile_size=TILE_SIZE):
+        """
+            Set up the shared blocks and start the workers.
+
+                Parameters:
+                    scene, width, height, occlusion_mode, atlas: as cpurender.CPURenderer
+                    workers (int): worker processes, one per core if not given
+                    tile_size (int): pixels along the side of a tile
+        """
+
+        super().__init__(scene, width, height, occlusion_mode, atlas)
+        self.tiles = getTiles(self.width, self.height, tile_size)
+
+        self.atlasMemory = SharedBlock()
+        self.atlasBlock = self.atlasMemory.write({"atlas": self.atlas})
+        self.atlas = self.atlasMemory.getArrays(self.atlasBlock[1])["atlas"]
+        self.frameMemory = SharedBlock()
+        self.imageMemory = SharedBlock()
+        self.imageBlock = self.imageMemory.write(
+            {"image": np.zeros((self.height, self.width, 3), dtype=np.float32)}
+        )
+        self.image = self.imageMemory.getArrays(self.imageBlock[1])["image"]
+
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = startPool(self.workers)
+
+    def render(self):
+        """
+            Draw the scene as it is now from its camera.
+
+                Returns:
+                    a (height, width, 3) float32 array, the engine's color
+                    buffer, top row first
+        """
+
+        frameBlock = self.frameMemory.write(cpurender.packFrame(self.scene, self.objectStore))
+        tasks = [
+            (frameBlock, self.atlasBlock, self.imageBlock, self.occlusionMode, _tile)
+            for _tile in self.tiles
+        ]
+        #tiles land in the image as they finish
+        for _ in self.pool.imap_unordered(renderTile, tasks):
+            pass
+
+        return self.image.copy()
+
+    def destroy(self):
+
+        self.pool.close()
+        self.pool.join()
+        #drop the views before the blocks they look into
+        self.atlas = self.image = None
+        for block in (self.atlasMemory, self.frameMemory, self.imageMemory):
+            block.destroy()
+
+if __name__ == "__main__":
+    renderer = TileRenderer(scene.Scene(finalize=False))
+    camera = renderer.scene.camera
+    image = renderer.render_frame((camera.posArray, camera.theta, camera.phi), 0.0)
+    pg.image.save(
+        pg.surfarray.make_surface(np.ascontiguousarray(image.swapaxes(0, 1))),
+        sys.argv[1] if len(sys.argv) > 1 else "frame.png"
+    )
+    renderer.destroy()
@@ -0,0 +1,111 @@
+from elements import *
+
+"""
+    Lighting at a fraction of the screen's resolution.
+
+    Light changes slowly across a surface compared to its textures, so the
+    ray tracer can shade one pixel in every LIGHTING_SCALE x LIGHTING_SCALE
+    block (its sample pixel) into a small lighting image. A second pass
+    brings that back to every pixel: each pixel blends the four nearest
+    samples, weighting them by how close they are on screen and by how
+    well they match its g-buffer normal and lie on its plane, so light
+    doesn't bleed across edges. The result is multiplied by the pixel's
+    own albedo and its emissive added, which keeps textures sharp.
+
+    Shadow rays drop by the square of the scale. upsampleLighting is the
+    NumPy version of the shader's upsample pass, getPSNR measures what is lost.
+"""
+
+#engine lighting scales: pixels per lighting sample along each axis
+LIGHTING_SCALES = (1, 2, 4)
+
+#a sample's normal weight is dot(normals) ** NORMAL_POWER
+NORMAL_POWER = 8
+#and its plane weight falls by e every PLANE_SIGMA units off the pixel's plane
+PLANE_SIGMA = 0.05
+#samples weigh less than this together: fall back on the geometry alone, then on distance alone
+WEIGHT_EPSILON = 1e-4
+
+def getLightingSize(width, height, scale):
+    """
+        Size of the lighting image for a screen, a sample for every started block.
+    """
+
+    return -(-width // scale), -(-height // scale)
+
+def getSamplePixels(width, height, scale):
+    """
+        The screen pixel shaded for each lighting sample: the middle of its block,
+        kept on screen. Returns (columns, rows) of the lighting image's pixels.
+    """
+
+    lighting_width, lighting_height = getLightingSize(width, height, scale)
+    columns = np.minimum(np.arange(lighting_width) * scale + scale // 2, width - 1)
+    rows = np.minimum(np.arange(lighting_height) * scale + scale // 2, height - 1)
+    return columns, rows
+
+def upsampleLighting(lighting, positions, normals, scale):
+    """
+        Bring lighting samples back to every pixel, guided by the g-buffer.
+
+            Parameters:
+                lighting (array): (lighting height, lighting width, 3) light
+                    at the sample pixels
+                positions (array): (height, width, 3) g-buffer positions
+                normals (array): (height, width, 3) g-buffer normals, -1 to 1
+                scale (int): pixels per sample along each axis
+
+            Returns:
+                a (height, width, 3) array of light
+    """
+
+    lighting = np.asarray(lighting, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    normals = np.asarray(normals, dtype=np.float64)
+    height, width = positions.shape[:2]
+    columns, rows = getSamplePixels(width, height, scale)
+
+    #the samples either side of each pixel, and how far it is between them
+    taps = []
+    for size, count in ((width, len(columns)), (height, len(rows))):
+        u = (np.arange(size) - scale // 2) / scale
+        i0 = np.clip(np.floor(u).astype(np.int64), 0, count - 1)
+        i1 = np.minimum(i0 + 1, count - 1)
+        f = np.clip(u - i0, 0, 1)
+        taps.append(((i0, 1 - f), (i1, f)))
+
+    weights, geometry = [], []
+    for i_y, w_y in taps[1]:
+        for i_x, w_x in taps[0]:
+            sample_positions = positions[rows[i_y][:, None], columns[i_x][None, :]]
+            sample_normals = normals[rows[i_y][:, None], columns[i_x][None, :]]
+            facing = np.maximum(np.einsum("ijk,ijk->ij", normals, sample_normals), 0) ** NORMAL_POWER
+            off_plane = np.abs(np.einsum("ijk,ijk->ij", normals, sample_positions - positions))
+            geometry.append(facing * np.exp(-off_plane / PLANE_SIGMA))
+            weights.append(w_y[:, None] * w_x[None, :])
+    weights, geometry = np.array(weights), np.array(geometry)
+
+    blended = weights * geometry
+    total = blended.sum(axis=0)
+    blended = np.where(total > WEIGHT_EPSILON, blended, geometry)
+    total = blended.sum(axis=0)
+    blended = np.where(total > WEIGHT_EPSILON, blended, weights)
+    blended /= blended.sum(axis=0)
+
+    light = np.zeros((height, width, 3))
+    k = 0
+    for i_y, _ in taps[1]:
+        for i_x, _ in taps[0]:
+            light += blended[k][:, :, None] * lighting[i_y[:, None], i_x[None, :]]
+            k += 1
+    return light
+
+def getPSNR(reference, image):
+    """
+        Peak signal to noise ratio of an image against a reference, in
+        decibels, both clipped to the displayable 0 to 1. Infinite if they match.
+    """
+
+    difference = np.clip(np.asarray(image, dtype=np.float64), 0, 1) - np.clip(np.asarray(reference, dtype=np.float64), 0, 1)
+    error = np.mean(difference ** 2)
+    return np.inf if error == 0 else 10 * np.log10(1 / error)
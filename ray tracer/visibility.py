@@ -0,0 +1,146 @@
+from elements import *
+import lightgrid
+import occlusion
+
+"""
+    Baked wall visibility for lights moving along their fixed paths.
+
+    A light sits at center + radius * axis * phase, with phase = sin(velocity * t)
+    between -1 and 1, so its whole path is known in advance. For positions
+    PATH_SAMPLES_PER_UNIT a unit apart along it, the visibility of the light
+    from a lattice of points (NODES_PER_UNIT per unit, in the box its
+    influence radius can reach) is found by stepping through the wall grid
+    (occlusion.walkGrid) and stored as a byte. The shader blends the stored values of the nodes around a
+    pixel, and of the two samples either side of the light's phase, instead
+    of casting a shadow ray against the walls. Spheres still get a ray.
+    Shadow edges come out soft, a node or so wide.
+
+    A light keeps its volume in _light.volume until the blocks change.
+    sampleVolume is the NumPy version of the shader's bakedVisibility.
+"""
+
+#light positions baked per unit of a moving light's path
+PATH_SAMPLES_PER_UNIT = 4
+#lattice points per unit along each axis
+NODES_PER_UNIT = 4
+
+#one light's volume, the shader's PackedVolume struct. Node (x, y, z) of
+#sample k is byte first + ((k * size z + z) * size y + y) * size x + x of the
+#visibility bytes. samples is 0 for lights without a volume.
+VOLUME_LAYOUT = np.dtype([
+    ("lower", np.float32, (3,)), ("spacing", np.float32),
+    ("size", np.int32, (3,)), ("first", np.int32), ("samples", np.int32),
+    ("phase", np.float32),
+])
+#four visibility bytes, the shader's PackedVisibility struct
+WORD_LAYOUT = np.dtype([("bytes", np.uint32)])
+
+def isMoving(_light):
+
+    return _light.radius != 0 and _light.velocity != 0 and np.any(_light.axis != 0)
+
+def getPhase(_light):
+    """
+        Where a light is along its path, from -1 to 1.
+    """
+
+    return float(np.sin(_light.velocity * _light.t)) if isMoving(_light) else 0.0
+
+def getPathSamples(_light, samples_per_unit=PATH_SAMPLES_PER_UNIT):
+    """
+        Positions baked along a light's path, evenly spaced in phase,
+        at least both ends. A light which doesn't move has one.
+    """
+
+    if not isMoving(_light):
+        return _light.center[None, :].astype(np.float64)
+
+    length = 2 * abs(_light.radius) * np.linalg.norm(_light.axis)
+    phases = np.linspace(-1, 1, max(2, int(np.ceil(length * samples_per_unit)) + 1))
+    return _light.center + _light.radius * phases[:, None] * _light.axis[None, :].astype(np.float64)
+
+def bakeVolume(_light, solid, samples_per_unit=PATH_SAMPLES_PER_UNIT, nodes_per_unit=NODES_PER_UNIT):
+    """
+        Bake a light's visibility from the walls of a grid.
+
+            Parameters:
+                _light (elements.Light): the light
+                solid (bool array): rows x cols, see occlusion.getSolidGrid
+                samples_per_unit (int): positions per unit of its path, if it moves
+                nodes_per_unit (int): lattice density
+
+            Returns:
+                (header, data): a VOLUME_LAYOUT record with first and phase
+                left at 0, and the uint8 visibility of shape
+                (samples, size z, size y, size x)
+    """
+
+    positions = getPathSamples(_light, samples_per_unit)
+    reach = float(lightgrid.getInfluenceRadii([_light])[0])
+    spacing = 1.0 / nodes_per_unit
+    rows, cols = solid.shape
+
+    #box around the whole path and its reach, snapped to the lattice and the map
+    lower = np.maximum(np.floor((positions.min(axis=0) - reach) * nodes_per_unit) * spacing, 0)
+    upper = np.minimum(np.ceil((positions.max(axis=0) + reach) * nodes_per_unit) * spacing, (cols, rows, 1))
+    lower[2], upper[2] = 0, 1
+    size = np.maximum(np.round((upper - lower) * nodes_per_unit).astype(np.int64) + 1, 2)
+
+    z, y, x = np.meshgrid(*(lower[axis] + spacing * np.arange(size[axis]) for axis in (2, 1, 0)), indexing="ij")
+    nodes = np.stack((x.ravel(), y.ravel(), z.ravel()), axis=1)
+
+    data = np.empty((len(positions), nodes.shape[0]), dtype=np.uint8)
+    for k, position in enumerate(positions):
+        directions = position - nodes
+        distances = np.linalg.norm(directions, axis=1)
+        directions /= np.maximum(distances, 1e-9)[:, None]
+        data[k] = np.where(occlusion.walkGrid(solid, nodes, directions, distances), 0, 255)
+
+    header = np.zeros((), dtype=VOLUME_LAYOUT)
+    header["lower"] = lower
+    header["spacing"] = spacing
+    header["size"] = size
+    header["samples"] = len(positions)
+    return header, data.reshape(len(positions), size[2], size[1], size[0])
+
+def getVolume(_light, solid, version):
+    """
+        A light's volume, baked again if the blocks changed since version.
+    """
+
+    if _light.volume is None or _light.volume[0] != version:
+        _light.volume = (version,) + bakeVolume(_light, solid)
+    return _light.volume[1:]
+
+def sampleVolume(header, data, phase, positions, directions):
+    """
+        Visibility of a light at surface points, from its baked volume,
+        blended as the shader does. Points are pushed half a node along
+        their (normalised) directions to the light first, so a lit face
+        reads the open side of its wall and an unlit one the inside.
+    """
+
+    spacing = float(header["spacing"])
+    size = header["size"].astype(np.int64)
+    samples = int(header["samples"])
+    p = (np.asarray(positions) + 0.5 * spacing * np.asarray(directions) - header["lower"]) / spacing
+    p = np.clip(p, 0, size - 1)
+    i0 = np.minimum(np.floor(p).astype(np.int64), size - 2)
+    f = p - i0
+
+    u = (phase + 1) * 0.5 * (samples - 1)
+    k0 = min(int(np.floor(u)), max(samples - 2, 0))
+    fk = u - k0 if samples > 1 else 0.0
+
+    result = np.zeros(len(p))
+    for k, wk in ((k0, 1 - fk), (min(k0 + 1, samples - 1), fk)):
+        for dz in (0, 1):
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    weight = (
+                        (f[:, 0] if dx else 1 - f[:, 0]) * (f[:, 1] if dy else 1 - f[:, 1])
+                        * (f[:, 2] if dz else 1 - f[:, 2])
+                    )
+                    value = data[k, i0[:, 2] + dz, i0[:, 1] + dy, i0[:, 0] + dx]
+                    result += wk * weight * value / 255.0
+    return result